@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -94,6 +95,26 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.1/ref/settings/#caches
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Per-user conversation lists, see main/conversation_cache.py. Any cache backend works, e.g.
+    # 'django.core.cache.backends.redis.RedisCache' with 'LOCATION': 'redis://127.0.0.1:6379/1'.
+    'conversations': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'conversations',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -145,7 +166,7 @@ REST_FRAMEWORK = {
     # 'DEFAULT_PAGINATION_CLASS':
     #     'rest_framework.pagination.PageNumberPagination', 'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'main.authentication.CachedTokenAuthentication',
     ]
 }
 
@@ -158,6 +179,10 @@ CORS_ALLOWED_ORIGINS = [
 ]
 
 
+# The sharded layer is opt-in: set BACKEND to 'main.layers.ShardedChannelLayer' to
+# consistent-hash groups and channels over several Redis hosts, e.g.
+# "hosts": [('redis-1', 6379), ('redis-2', 6379)]. See main/layers.py.
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -169,3 +194,73 @@ CHANNEL_LAYERS = {
     },
 }
 
+
+# Presence backend for chat sockets, see main/presence.py.
+
+CONVO_PRESENCE = {
+    'BACKEND': 'main.presence.ChannelLayerPresence',
+    'TTL': 60,
+}
+
+
+# Token-to-user cache shared by REST and websocket authentication, see main/authentication.py.
+
+CONVO_TOKEN_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 60,
+}
+
+
+# Typing indicator coalescing for chat sockets, see TypingIndicator in main/consumers.py.
+
+CONVO_TYPING = {
+    'TIMEOUT': 5.0,
+    'DEBOUNCE': 1.0,
+}
+
+
+# Outbound frame queue of every socket, see main/outbound.py.
+
+CONVO_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 256,
+}
+
+
+# Per-event latency and query metrics, served at /api/metrics, see main/instrumentation.py.
+
+CONVO_INSTRUMENTATION = {
+    'ENABLED': True,
+    'SLOW_EVENT_THRESHOLD': 1.0,
+}
+
+
+# User directory search behind /api/users, see main/search.py.
+
+CONVO_USER_SEARCH = {
+    'BACKEND': 'main.search.FTS5UserSearch',
+}
+
+
+# Message search behind /api/messages/search, see main/search.py.
+
+CONVO_MESSAGE_SEARCH = {
+    'BACKEND': 'main.search.FTS5MessageSearch',
+    'BATCH_SIZE': 10000,
+    'MAX_RANKED': 1000,
+}
+
+
+# Moving old messages out of the hot message table with archive_messages, see main/archive.py.
+
+CONVO_ARCHIVE = {
+    'AGE_DAYS': 90,
+    'BATCH_SIZE': 1000,
+}
+
+
+# Per-user conversation list cache behind /api/chats and the login response, see main/conversation_cache.py.
+
+CONVO_CONVERSATION_CACHE = {
+    'ENABLED': True,
+    'CACHE': 'conversations',
+}
@@ -1,10 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.models import Group
 
-from .models import User, Conversation, Message, Request
+from .models import User, Conversation, Message, ArchivedMessage, Request, Membership
 
 admin.site.register(User)
 admin.site.register(Message)
+admin.site.register(ArchivedMessage)
 admin.site.register(Conversation)
 admin.site.register(Request)
+admin.site.register(Membership)
 admin.site.unregister(Group)
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        # Connect the token and conversation cache invalidation receivers and the query recorder.
+        from . import authentication, conversation_cache, instrumentation  # noqa: F401
+        from .search import install_search_indexes
+
+        post_migrate.connect(install_search_indexes, sender=self)
@@ -0,0 +1,183 @@
+"""
+Hot and cold message tiers.
+
+``archive_messages`` moves the messages older than ``AGE_DAYS`` from the
+Message table to ArchivedMessage, ``BATCH_SIZE`` rows per transaction, so
+the hot table and its indexes only hold recent history. A conversation is
+archived oldest first and never past its last message, which the
+conversation list joins, or its oldest unread personal message, which read
+receipts still update. Its archived messages therefore always precede its
+hot ones.
+
+``MessageHistory`` reads pages of history across both tiers. A newest-first
+page of one conversation only reads the archive once the hot table runs out
+before the page is full, so recent history never touches it.
+MessagePagination and the chat consumers page through it, and message search
+covers both tiers.
+
+Configured with the ``CONVO_ARCHIVE`` setting::
+
+    CONVO_ARCHIVE = {
+        'AGE_DAYS': 90,
+        'BATCH_SIZE': 1000,
+    }
+"""
+import heapq
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import ArchivedMessage, Conversation, Message
+
+DEFAULT_ARCHIVE = {
+    'AGE_DAYS': 90,
+    'BATCH_SIZE': 1000,
+}
+
+
+def position(message):
+    return message.created_at, message.id
+
+
+class MessageArchiver:
+    def __init__(self, age_days=90, batch_size=1000, **kwargs):
+        self.age_days = age_days
+        self.batch_size = batch_size
+
+    def archive(self, now=None, progress=None):
+        """
+        Move the messages older than `age_days` to the archive and return how
+        many were moved, calling `progress(moved)` after each batch.
+        """
+        cutoff = (now or timezone.now()) - timedelta(days=self.age_days)
+        # A conversation created after the cutoff has nothing old enough.
+        conversations = Conversation.objects.filter(created_at__lt=cutoff).order_by('id').values_list(
+            'id', 'last_message__created_at', 'last_message_id'
+        )
+        moved, batch = 0, []
+        for conversation_id, *last_message in conversations.iterator():
+            boundary = self.get_boundary(conversation_id, cutoff, last_message)
+            messages = Message.objects.filter(conversation_id=conversation_id).before(*boundary)
+            # A batch holds the oldest messages of one or more conversations, so a
+            # conversation's archived messages always stay a prefix of its history.
+            while True:
+                wanted = self.batch_size - len(batch)
+                selected = list(messages.order_by('created_at', 'id').values_list('created_at', 'id')[:wanted])
+                batch.extend(selected)
+                if len(batch) == self.batch_size:
+                    moved += self.move(batch)
+                    batch = []
+                    if progress is not None:
+                        progress(moved)
+                if len(selected) < wanted:
+                    break
+                messages = messages.after(*selected[-1])
+        if batch:
+            moved += self.move(batch)
+            if progress is not None:
+                progress(moved)
+        return moved
+
+    def get_boundary(self, conversation_id, cutoff, last_message):
+        """
+        Return the (created_at, id) position a conversation is archived up to:
+        the cutoff, its last message or its oldest unread personal message,
+        whichever comes first.
+        """
+        positions = [(cutoff, 0)]
+        if last_message[1] is not None:
+            positions.append(tuple(last_message))
+        unread = Message.objects.filter(
+            conversation_id=conversation_id, created_at__lt=cutoff, recipient__isnull=False, read=False
+        ).order_by('created_at', 'id').values_list('created_at', 'id').first()
+        if unread is not None:
+            positions.append(unread)
+        return min(positions)
+
+    def move(self, positions):
+        """
+        Copy the messages at `positions` to the archive and delete them from the
+        message table in one transaction.
+        """
+        connection = connections[router.db_for_write(Message)]
+        message_table = connection.ops.quote_name(Message._meta.db_table)
+        archived_table = connection.ops.quote_name(ArchivedMessage._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in ArchivedMessage._meta.concrete_fields)
+        ids = [pk for _, pk in positions]
+        placeholders = ', '.join(['%s'] * len(ids))
+        # Plain SQL: the ORM would load every row to null Conversation.last_message, which is never archived.
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {archived_table} ({columns}) SELECT {columns} FROM {message_table} "
+                f"WHERE id IN ({placeholders})", ids
+            )
+            cursor.execute(f"DELETE FROM {message_table} WHERE id IN ({placeholders})", ids)
+        return len(ids)
+
+
+class MessageHistory:
+    """
+    The messages of some conversations across the hot and archived tiers.
+
+    `newest` and `before` return up to `limit` messages newest first, `after`
+    oldest first. Across several conversations the tiers interleave, so both
+    are always read.
+    """
+
+    def __init__(self, conversation_ids):
+        conversation_ids = list(conversation_ids)
+        self.messages = Message.objects.filter(conversation_id__in=conversation_ids)
+        self.archived = ArchivedMessage.objects.filter(conversation_id__in=conversation_ids)
+        self.interleaved = len(conversation_ids) > 1
+
+    def newest(self, limit):
+        return self.read(
+            self.messages.order_by('-created_at', '-id'), self.archived.order_by('-created_at', '-id'), limit,
+            reverse=True,
+        )
+
+    def before(self, created_at, pk, limit):
+        return self.read(
+            self.messages.before(created_at, pk), self.archived.before(created_at, pk), limit, reverse=True
+        )
+
+    def after(self, created_at, pk, limit):
+        # Oldest first, the archived messages come before the hot ones.
+        return self.read(
+            self.archived.after(created_at, pk), self.messages.after(created_at, pk), limit, reverse=False
+        )
+
+    def read(self, first, second, limit, reverse):
+        messages = list(first[:limit])
+        if len(messages) < limit or self.interleaved:
+            messages = list(islice(heapq.merge(messages, second[:limit], key=position, reverse=reverse), limit))
+        return messages
+
+    def position(self, message_id):
+        """
+        Return the (created_at, id) position of a message, or None if it is not in these conversations.
+        """
+        for messages in (self.messages, self.archived):
+            found = messages.filter(id=message_id).values_list('created_at', 'id').first()
+            if found is not None:
+                return found
+        return None
+
+
+def load_messages(ids):
+    """
+    Return the messages with the given ids keyed by id, hot or archived.
+    """
+    messages = Message.objects.in_bulk(ids)
+    missing = [pk for pk in ids if pk not in messages]
+    if missing:
+        messages.update(ArchivedMessage.objects.in_bulk(missing))
+    return messages
+
+
+def get_archiver():
+    config = {**DEFAULT_ARCHIVE, **getattr(settings, 'CONVO_ARCHIVE', {})}
+    return MessageArchiver(**{key.lower(): value for key, value in config.items()})
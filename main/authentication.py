@@ -0,0 +1,163 @@
+"""
+Cached token authentication for the websocket middleware and the REST API.
+
+Resolving a token costs a query on the authtoken table, and reconnect storms
+after a deploy resolve the same few thousand tokens over and over. Resolved
+tokens are kept in a bounded LRU cache for ``TTL`` seconds.
+
+Deleting a token or saving its user evicts the cached entry in the current
+process. Other processes keep their entry until it expires, so ``TTL`` is the
+longest a deleted token or a deactivated user stays accepted elsewhere.
+
+Configured with the ``CONVO_TOKEN_CACHE`` setting::
+
+    CONVO_TOKEN_CACHE = {
+        'MAX_SIZE': 10000,
+        'TTL': 60,
+    }
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework import authentication
+from rest_framework.authtoken.models import Token
+
+DEFAULT_TOKEN_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 60,
+}
+
+
+class TokenCache:
+    """
+    Thread-safe LRU map of token key to (user, token) with a per-entry expiry.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, **kwargs):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys_by_user = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return a copy of the cached (user, token) pair, or None.
+
+        The user is copied so a request changing its attributes can't leak
+        into other requests sharing the entry.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            user, token, _ = entry
+        return copy.copy(user), token
+
+    def set(self, key, user, token):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (user, token, time.monotonic() + self.ttl)
+            self.keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self.keys_by_user.get(entry[0].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_user[entry[0].pk]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in list(self.keys_by_user.get(user_id, ())):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_user.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_token_cache = None
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        config = {**DEFAULT_TOKEN_CACHE, **getattr(settings, 'CONVO_TOKEN_CACHE', {})}
+        _token_cache = TokenCache(**{key.lower(): value for key, value in config.items()})
+    return _token_cache
+
+
+def _reset_token_cache(setting, **kwargs):
+    global _token_cache
+    if setting == 'CONVO_TOKEN_CACHE':
+        _token_cache = None
+
+
+setting_changed.connect(_reset_token_cache)
+
+
+class CachedTokenAuthentication(authentication.TokenAuthentication):
+    """
+    Drop-in replacement for DRF's TokenAuthentication that resolves tokens through the token cache.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = get_token_cache().get(key)
+        if cached is not None:
+            return cached
+        return self.load_credentials(key)
+
+    def load_credentials(self, key):
+        """
+        Resolve the token from the database and cache the result.
+        """
+        user, token = super().authenticate_credentials(key)
+        get_token_cache().set(key, user, token)
+        return copy.copy(user), token
+
+
+@receiver(post_delete, sender=Token)
+def evict_deleted_token(sender, instance, **kwargs):
+    get_token_cache().invalidate(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def evict_saved_user(sender, instance, created=False, **kwargs):
+    # Any save may deactivate the user or change what the cached copy shows.
+    if not created:
+        get_token_cache().invalidate_user(instance.pk)
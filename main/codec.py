@@ -0,0 +1,24 @@
+"""
+JSON codec used for socket frames.
+
+Uses orjson when it is installed and falls back to the standard library.
+Both produce the same documents; orjson just omits the optional whitespace.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(content):
+        return orjson.dumps(content).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(content):
+        return json.dumps(content, separators=(',', ':'))
+
+    loads = json.loads
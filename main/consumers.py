@@ -1,36 +1,204 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+
+from . import codec, wire
+from .archive import MessageHistory
+from .fanout import group_send_many
+from .instrumentation import instrument
+from .models import User, Conversation, Message, Membership
+from .outbound import DEFAULT_OUTBOUND_QUEUE, RESUME_REQUIRED_CLOSE_CODE, OutboundQueue
+from .pagination import decode_cursor, encode_cursor
+from .presence import get_presence
+from .serializers import MessageSerializer, load_message_users
+from .writebehind import get_writer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TYPING = {
+    'TIMEOUT': 5.0,
+    'DEBOUNCE': 1.0,
+}
+
+
+class EventConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Base for the socket consumers.
+
+    Group events are encoded once by the sender: `group_send` stores the finished
+    frame in the event's "text" key and the receiving handlers forward it as is
+    with `send_event`, so a broadcast costs one encode however many sockets get it.
+
+    Frames are written by the socket's outbound queue, which bounds what a slow
+    client can pile up in the worker; see main/outbound.py. Clients may negotiate
+    MessagePack frames with interned users, see main/wire.py; group events then
+    carry a packed version next to the JSON one, also encoded once by the sender.
+    """
+
+    # Frame types clients send; anything else is instrumented as "other".
+    client_events = frozenset()
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return codec.loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return codec.dumps(content)
 
-from .models import User, Conversation, Message
-from .serializers import MessageSerializer
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.background_tasks = set()
+        self.packed = False
+        self.known_users = set()
+        config = {**DEFAULT_OUTBOUND_QUEUE, **getattr(settings, 'CONVO_OUTBOUND_QUEUE', {})}
+        self.outbox = OutboundQueue(
+            self.write_frame, self.close_behind, self.close, **{key.lower(): value for key, value in config.items()}
+        )
 
+    def layer_message(self, event):
+        """
+        Return the channel layer message of `event`: the encoded frame plus the
+        fields the receivers' outbound queues need to merge and track it.
+        """
+        message = {"type": event["type"], "text": codec.dumps(event)}
+        if "user" in event:
+            message["user"] = event["user"]
+        if isinstance(event.get("message"), dict) and "id" in event["message"]:
+            message["message_id"] = event["message"]["id"]
+        if wire.msgpack is not None:
+            interned, users = wire.intern_users(event)
+            message["packed"] = wire.pack(interned)
+            if users:
+                message["users"] = users
+        return message
 
-class NotificationConsumer(JsonWebsocketConsumer):
+    async def group_send(self, group, event):
+        await self.channel_layer.group_send(group, self.layer_message(event))
+
+    async def group_send_many(self, groups, event):
+        await group_send_many(self.channel_layer, groups, self.layer_message(event))
+
+    def run_in_background(self, coroutine):
+        """
+        Run `coroutine` without making the current handler wait for it.
+        """
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_task_done)
+        return task
+
+    def background_task_done(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background task failed", exc_info=task.exception())
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            subprotocol = wire.select_subprotocol(self.scope.get("subprotocols", []))
+        self.packed = subprotocol == wire.MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    async def websocket_connect(self, message):
+        with instrument(f"{type(self).__name__}.connect"):
+            await super().websocket_connect(message)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if self.packed and bytes_data is not None:
+            content = wire.unpack(bytes_data)
+        elif text_data:
+            content = await self.decode_json(text_data)
+        else:
+            raise ValueError("No text section for incoming WebSocket frame!")
+        event_type = content.get("type") if isinstance(content, dict) else None
+        if event_type not in self.client_events:
+            event_type = "other"
+        with instrument(f"{type(self).__name__}.{event_type}"):
+            await self.receive_json(content, **kwargs)
+
+    def pack(self, content):
+        interned, users = wire.intern_users(content)
+        self.define_users(users)
+        return wire.pack(interned)
+
+    def define_users(self, users):
+        """
+        Queue a "users" frame describing the users this socket hasn't seen yet.
+        """
+        unseen = [user for username, user in users.items() if username not in self.known_users]
+        if unseen:
+            self.known_users.update(user["username"] for user in unseen)
+            self.outbox.put("users", wire.pack({"type": "users", "users": unseen}))
+
+    async def encode(self, content):
+        if self.packed:
+            return self.pack(content)
+        return await self.encode_json(content)
+
+    async def send_json(self, content, message_id=None):
+        """
+        Queue a frame. `message_id` is the newest chat message it carries, if any.
+        """
+        self.outbox.put(content["type"], await self.encode(content), user=content.get("user"), message_id=message_id)
+
+    async def send_event(self, event):
+        if self.packed and "packed" in event:
+            self.define_users(event.get("users", {}))
+            payload = event["packed"]
+        elif "text" in event:
+            payload = self.pack(codec.loads(event["text"])) if self.packed else event["text"]
+        else:
+            payload = await self.encode(event)
+        self.outbox.put(event["type"], payload, user=event.get("user"), message_id=event.get("message_id"))
+
+    async def write_frame(self, payload):
+        if isinstance(payload, bytes):
+            await self.send(bytes_data=payload)
+        else:
+            await self.send(text_data=payload)
+
+    async def close_behind(self, last_message_id):
+        await self.write_frame(await self.encode({
+            "type": "resume_required",
+            "last_message_id": last_message_id,
+        }))
+        await self.close(code=RESUME_REQUIRED_CLOSE_CODE)
+
+    async def websocket_disconnect(self, message):
+        self.outbox.stop()
+        with instrument(f"{type(self).__name__}.disconnect"):
+            await super().websocket_disconnect(message)
+
+
+class NotificationConsumer(EventConsumer):
     def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
+        super().__init__(*args, **kwargs)
         self.notification_group_name = None
         self.user = None
 
-    def connect(self):
+    @database_sync_to_async
+    def get_unread_counts(self):
+        return Conversation.objects.unread_counts(self.user)
+
+    async def connect(self):
         self.user = self.scope["user"]
         if not self.user.is_authenticated:
             return
 
-        self.accept()
+        await self.accept()
 
         self.notification_group_name = self.user.username + "__notifications"
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.notification_group_name,
             self.channel_name,
         )
 
-        unread_count = Message.objects.filter(recipient=self.user, read=False).count()
-        conversations = Conversation.objects.filter(users__in=[self.user]).order_by("-created_at")
-        conversations_unread_counts = [
-            {"id": conversation.id, "count": conversation.get_unread_messages_count(self.user)}
-            for conversation in conversations
-        ]
-        self.send_json(
+        unread_count, conversations_unread_counts = await self.get_unread_counts()
+        await self.send_json(
             {
                 "type": "unread_count",
                 "unread_count": unread_count,
@@ -38,225 +206,295 @@ class NotificationConsumer(JsonWebsocketConsumer):
             }
         )
 
-        self.send_json(
-            {
-                "type": "unread_count",
-                "unread_count": unread_count,
-                "conversations_unread_counts": conversations_unread_counts
-            }
-        )
-
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.notification_group_name,
-            self.channel_name,
-        )
-        return super().disconnect(code)
-
-    def unread_count(self, event):
-        self.send_json(event)
-
-    def new_message_notification(self, event):
-        self.send_json(event)
-
+    async def disconnect(self, code):
+        if self.notification_group_name:
+            await self.channel_layer.group_discard(
+                self.notification_group_name,
+                self.channel_name,
+            )
 
-class PersonalChatConsumer(JsonWebsocketConsumer):
+    async def unread_count(self, event):
+        await self.send_event(event)
+
+    async def new_message_notification(self, event):
+        await self.send_event(event)
+
+
+class TypingIndicator:
+    """
+    Typing state of one user in one conversation, reduced to its transitions.
+
+    Clients send a "typing" frame per keystroke. Only the first one is broadcast;
+    the others just push back the automatic stop, which is broadcast after
+    ``TIMEOUT`` seconds without keystrokes. A stop frame is held back for
+    ``DEBOUNCE`` seconds, so a client flapping between typing and not typing
+    causes no broadcasts at all.
+
+    The sockets a user has open in a conversation `attach` to the same
+    indicator, so their frames make up one state and one set of broadcasts,
+    sent through any of them. This holds per worker: sockets of the same user
+    on different workers keep separate states.
+
+    Configured with the ``CONVO_TYPING`` setting::
+
+        CONVO_TYPING = {
+            'TIMEOUT': 5.0,
+            'DEBOUNCE': 1.0,
+        }
+    """
+
+    # {(conversation id, username): indicator} of the sockets on this worker.
+    attached = {}
+
+    def __init__(self, consumer, timeout=5.0, debounce=1.0, **kwargs):
+        self.consumer = consumer
+        self.consumers = {consumer}
+        self.timeout = timeout
+        self.debounce = debounce
+        self.typing = False
+        self.timer = None
+        self.key = None
+
+    @classmethod
+    def attach(cls, key, consumer, **config):
+        """
+        Return the indicator of `key`, a (conversation id, username) pair, shared by its sockets.
+        """
+        indicator = cls.attached.get(key)
+        if indicator is None:
+            indicator = cls.attached[key] = cls(consumer, **config)
+            indicator.key = key
+        indicator.consumers.add(consumer)
+        return indicator
+
+    async def detach(self, consumer):
+        """
+        Drop a closed socket; typing ends with the user's last socket.
+        """
+        self.consumers.discard(consumer)
+        if self.consumers:
+            if self.consumer is consumer:
+                self.consumer = next(iter(self.consumers))
+            return
+        if self.attached.get(self.key) is self:
+            del self.attached[self.key]
+        await self.stop()
+
+    async def update(self, typing):
+        if typing:
+            self.schedule_stop(self.timeout)
+            if not self.typing:
+                self.typing = True
+                await self.consumer.broadcast_typing(True)
+        elif self.typing:
+            self.schedule_stop(self.debounce)
+
+    def schedule_stop(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(delay, self.expire)
+
+    def expire(self):
+        self.timer = None
+        if self.typing:
+            self.typing = False
+            self.consumer.run_in_background(self.consumer.broadcast_typing(False))
+
+    async def stop(self):
+        """
+        End typing right away, e.g. when the message was sent or the socket closed.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.typing:
+            self.typing = False
+            await self.consumer.broadcast_typing(False)
+
+
+class ChatConsumer(EventConsumer):
+    """
+    Behaviour shared by the personal and room chat consumers.
+
+    Subclasses resolve the conversation in `get_conversation` and decide who is
+    notified about new messages. Every ORM call is made from one of the
+    `database_sync_to_async` methods below so a frame costs at most one thread hop.
+    Presence lives in the configured presence backend, never in the database.
+
+    History is paged with keyset cursors and reads through to archived messages,
+    see main/archive.py. On connect the client gets the newest page as
+    "last_50_messages" and can walk back with "load_more" frames. A client
+    that reconnects with `?resume=<last seen message id>` only gets the messages
+    after that id, oldest first, as "resume_messages"; while `has_more` is true it
+    sends a "resume" frame with the id of the last message it received. A client
+    that falls too far behind gets a "resume_required" frame with that id before
+    the socket is closed.
+    """
+    history_page_size = 50
+    client_events = frozenset({"chat_message", "typing", "load_more", "resume", "read_messages"})
 
     def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
-        self.room_name = None
+        super().__init__(*args, **kwargs)
         self.conversation = None
         self.conversation_name = None
-        self.user_conversations = None
         self.user = None
-        self.user2 = None
-
-    def connect(self):
-        self.user = self.scope['user']
-        if not self.user.is_authenticated:
-            return
-
-        user2_username = self.scope['url_route']['kwargs']['username']
-        self.user2 = User.objects.get(username=user2_username)
-        self.accept()
+        self.presence = get_presence()
+        self.heartbeat_task = None
+        self.typing_indicator = None
+
+    def get_conversation(self):
+        raise NotImplementedError
+
+    def get_recipient(self):
+        raise NotImplementedError
+
+    def get_notification_recipients(self):
+        raise NotImplementedError
+
+    def get_page(self, messages):
+        return messages[:self.history_page_size], len(messages) > self.history_page_size
+
+    def get_history(self, before=None):
+        history = MessageHistory([self.conversation.id])
+        if before is not None:
+            messages = history.before(*before, self.history_page_size + 1)
+        else:
+            messages = history.newest(self.history_page_size + 1)
+        messages, has_more = self.get_page(messages)
+        return {
+            "messages": MessageSerializer(messages, many=True).data,
+            "has_more": has_more,
+            "cursor": encode_cursor(messages[-1]) if messages else None,
+        }
+
+    def get_missed_messages(self, last_message_id):
+        """
+        Return the messages after `last_message_id`, or None if that message is unknown.
+        """
+        history = MessageHistory([self.conversation.id])
+        position = history.position(last_message_id)
+        if position is None:
+            return None
+        messages, has_more = self.get_page(history.after(*position, self.history_page_size + 1))
+        return {
+            "messages": MessageSerializer(messages, many=True).data,
+            "has_more": has_more,
+        }
 
-        self.conversation = Conversation.objects.get_or_create_personal_conversation(self.user, self.user2)
+    @database_sync_to_async
+    def join_conversation(self, resume_from=None):
+        self.conversation = self.get_conversation()
         self.conversation_name = self.conversation.name
-        self.user_conversations = Conversation.objects.filter(users__in=[self.user]).order_by("-created_at")
 
-        async_to_sync(self.channel_layer.group_add)(
-            self.conversation_name,
-            self.channel_name
-        )
-
-        self.send_json(
-            {
-                "type": "online_user_list",
-                "users": list(self.conversation.online.all().values_list('username', flat=True)),
-            }
-        )
-        async_to_sync(self.channel_layer.group_send)(
-            self.conversation_name,
+        if resume_from is not None:
+            missed = self.get_missed_messages(resume_from)
+            if missed is not None:
+                return {"type": "resume_messages", **missed}
+        return {"type": "last_50_messages", **self.get_history()}
+
+    @database_sync_to_async
+    def load_more(self, before):
+        return self.get_history(before)
+
+    @database_sync_to_async
+    def resume(self, last_message_id):
+        return self.get_missed_messages(last_message_id)
+
+    def get_resume_from(self):
+        query_params = parse_qs(self.scope["query_string"].decode())
+        try:
+            return int(query_params["resume"][0])
+        except (KeyError, ValueError):
+            return None
+
+    @database_sync_to_async
+    def save_message(self, content):
+        message = Message.objects.store(self.conversation, self.user, content, recipient=self.get_recipient())
+        load_message_users([message])
+        return MessageSerializer(message).data
+
+    @database_sync_to_async
+    def serialize_message(self, message):
+        load_message_users([message])
+        return MessageSerializer(message).data
+
+    async def store_message(self, content):
+        """
+        Persist a message and return its serialized form. With write-behind
+        enabled the message is only queued for the next batch.
+        """
+        writer = get_writer()
+        if writer is None:
+            return await self.save_message(content)
+        message = writer.prepare(Message(
+            conversation=self.conversation,
+            sender=self.user,
+            recipient=self.get_recipient(),
+            content=content
+        ))
+        data = await self.serialize_message(message)
+        await writer.submit(message)
+        return data
+
+    async def notify_recipients(self):
+        recipients = await database_sync_to_async(self.get_notification_recipients)()
+        await self.group_send_many(
+            [username + "__notifications" for username in recipients],
             {
-                "type": "user_join",
-                "user": self.user.username,
+                "type": "new_message_notification",
+                "name": self.user.username,
+                "id": self.conversation.id
             },
         )
 
-        self.conversation.online.add(self.user)
-
-        self.send_json({
-            "type": "welcome_message",
-            "message": "Hey there! You've successfully connected!",
-        })
+    @database_sync_to_async
+    def read_messages(self):
+        Membership.objects.mark_read(self.user, self.conversation)
+        return Conversation.objects.unread_counts(self.user)
 
-        messages = self.conversation.messages.all().order_by("-created_at")[:50]
-        message_count = self.conversation.messages.all().count()
-        self.send_json({
-            "type": "last_50_messages",
-            "messages": MessageSerializer(messages, many=True).data,
-            "has_more": message_count > 50
-        })
-
-    def disconnect(self, close_code):
-        if self.user.is_authenticated:
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    "type": "user_leave",
-                    "user": self.user.username,
-                },
-            )
-            self.conversation.online.remove(self.user)
-        return super().disconnect(close_code)
+    async def update_typing(self, typing):
+        await self.typing_indicator.update(typing)
 
-    def receive_json(self, content, **kwargs):
-        message_type = content['type']
-        if message_type == "chat_message":
-            message = self.store_message(content['message'])
-
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    'type': 'chat_message',
-                    'message': MessageSerializer(message).data,
-                    'conversation_id': self.conversation.id
-
-                })
-
-            notification_group_name = self.user2.username + "__notifications"
-            async_to_sync(self.channel_layer.group_send)(
-                notification_group_name,
-                {
-                    "type": "new_message_notification",
-                    "name": self.user.username,
-                    "id": self.conversation.id
-                },
-            )
-
-        if message_type == "typing":
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    "type": "typing",
-                    "user": self.user.username,
-                    "typing": content["typing"],
-                },
-            )
-
-        if message_type == "read_messages":
-            messages_to_me = self.conversation.messages.filter(recipient=self.user)
-            messages_to_me.update(read=True, status="seen")
-
-            # Update the unread message count
-            unread_count = Message.objects.filter(recipient=self.user, read=False).count()
-            conversations_unread_counts = [
-                {"id": conversation.id, "count": conversation.get_unread_messages_count(self.user)}
-                for conversation in self.user_conversations
-            ]
-            async_to_sync(self.channel_layer.group_send)(
-                self.user.username + "__notifications",
-                {
-                    "type": "unread_count",
-                    "unread_count": unread_count,
-                    "conversations_unread_counts": conversations_unread_counts
-
-                },
-            )
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    'type': 'seen_message',
-                    'user': self.user.username
-                })
-
-        return super().receive_json(content, **kwargs)
-
-    def user_join(self, event):
-        self.send_json(event)
-
-    def user_leave(self, event):
-        self.send_json(event)
-
-    def new_message_notification(self, event):
-        self.send_json(event)
-
-    def chat_message(self, event):
-        self.send_json(event)
-
-    def seen_message(self, event):
-        self.send_json(event)
-
-    def typing(self, event):
-        self.send_json(event)
-
-    def unread_count(self, event):
-        self.send_json(event)
-
-    def store_message(self, message):
-        message = Message.objects.create(
-            conversation=self.conversation,
-            sender=self.user,
-            recipient=self.user2,
-            content=message
+    async def broadcast_typing(self, typing):
+        await self.group_send(
+            self.conversation_name,
+            {
+                "type": "typing",
+                "user": self.user.username,
+                "typing": typing,
+            },
         )
-        return message
 
+    async def send_history(self, history):
+        """
+        Send a history frame. Its newest message is where a client that falls behind resumes.
+        """
+        await self.send_json(history, message_id=max((m["id"] for m in history["messages"]), default=None))
 
-class RoomChatConsumer(JsonWebsocketConsumer):
-    def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
-        self.room_group_name = None
-        self.room_name = None
-        self.conversation = None
-        self.conversation_name = None
-        self.user_conversations = None
-        self.user = None
-
-    def connect(self):
+    async def connect(self):
         self.user = self.scope['user']
         if not self.user.is_authenticated:
             return
 
-        self.accept()
-
-        self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.conversation = Conversation.objects.get_or_create_group_conversation(self.user, self.room_name, "", "", None, None)
-        self.conversation_name = self.conversation.name
-        self.user_conversations = Conversation.objects.filter(users__in=[self.user]).order_by("-created_at")
+        history = await self.join_conversation(self.get_resume_from())
+        config = {**DEFAULT_TYPING, **getattr(settings, 'CONVO_TYPING', {})}
+        self.typing_indicator = TypingIndicator.attach(
+            (self.conversation.id, self.user.username), self, **{key.lower(): value for key, value in config.items()}
+        )
+        await self.accept()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.conversation_name,
             self.channel_name
         )
 
-        self.send_json(
+        await self.send_json(
             {
                 "type": "online_user_list",
-                "users": list(self.conversation.online.all().values_list('username', flat=True)),
+                "users": await self.presence.online(self.conversation.id),
             }
         )
-        async_to_sync(self.channel_layer.group_send)(
+        await self.group_send(
             self.conversation_name,
             {
                 "type": "user_join",
@@ -264,79 +502,95 @@ class RoomChatConsumer(JsonWebsocketConsumer):
             },
         )
 
-        self.conversation.online.add(self.user)
+        await self.presence.join(self.conversation.id, self.user.username, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
 
-        self.send_json({
+        await self.send_json({
             "type": "welcome_message",
             "message": "Hey there! You've successfully connected!",
         })
 
-        messages = self.conversation.messages.all().order_by("-created_at")[:50]
-        message_count = self.conversation.messages.all().count()
-        self.send_json({
-            "type": "last_50_messages",
-            "messages": MessageSerializer(messages, many=True).data,
-            "has_more": message_count > 50
-        })
-
-    def disconnect(self, close_code):
-        if self.user.is_authenticated:
-            async_to_sync(self.channel_layer.group_send)(
+        await self.send_history(history)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.presence.heartbeat_interval)
+            try:
+                await self.presence.heartbeat(self.conversation.id, self.user.username, self.channel_name)
+            except Exception:
+                # The entry may expire until the backend is back, but the socket stays up.
+                logger.exception("Presence heartbeat of %s failed", self.user.username)
+
+    async def drain_writer(self):
+        writer = get_writer()
+        if writer is not None:
+            await writer.drain()
+
+    async def disconnect(self, close_code):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        # Don't leave this socket's acknowledged messages waiting for the next flush.
+        await self.drain_writer()
+        if self.typing_indicator is not None:
+            await self.typing_indicator.detach(self)
+        if self.user.is_authenticated and self.conversation_name:
+            await self.channel_layer.group_discard(
+                self.conversation_name,
+                self.channel_name
+            )
+            await self.group_send(
                 self.conversation_name,
                 {
                     "type": "user_leave",
                     "user": self.user.username,
                 },
             )
-            self.conversation.online.remove(self.user)
-        return super().disconnect(close_code)
+            await self.presence.leave(self.conversation.id, self.user.username, self.channel_name)
 
-    def receive_json(self, content, **kwargs):
+    async def receive_json(self, content, **kwargs):
         message_type = content['type']
         if message_type == "chat_message":
-            message = self.store_message(content['message'])
+            message = await self.store_message(content['message'])
+            await self.typing_indicator.stop()
 
-            async_to_sync(self.channel_layer.group_send)(
+            await self.group_send(
                 self.conversation_name,
                 {
                     'type': 'chat_message',
-                    'message': MessageSerializer(message).data,
+                    'message': message,
                     'conversation_id': self.conversation.id
 
                 })
 
-            for user in self.conversation.users.all():
-                notification_group_name = user.username + "__notifications"
-                async_to_sync(self.channel_layer.group_send)(
-                    notification_group_name,
-                    {
-                        "type": "new_message_notification",
-                        "name": self.user.username,
-                        "id": self.conversation.id
-                    },
-                )
+            # Member notifications fan out off the sender's critical path.
+            self.run_in_background(self.notify_recipients())
 
         if message_type == "typing":
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    "type": "typing",
-                    "user": self.user.username,
-                    "typing": content["typing"],
-                },
-            )
+            await self.update_typing(bool(content["typing"]))
+
+        if message_type == "load_more":
+            try:
+                before = decode_cursor(content["cursor"])
+            except (KeyError, TypeError, ValueError):
+                await self.send_json({"type": "error", "message": "Invalid cursor."})
+            else:
+                await self.send_json({"type": "more_messages", **await self.load_more(before)})
+
+        if message_type == "resume":
+            try:
+                missed = await self.resume(int(content["last_message_id"]))
+            except (KeyError, TypeError, ValueError):
+                missed = None
+            if missed is None:
+                await self.send_history({"type": "last_50_messages", **await self.load_more(None)})
+            else:
+                await self.send_history({"type": "resume_messages", **missed})
 
         if message_type == "read_messages":
-            messages_to_me = self.conversation.messages.filter(recipient=self.user)
-            messages_to_me.update(read=True, status="seen")
-
-            # Update the unread message count
-            unread_count = Message.objects.filter(recipient=self.user, read=False).count()
-            conversations_unread_counts = [
-                {"id": conversation.id, "count": conversation.get_unread_messages_count(self.user)}
-                for conversation in self.user_conversations
-            ]
-            async_to_sync(self.channel_layer.group_send)(
+            # Messages still waiting for write-behind would be counted unread after the receipt.
+            await self.drain_writer()
+            unread_count, conversations_unread_counts = await self.read_messages()
+            await self.group_send(
                 self.user.username + "__notifications",
                 {
                     "type": "unread_count",
@@ -345,40 +599,64 @@ class RoomChatConsumer(JsonWebsocketConsumer):
 
                 },
             )
-            async_to_sync(self.channel_layer.group_send)(
+            await self.group_send(
                 self.conversation_name,
                 {
                     'type': 'seen_message',
                     'user': self.user.username
                 })
 
-        return super().receive_json(content, **kwargs)
+    async def user_join(self, event):
+        await self.send_event(event)
 
-    def user_join(self, event):
-        self.send_json(event)
+    async def user_leave(self, event):
+        await self.send_event(event)
 
-    def user_leave(self, event):
-        self.send_json(event)
+    async def new_message_notification(self, event):
+        await self.send_event(event)
 
-    def new_message_notification(self, event):
-        self.send_json(event)
+    async def chat_message(self, event):
+        await self.send_event(event)
 
-    def chat_message(self, event):
-        self.send_json(event)
+    async def seen_message(self, event):
+        await self.send_event(event)
 
-    def seen_message(self, event):
-        self.send_json(event)
+    async def typing(self, event):
+        await self.send_event(event)
 
-    def typing(self, event):
-        self.send_json(event)
+    async def unread_count(self, event):
+        await self.send_event(event)
 
-    def unread_count(self, event):
-        self.send_json(event)
 
-    def store_message(self, message):
-        message = Message.objects.create(
-            conversation=self.conversation,
-            sender=self.user,
-            content=message
-        )
-        return message
+class PersonalChatConsumer(ChatConsumer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user2 = None
+
+    def get_conversation(self):
+        user2_username = self.scope['url_route']['kwargs']['username']
+        self.user2 = User.objects.get(username=user2_username)
+        return Conversation.objects.get_or_create_personal_conversation(self.user, self.user2)
+
+    def get_recipient(self):
+        return self.user2
+
+    def get_notification_recipients(self):
+        return [self.user2.username]
+
+
+class RoomChatConsumer(ChatConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_name = None
+
+    def get_conversation(self):
+        self.room_name = self.scope['url_route']['kwargs']['room_name']
+        return Conversation.objects.get_or_create_group_conversation(self.user, self.room_name, "", "", None, None)
+
+    def get_recipient(self):
+        return None
+
+    def get_notification_recipients(self):
+        return list(self.conversation.users.values_list('username', flat=True))
@@ -0,0 +1,345 @@
+"""
+Per-user cache of the serialized conversation list.
+
+``ConversationView`` serves the list from the cache and the login response
+takes the last conversation from it when it is cached. Entries live in the
+Django cache named by ``CACHE``, so the backend, size limit and eviction
+(``MAX_ENTRIES``) and expiry (``TIMEOUT``) are set in ``CACHES``; the
+locmem, file and Redis backends all work.
+
+Every user has a generation token and their list is stored under it.
+Invalidating a user replaces the token, which orphans the stored list until
+it expires. Invalidation happens after the writing transaction commits, so a
+list built from data read before the commit is stored under the old token
+and never served. Only the affected users are invalidated:
+
+* the members of a conversation when messages are stored in it, when read
+  receipts mark messages read, and when it is saved or deleted;
+* the old and new members when its users change;
+* the conversation partners of a user whose profile or friends change.
+
+Read receipts in group conversations change nothing in the list, since group
+messages have no recipient to mark them seen, and invalidate nobody.
+
+Stored messages and read receipts don't invalidate on the sender's thread. The
+conversations are queued and a background thread invalidates their members
+``INVALIDATION_DELAY`` seconds later, together with everything queued in the
+meantime, so a busy room is invalidated once per delay however many messages
+it gets. Lists may be served stale for that long. A delay of None invalidates
+right after the commit instead. Failed rounds are retried with exponential
+backoff, up to ``MAX_RETRY_DELAY`` seconds apart. The thread has its own
+database connection; it is stopped, and what is still queued invalidated, when
+the settings change and when the process exits.
+
+Hits and misses are counted in ``convo_conversation_cache_lookups_total``,
+served at /api/metrics.
+
+Configured with the ``CONVO_CONVERSATION_CACHE`` setting::
+
+    CONVO_CONVERSATION_CACHE = {
+        'ENABLED': True,
+        'CACHE': 'conversations',
+        'INVALIDATION_DELAY': 0.05,
+    }
+"""
+import atexit
+import logging
+import threading
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connections, transaction
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+
+from .metrics import Counter
+from .models import Conversation, Membership, User, messages_read, messages_stored
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONVERSATION_CACHE = {
+    'ENABLED': True,
+    'CACHE': 'conversations',
+    'INVALIDATION_DELAY': 0.05,
+}
+
+# UserSerializer fields, shown as the other user of a conversation.
+PROFILE_FIELDS = frozenset({'username', 'first_name', 'last_name', 'email', 'display_photo'})
+
+# Longest wait between retries of a failing background invalidation, in seconds.
+MAX_RETRY_DELAY = 30
+
+lookups = Counter('convo_conversation_cache_lookups_total', 'Conversation list cache lookups.')
+invalidations = Counter('convo_conversation_cache_invalidations_total', 'Conversation lists invalidated.')
+
+
+class ConversationListCache:
+    def __init__(self, enabled=True, cache='conversations', invalidation_delay=0.05, **kwargs):
+        self.enabled = enabled
+        self.alias = cache
+        self.invalidation_delay = invalidation_delay
+        # Conversations and users queued for the background invalidation.
+        self.queued_conversations = set()
+        self.queued_users = set()
+        self.queue_changed = threading.Condition()
+        self.worker = None
+        self.stopping = False
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation_key(self, user_id):
+        return f'conversations:{user_id}'
+
+    def list_key(self, user_id, generation, base_url):
+        # Image fields are serialized as absolute URLs of the request's host.
+        return f'conversations:{user_id}:{generation}:{base_url}'
+
+    def get_generation(self, user_id):
+        key = self.generation_key(user_id)
+        generation = self.cache.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            if not self.cache.add(key, generation):
+                generation = self.cache.get(key, generation)
+        return generation
+
+    def get(self, user, base_url):
+        """
+        Return the cached list of `user`, or None.
+        """
+        if not self.enabled:
+            return None
+        data = self.cache.get(self.list_key(user.pk, self.get_generation(user.pk), base_url))
+        lookups.inc(result='miss' if data is None else 'hit')
+        return data
+
+    def get_or_build(self, user, base_url, build):
+        """
+        Return the cached list of `user`, calling `build()` and caching its result on a miss.
+        """
+        if not self.enabled:
+            return build()
+        key = self.list_key(user.pk, self.get_generation(user.pk), base_url)
+        data = self.cache.get(key)
+        if data is not None:
+            lookups.inc(result='hit')
+            return data
+        lookups.inc(result='miss')
+        data = list(build())
+        self.cache.set(key, data)
+        return data
+
+    def invalidate(self, user_ids):
+        user_ids = set(user_ids)
+        if not self.enabled or not user_ids:
+            return
+        generation = uuid.uuid4().hex
+        self.cache.set_many({self.generation_key(user_id): generation for user_id in user_ids})
+        invalidations.inc(len(user_ids))
+
+    def invalidate_conversations(self, conversation_ids, user_ids=()):
+        """
+        Invalidate the members of the conversations and `user_ids`.
+        """
+        members = Membership.objects.filter(conversation_id__in=conversation_ids).values_list('user_id', flat=True)
+        self.invalidate({*members, *user_ids})
+
+    def invalidate_partners(self, user_ids):
+        """
+        Invalidate the users sharing a conversation with `user_ids`.
+        """
+        conversations = Membership.objects.filter(user_id__in=user_ids).values_list('conversation_id', flat=True)
+        self.invalidate_conversations(conversations)
+
+    def invalidate_later(self, conversation_ids, user_ids=()):
+        """
+        Queue the members of the conversations and `user_ids` for the background invalidation.
+        """
+        if self.invalidation_delay is None or self.stopping:
+            self.invalidate_conversations(conversation_ids, user_ids)
+            return
+        with self.queue_changed:
+            self.queued_conversations.update(conversation_ids)
+            self.queued_users.update(user_ids)
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='conversation-cache', daemon=True)
+                self.worker.start()
+            self.queue_changed.notify()
+
+    def run(self):
+        failures = 0
+        try:
+            while True:
+                with self.queue_changed:
+                    self.queue_changed.wait_for(
+                        lambda: self.stopping or self.queued_conversations or self.queued_users
+                    )
+                    # Let the invalidations of the next few commits join this one, and back off after failures.
+                    delay = min(self.invalidation_delay * 2 ** failures, MAX_RETRY_DELAY)
+                    self.queue_changed.wait_for(lambda: self.stopping, timeout=delay)
+                    if self.stopping:
+                        return
+                try:
+                    self.flush()
+                except Exception:
+                    if not failures:
+                        logger.exception("Conversation list invalidation failed, retrying with backoff")
+                    failures += 1
+                else:
+                    if failures:
+                        logger.warning("Conversation list invalidation recovered after %d failed attempts", failures)
+                    failures = 0
+                finally:
+                    close_old_connections()
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        """
+        Stop the background thread and invalidate what is still queued on the calling thread.
+        """
+        with self.queue_changed:
+            self.stopping = True
+            self.queue_changed.notify()
+        if self.worker is not None:
+            self.worker.join()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Conversation list invalidation failed while stopping")
+
+    def flush(self):
+        """
+        Invalidate everything queued now, on the calling thread.
+        """
+        with self.queue_changed:
+            conversation_ids, self.queued_conversations = self.queued_conversations, set()
+            user_ids, self.queued_users = self.queued_users, set()
+        if not conversation_ids and not user_ids:
+            return
+        try:
+            self.invalidate_conversations(conversation_ids, user_ids)
+        except Exception:
+            # Keep them queued for the next round.
+            with self.queue_changed:
+                self.queued_conversations.update(conversation_ids)
+                self.queued_users.update(user_ids)
+            raise
+
+    def on_commit(self, method, *args):
+        """
+        Run an invalidation once the current transaction commits, or right away outside one.
+        """
+        if self.enabled:
+            transaction.on_commit(partial(method, *args))
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        hits, misses = lookups.get(result='hit'), lookups.get(result='miss')
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'invalidations': invalidations.get(),
+        }
+
+
+_conversation_cache = None
+
+
+def get_conversation_cache():
+    global _conversation_cache
+    if _conversation_cache is None:
+        config = {**DEFAULT_CONVERSATION_CACHE, **getattr(settings, 'CONVO_CONVERSATION_CACHE', {})}
+        _conversation_cache = ConversationListCache(**{key.lower(): value for key, value in config.items()})
+    return _conversation_cache
+
+
+def _reset_conversation_cache(setting, **kwargs):
+    global _conversation_cache
+    if setting == 'CONVO_CONVERSATION_CACHE':
+        if _conversation_cache is not None:
+            _conversation_cache.stop()
+        _conversation_cache = None
+
+
+def _stop_invalidation_at_exit():
+    if _conversation_cache is not None:
+        _conversation_cache.stop()
+
+
+setting_changed.connect(_reset_conversation_cache)
+atexit.register(_stop_invalidation_at_exit)
+
+
+@receiver(messages_stored)
+def invalidate_stored(sender, messages, **kwargs):
+    cache = get_conversation_cache()
+    cache.on_commit(cache.invalidate_later, {message.conversation_id for message in messages})
+
+
+@receiver(messages_read)
+def invalidate_read(sender, conversation, user, **kwargs):
+    # The last message may now be shown as seen, to every member. Group messages have no
+    # recipient and stay as they are.
+    if conversation.type == 'group':
+        return
+    cache = get_conversation_cache()
+    cache.on_commit(cache.invalidate_later, [conversation.pk])
+
+
+@receiver(post_save, sender=Conversation)
+def invalidate_saved_conversation(sender, instance, created=False, **kwargs):
+    # A new conversation has no members yet; adding them invalidates them.
+    if not created:
+        cache = get_conversation_cache()
+        cache.on_commit(cache.invalidate_conversations, [instance.pk])
+
+
+@receiver(pre_delete, sender=Conversation)
+def invalidate_deleted_conversation(sender, instance, **kwargs):
+    cache = get_conversation_cache()
+    if cache.enabled:
+        cache.on_commit(cache.invalidate, list(instance.memberships.values_list('user_id', flat=True)))
+
+
+@receiver(m2m_changed, sender=Conversation.users.through)
+def invalidate_members(sender, instance, action, reverse, pk_set, **kwargs):
+    cache = get_conversation_cache()
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            cache.on_commit(cache.invalidate_conversations, pk_set, [instance.pk])
+        else:
+            cache.on_commit(cache.invalidate_conversations, [instance.pk], pk_set)
+    elif action == 'pre_clear' and cache.enabled:
+        # The members are gone after the clear.
+        if reverse:
+            conversation_ids = list(instance.memberships.values_list('conversation_id', flat=True))
+            cache.on_commit(cache.invalidate_conversations, conversation_ids, [instance.pk])
+        else:
+            cache.on_commit(cache.invalidate, list(instance.memberships.values_list('user_id', flat=True)))
+
+
+@receiver(m2m_changed, sender=User.friends.through)
+def invalidate_friends(sender, instance, action, pk_set, **kwargs):
+    # Friend counts are shown for the other user of a conversation.
+    cache = get_conversation_cache()
+    if action in ('post_add', 'post_remove', 'pre_clear') and cache.enabled:
+        if action == 'pre_clear':
+            pk_set = set(instance.friends.values_list('pk', flat=True))
+        cache.on_commit(cache.invalidate_partners, {instance.pk, *pk_set})
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_profile(sender, instance, created=False, update_fields=None, **kwargs):
+    if created or (update_fields is not None and not PROFILE_FIELDS & set(update_fields)):
+        return
+    cache = get_conversation_cache()
+    cache.on_commit(cache.invalidate_partners, [instance.pk])
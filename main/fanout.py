@@ -0,0 +1,32 @@
+"""
+Delivery of one event to many channel layer groups.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+    Send `message` to every group in `groups`.
+
+    Layers that implement `group_send_many` get all groups in a single call.
+    Otherwise the sends are issued concurrently, so a Redis-backed layer keeps
+    them in flight together over its connection pool instead of paying one
+    round trip after another.
+    """
+    groups = list(groups)
+    if not groups:
+        return
+    send_many = getattr(channel_layer, 'group_send_many', None)
+    if send_many is not None:
+        await send_many(groups, message)
+        return
+    results = await asyncio.gather(
+        *(channel_layer.group_send(group, message) for group in groups),
+        return_exceptions=True,
+    )
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            logger.error("group_send to %s failed", group, exc_info=result)
@@ -0,0 +1,141 @@
+"""
+Latency and database cost per websocket event and REST route.
+
+Every consumer connect, client frame and disconnect, and every HTTP request,
+runs inside `instrument(<event name>)`. It records the event's duration and
+the number and duration of the queries it ran, including the ones made from
+`database_sync_to_async` threads, which inherit the event's context. The
+numbers end up in main/metrics.py and are served at /api/metrics. Events
+slower than ``SLOW_EVENT_THRESHOLD`` seconds are logged.
+
+Configured with the ``CONVO_INSTRUMENTATION`` setting::
+
+    CONVO_INSTRUMENTATION = {
+        'ENABLED': True,
+        'SLOW_EVENT_THRESHOLD': 1.0,
+    }
+"""
+import logging
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+
+from .metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INSTRUMENTATION = {
+    'ENABLED': True,
+    'SLOW_EVENT_THRESHOLD': 1.0,
+}
+
+event_duration = Histogram('convo_event_duration_seconds', 'Time spent handling an event.')
+event_queries = Counter('convo_event_queries_total', 'Database queries run by events.')
+event_db_time = Counter('convo_event_db_seconds_total', 'Time events spent in database queries.')
+
+current_event = ContextVar('current_event', default=None)
+
+
+class EventStats:
+    __slots__ = ('queries', 'db_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current_event.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+_config = None
+
+
+def get_config():
+    global _config
+    if _config is None:
+        _config = {**DEFAULT_INSTRUMENTATION, **getattr(settings, 'CONVO_INSTRUMENTATION', {})}
+    return _config
+
+
+def _reset_config(setting, **kwargs):
+    global _config
+    if setting == 'CONVO_INSTRUMENTATION':
+        _config = None
+
+
+setting_changed.connect(_reset_config)
+
+
+class instrument:
+    """
+    Context manager measuring the event named `event`.
+    """
+    __slots__ = ('event', 'stats', 'token', 'started')
+
+    def __init__(self, event):
+        self.event = event
+        self.stats = None
+
+    def __enter__(self):
+        if get_config()['ENABLED']:
+            self.stats = EventStats()
+            self.token = current_event.set(self.stats)
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stats = self.stats
+        if stats is None:
+            return
+        duration = time.perf_counter() - self.started
+        current_event.reset(self.token)
+        event_duration.observe(duration, event=self.event)
+        if stats.queries:
+            event_queries.inc(stats.queries, event=self.event)
+            event_db_time.inc(stats.db_time, event=self.event)
+        if duration >= get_config()['SLOW_EVENT_THRESHOLD']:
+            logger.warning(
+                "Slow event %s took %.3fs: %d queries, %.3fs in the database",
+                self.event, duration, stats.queries, stats.db_time,
+            )
+
+
+class InstrumentationMiddleware:
+    """
+    Instrument every request under the name of its route, e.g. "GET api/chats".
+    """
+
+    methods = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        measurement = instrument(None)
+        with measurement:
+            response = self.get_response(request)
+            # Label by route pattern and known method only, so clients can't grow the label set.
+            method = request.method if request.method in self.methods else 'OTHER'
+            match = request.resolver_match
+            measurement.event = f"{method} {match.route if match is not None else 'unmatched'}"
+        return response
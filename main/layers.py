@@ -0,0 +1,404 @@
+"""
+A channel layer that shards groups and channels over several stores and
+delivers group messages in batches.
+
+``ShardedChannelLayer`` places every group and every channel on a shard by
+consistent hashing, so adding a shard only moves the keys that land on it. A
+group message is serialized once, the group's members are read from the
+group's shard in one round trip, and the deliveries are pushed to each
+channel's shard in one round trip per shard, however many members there are.
+`group_send_many` does the same for one message sent to many groups.
+
+Process-specific channels (``specific.<process>!<socket>``) share one queue
+per process, read by a single task that hands the messages to the sockets'
+local buffers. ``CAPACITY`` applies to each socket's buffer there, and a
+message arriving for a full buffer is dropped, as with a full channel in
+group_send. `send` raises ChannelFull only when the socket is in the sending
+process and its buffer is already full; sends from other processes cannot see
+the buffer and are dropped silently when it is.
+
+With ``HOSTS`` the shards are Redis servers, one per host (needs ``redis``).
+Without, the layer keeps ``SHARDS`` stores in memory, which only works within
+one process but runs the same routing and batching, e.g. in tests and
+benchmarks. Messages are serialized with msgpack in both modes::
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'main.layers.ShardedChannelLayer',
+            'CONFIG': {
+                'hosts': [('redis-1', 6379), 'redis://redis-2:6379/0'],
+            },
+        },
+    }
+"""
+import asyncio
+import bisect
+import hashlib
+import time
+import uuid
+from collections import defaultdict
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto shard indexes, with `replicas` points per shard.
+    """
+
+    def __init__(self, names, replicas=64):
+        points = sorted(
+            (hash_key(f'{name}#{replica}'), index)
+            for index, name in enumerate(names)
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def lookup(self, key):
+        position = bisect.bisect(self.hashes, hash_key(key))
+        return self.indexes[position % len(self.indexes)]
+
+
+class MemoryShard:
+    """
+    Queues and groups of one shard, kept in this process.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queues = {}
+        self.groups = {}
+
+    def get_queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = asyncio.Queue()
+        return queue
+
+    async def push(self, items, expiry):
+        """
+        Append (queue name, data, capacity) items and return the indexes of the
+        ones rejected because their queue was full. A capacity of None is unbounded.
+        """
+        rejected = []
+        expires = time.time() + expiry
+        for index, (name, data, capacity) in enumerate(items):
+            queue = self.get_queue(name)
+            if capacity is not None and queue.qsize() >= capacity:
+                rejected.append(index)
+            else:
+                queue.put_nowait((expires, data))
+        return rejected
+
+    async def pop(self, name):
+        queue = self.get_queue(name)
+        while True:
+            expires, data = await queue.get()
+            if expires >= time.time():
+                return data
+
+    async def group_add(self, group, channel, group_expiry):
+        self.groups.setdefault(group, {})[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.pop(channel, None)
+            if not channels:
+                del self.groups[group]
+
+    async def group_channels(self, groups, group_expiry):
+        """
+        Return the member channels of each of `groups`.
+        """
+        oldest = time.time() - group_expiry
+        members = []
+        for group in groups:
+            channels = self.groups.get(group, {})
+            for channel in [channel for channel, joined in channels.items() if joined < oldest]:
+                del channels[channel]
+            members.append(list(channels))
+        return members
+
+    async def flush(self):
+        self.queues = {}
+        self.groups = {}
+
+    async def close(self):
+        pass
+
+
+class RedisShard:
+    """
+    Queues and groups of one shard on a Redis server.
+
+    A queue is a list that expires ``EXPIRY`` seconds after its last push, a
+    group a sorted set of channels scored by the time they joined.
+    """
+
+    # Pushes every item whose list is below its capacity; a capacity of -1 is unbounded.
+    # KEYS are the lists, ARGV the expiry followed by a capacity and data per item.
+    push_script = """
+        local rejected = {}
+        for i = 1, #KEYS do
+            local capacity = tonumber(ARGV[i * 2])
+            if capacity >= 0 and redis.call('LLEN', KEYS[i]) >= capacity then
+                table.insert(rejected, i - 1)
+            else
+                redis.call('RPUSH', KEYS[i], ARGV[i * 2 + 1])
+                redis.call('EXPIRE', KEYS[i], ARGV[1])
+            end
+        end
+        return rejected
+    """
+
+    def __init__(self, host, prefix='convo'):
+        import redis.asyncio
+
+        if isinstance(host, str):
+            self.connection = redis.asyncio.Redis.from_url(host)
+            self.name = host
+        else:
+            address, port = host
+            self.connection = redis.asyncio.Redis(host=address, port=port)
+            self.name = f'{address}:{port}'
+        self.prefix = prefix
+        self.push_many = self.connection.register_script(self.push_script)
+
+    def queue_key(self, name):
+        return f'{self.prefix}:queue:{name}'
+
+    def group_key(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    async def push(self, items, expiry):
+        keys, args = [], [int(expiry)]
+        for name, data, capacity in items:
+            keys.append(self.queue_key(name))
+            args.extend((-1 if capacity is None else capacity, data))
+        return await self.push_many(keys=keys, args=args)
+
+    async def pop(self, name):
+        key = self.queue_key(name)
+        while True:
+            # Time out now and then so a dead connection is noticed.
+            result = await self.connection.blpop([key], timeout=5)
+            if result is not None:
+                return result[1]
+
+    async def group_add(self, group, channel, group_expiry):
+        key = self.group_key(group)
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.zadd(key, {channel: time.time()})
+        pipeline.expire(key, int(group_expiry))
+        await pipeline.execute()
+
+    async def group_discard(self, group, channel):
+        await self.connection.zrem(self.group_key(group), channel)
+
+    async def group_channels(self, groups, group_expiry):
+        oldest = time.time() - group_expiry
+        pipeline = self.connection.pipeline(transaction=False)
+        for group in groups:
+            key = self.group_key(group)
+            pipeline.zremrangebyscore(key, '-inf', oldest)
+            pipeline.zrange(key, 0, -1)
+        results = await pipeline.execute()
+        return [[channel.decode() for channel in channels] for channels in results[1::2]]
+
+    async def flush(self):
+        keys = [key async for key in self.connection.scan_iter(match=f'{self.prefix}:*')]
+        if keys:
+            await self.connection.delete(*keys)
+
+    async def close(self):
+        await self.connection.aclose()
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, shards=1, prefix='convo', expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None, replicas=64, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        if hosts:
+            self.shards = [RedisShard(host, prefix=prefix) for host in hosts]
+        else:
+            self.shards = [MemoryShard(f'memory{index}') for index in range(shards)]
+        self.ring = HashRing([shard.name for shard in self.shards], replicas=replicas)
+        self.client_prefix = uuid.uuid4().hex
+        # {process queue: {channel: buffer}} for the process-specific channels received here.
+        self.local_channels = {}
+        self.readers = {}
+
+    # Routing
+
+    def consistent_hash(self, key):
+        return self.ring.lookup(key)
+
+    def shard(self, key):
+        return self.shards[self.ring.lookup(key)]
+
+    def connection(self, index):
+        """
+        Return the Redis connection of shard `index`, e.g. for main/presence.py.
+        """
+        shard = self.shards[index]
+        if not isinstance(shard, RedisShard):
+            raise ImproperlyConfigured(
+                "ShardedChannelLayer keeps its shards in memory; configure HOSTS to share them."
+            )
+        return shard.connection
+
+    def envelope(self, channel, data):
+        # Channel names are ASCII without NUL, so the name can prefix the serialized message.
+        return channel.encode() + b'\0' + data
+
+    def open(self, envelope):
+        channel, _, data = envelope.partition(b'\0')
+        return channel.decode(), msgpack.unpackb(data, raw=False)
+
+    def delivery_capacity(self, channel):
+        # A process queue is shared by all of its sockets and drained continuously; the
+        # capacity applies to each socket's local buffer instead.
+        return None if '!' in channel else self.get_capacity(channel)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        queue = self.non_local_name(channel)
+        buffer = self.local_channels.get(queue, {}).get(channel)
+        if buffer is not None and buffer.full():
+            raise ChannelFull(channel)
+        data = msgpack.packb(message, use_bin_type=True)
+        rejected = await self.shard(queue).push(
+            [(queue, self.envelope(channel, data), self.delivery_capacity(channel))], self.expiry
+        )
+        if rejected:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        if '!' not in channel:
+            return self.open(await self.shard(channel).pop(channel))[1]
+
+        queue = self.non_local_name(channel)
+        buffer = self.local_channels.get(queue, {}).get(channel)
+        if buffer is None:
+            buffer = self.register(channel)
+        self.start_reader(queue)
+        try:
+            return await buffer.get()
+        except asyncio.CancelledError:
+            # The consumer is gone; drop its buffer and the messages arriving for it.
+            self.forget(queue, channel)
+            raise
+
+    async def new_channel(self, prefix='specific'):
+        channel = f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex}'
+        # Buffer messages from now on, before the consumer's first receive().
+        self.register(channel)
+        return channel
+
+    def register(self, channel):
+        buffer = asyncio.Queue(maxsize=self.get_capacity(channel))
+        self.local_channels.setdefault(self.non_local_name(channel), {})[channel] = buffer
+        return buffer
+
+    def start_reader(self, queue):
+        reader = self.readers.get(queue)
+        if reader is None or reader.done() or reader.get_loop() is not asyncio.get_running_loop():
+            self.readers[queue] = asyncio.ensure_future(self.read(queue))
+
+    def forget(self, queue, channel):
+        channels = self.local_channels.get(queue, {})
+        channels.pop(channel, None)
+        if not channels:
+            self.local_channels.pop(queue, None)
+            reader = self.readers.pop(queue, None)
+            if reader is not None:
+                reader.cancel()
+
+    async def read(self, queue):
+        """
+        Hand the messages of a process queue to the buffers of its channels.
+        """
+        shard = self.shard(queue)
+        while True:
+            channel, message = self.open(await shard.pop(queue))
+            buffer = self.local_channels.get(queue, {}).get(channel)
+            # A full buffer misses the message, see the module docstring.
+            if buffer is not None and not buffer.full():
+                buffer.put_nowait(message)
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self.shard(group).group_add(group, channel, self.group_expiry)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self.shard(group).group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await self.group_send_many([group], message)
+
+    async def group_send_many(self, groups, message):
+        """
+        Send `message` to every member of `groups`: one read per group shard and one
+        push per channel shard. Full channels miss the message, as with group_send.
+        """
+        assert isinstance(message, dict), 'message is not a dict'
+        groups_by_shard = defaultdict(list)
+        for group in groups:
+            self.require_valid_group_name(group)
+            groups_by_shard[self.ring.lookup(group)].append(group)
+        members = await asyncio.gather(*(
+            self.shards[index].group_channels(shard_groups, self.group_expiry)
+            for index, shard_groups in groups_by_shard.items()
+        ))
+
+        data = msgpack.packb(message, use_bin_type=True)
+        deliveries = defaultdict(list)
+        shard_indexes = {}
+        for shard_members in members:
+            for channels in shard_members:
+                for channel in channels:
+                    queue = self.non_local_name(channel)
+                    index = shard_indexes.get(queue)
+                    if index is None:
+                        index = shard_indexes[queue] = self.ring.lookup(queue)
+                    deliveries[index].append((queue, self.envelope(channel, data), self.delivery_capacity(channel)))
+        await asyncio.gather(*(
+            self.shards[index].push(items, self.expiry) for index, items in deliveries.items()
+        ))
+
+    # Flush extension
+
+    async def flush(self):
+        for reader in self.readers.values():
+            reader.cancel()
+        self.readers = {}
+        self.local_channels = {}
+        await asyncio.gather(*(shard.flush() for shard in self.shards))
+
+    async def close(self):
+        for reader in self.readers.values():
+            reader.cancel()
+        await asyncio.gather(*(shard.close() for shard in self.shards))
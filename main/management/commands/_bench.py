@@ -0,0 +1,94 @@
+"""
+Helpers shared by the ``bench_*`` management commands.
+
+Benchmarks never touch the configured database or channel layer: they run
+against a throwaway test database and an in-memory channel layer, and
+invalidate cached conversation lists on commit.
+"""
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 100000,
+        },
+    },
+}
+
+
+@contextmanager
+def bench_environment(channel_layers=None, database_name=None):
+    """
+    Pass `database_name` to benchmark against an on-disk SQLite file instead of
+    the in-memory test database, e.g. when fsync cost matters.
+    """
+    setup_test_environment()
+    if database_name is not None:
+        connection.settings_dict['TEST']['NAME'] = database_name
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(
+            CHANNEL_LAYERS=channel_layers or IN_MEMORY_CHANNEL_LAYERS,
+            CONVO_PRESENCE={'BACKEND': 'main.presence.InMemoryPresence'},
+            # A background invalidation thread would contend with the benchmark for the in-memory database.
+            CONVO_CONVERSATION_CACHE={'INVALIDATION_DELAY': None},
+        ):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def create_users(count, prefix="bench"):
+    from rest_framework.authtoken.models import Token
+    from main.models import User
+
+    User.objects.bulk_create([User(username=f"{prefix}{i}") for i in range(count)])
+    users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+    Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+    tokens = dict(Token.objects.filter(user__in=users).values_list("user_id", "key"))
+    return [(user, tokens[user.id]) for user in users]
+
+
+def websocket_application(coalesce_typing=True):
+    """
+    Pass `coalesce_typing=False` to route to consumers that broadcast every
+    typing frame, as they did before typing indicators were coalesced.
+    """
+    from channels.routing import URLRouter
+    from django.urls import path
+    from main.consumers import NotificationConsumer, PersonalChatConsumer, RoomChatConsumer
+    from main.middleware import TokenAuthMiddleware
+    from main.routing import websocket_urlpatterns
+
+    if not coalesce_typing:
+        class EveryFrameTyping:
+            async def update_typing(self, typing):
+                await self.broadcast_typing(typing)
+
+        class EveryFramePersonalChatConsumer(EveryFrameTyping, PersonalChatConsumer):
+            pass
+
+        class EveryFrameRoomChatConsumer(EveryFrameTyping, RoomChatConsumer):
+            pass
+
+        websocket_urlpatterns = [
+            path('ws/notifications/', NotificationConsumer.as_asgi()),
+            path('ws/chat/<str:username>/', EveryFramePersonalChatConsumer.as_asgi()),
+            path('ws/chat/room/<str:room_name>/', EveryFrameRoomChatConsumer.as_asgi()),
+        ]
+    return TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from main.archive import get_archiver
+
+
+class Command(BaseCommand):
+    help = "Move messages older than the configured age from the message table to the archive, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--age-days", type=int, help="Archive messages older than this many days.")
+        parser.add_argument("--batch-size", type=int, help="Messages moved per transaction.")
+
+    def handle(self, *args, **options):
+        archiver = get_archiver()
+        if options["age_days"] is not None:
+            archiver.age_days = options["age_days"]
+        if options["batch_size"]:
+            archiver.batch_size = options["batch_size"]
+        moved = archiver.archive(progress=lambda moved: self.stdout.write(f"Archived {moved} messages."))
+        self.stdout.write(f"Archived {moved} messages older than {archiver.age_days} days.")
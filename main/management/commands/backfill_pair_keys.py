@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Set the pair key of personal conversations created before it was introduced."
+
+    def handle(self, *args, **options):
+        updated, duplicates = Conversation.objects.backfill_pair_keys()
+        self.stdout.write(f"Updated {updated} conversations.")
+        if duplicates:
+            self.stdout.write(
+                f"{duplicates} duplicate conversations were left without a pair key; "
+                f"the oldest conversation of each pair is the one that gets looked up."
+            )
@@ -0,0 +1,100 @@
+import os
+import random
+import statistics
+import tempfile
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from main.archive import MessageArchiver, MessageHistory
+from main.models import ArchivedMessage, Conversation, Message
+
+from ._bench import Timer, bench_environment, create_users
+
+HOT_TABLES = ("main_message", "message_history_idx", "message_unread_idx")
+ARCHIVE_TABLES = ("main_archivedmessage", "archived_message_history_idx")
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a year of messages, archive the ones older than --age-days and report the size of "
+        "the hot table and its indexes and the latency of recent and archived history pages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--conversations", type=int, default=2000)
+        parser.add_argument("--age-days", type=int, default=90)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=500, help="History pages read per measurement.")
+
+    def handle(self, *args, **options):
+        database_name = os.path.join(tempfile.mkdtemp(), "bench_archive.sqlite3")
+        with bench_environment(database_name=database_name):
+            with Timer() as seed:
+                conversations = self.seed(options)
+            self.stdout.write(f"seeded {Message.objects.count()} messages in {seed.elapsed:.1f}s")
+            self.report("before", conversations, options)
+
+            archiver = MessageArchiver(age_days=options["age_days"], batch_size=options["batch_size"])
+            with Timer() as timer:
+                moved = archiver.archive()
+            self.stdout.write(f"archived {moved} messages in {timer.elapsed:.1f}s, {moved / timer.elapsed:.0f}/s")
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+                cursor.execute("ANALYZE")
+            self.report("after", conversations, options)
+
+    def seed(self, options):
+        rng = random.Random(0)
+        users = [user for user, _ in create_users(2 * options["conversations"])]
+        conversations = Conversation.objects.bulk_create([
+            Conversation(type="personal", name=f"bench-{i}", created_at=timezone.now() - timedelta(days=400))
+            for i in range(options["conversations"])
+        ])
+        # A year of history, in time order so ids follow created_at.
+        start = timezone.now() - timedelta(days=365)
+        step = timedelta(days=365) / options["messages"]
+        batch = []
+        for i in range(options["messages"]):
+            index = rng.randrange(len(conversations))
+            batch.append(Message(
+                conversation=conversations[index], sender=users[2 * index], recipient=users[2 * index + 1],
+                content=f"message {i} " + "lorem ipsum " * rng.randrange(1, 10), read=True, status="seen",
+                created_at=start + step * i,
+            ))
+            if len(batch) == 50000:
+                Message.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        Message.objects.bulk_create(batch, batch_size=5000)
+        Conversation.objects.rebuild_activity()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        return [conversation.id for conversation in conversations]
+
+    def report(self, label, conversations, options):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+            sizes = dict(cursor.fetchall())
+        hot = sum(sizes.get(name, 0) for name in HOT_TABLES)
+        cold = sum(sizes.get(name, 0) for name in ARCHIVE_TABLES)
+        self.stdout.write(
+            f"{label}: hot table and indexes {hot / 2 ** 20:7.1f} MiB ({Message.objects.count()} rows), "
+            f"archive {cold / 2 ** 20:7.1f} MiB ({ArchivedMessage.objects.count()} rows)"
+        )
+
+        rng = random.Random(1)
+        old = timezone.now() - timedelta(days=200)
+        for name, read in (
+            ("newest page", lambda history: history.newest(51)),
+            ("page 200 days back", lambda history: history.before(old, 0, 51)),
+        ):
+            timings = []
+            for _ in range(options["repeat"]):
+                history = MessageHistory([rng.choice(conversations)])
+                with Timer() as timer:
+                    read(history)
+                timings.append(timer.elapsed * 1000)
+            self.stdout.write(f"  {name:20} p50={statistics.median(timings):7.3f}ms max={max(timings):7.3f}ms")
@@ -0,0 +1,128 @@
+import random
+import statistics
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from main.conversation_cache import get_conversation_cache
+from main.models import Conversation, Membership, Message
+
+from ._bench import Timer, bench_environment, create_users
+
+# The background thread would contend with this thread for the in-memory database, so benchmarks
+# queue invalidations for longer than they run and do the thread's work with `flush()`, untimed.
+BACKGROUND = 3600
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a mix of conversation list requests and stored messages with the conversation "
+        "list cache enabled and disabled, and report request latency and the cache hit rate. Then "
+        "time stored messages and read receipts in one large group, invalidating on commit and in "
+        "the background."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--conversations", type=int, default=20, help="Personal conversations per user.")
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--write-ratio", type=float, default=0.1, help="Share of stored messages.")
+        parser.add_argument("--room-size", type=int, default=3000, help="Members of the large group.")
+        parser.add_argument("--room-messages", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with bench_environment():
+            users, conversations = self.seed(options)
+            for enabled in (False, True):
+                with override_settings(CONVO_CONVERSATION_CACHE={
+                    "ENABLED": enabled, "CACHE": "conversations", "INVALIDATION_DELAY": BACKGROUND,
+                }):
+                    get_conversation_cache().clear()
+                    self.run(users, conversations, enabled, options)
+            self.run_room(options)
+
+    def seed(self, options):
+        users = create_users(options["users"])
+        pairs = {
+            tuple(sorted((index, (index + offset) % len(users))))
+            for index in range(len(users)) for offset in range(1, options["conversations"] // 2 + 1)
+        }
+        conversations = Conversation.objects.bulk_create(
+            [Conversation(type="personal", name=f"bench-{first}-{second}") for first, second in pairs]
+        )
+        members = {conversation.id: pair for conversation, pair in zip(conversations, pairs)}
+        Through = Conversation.users.through
+        Through.objects.bulk_create(
+            [Through(conversation_id=c_id, user_id=users[index][0].id) for c_id, pair in members.items()
+             for index in pair],
+            batch_size=5000,
+        )
+        Membership.objects.bulk_create(
+            [Membership(conversation_id=c_id, user_id=users[index][0].id) for c_id, pair in members.items()
+             for index in pair],
+            batch_size=5000,
+        )
+        Message.objects.bulk_create(
+            [Message(conversation_id=c_id, sender=users[pair[0]][0], recipient=users[pair[1]][0], content="hello")
+             for c_id, pair in members.items()],
+            batch_size=5000,
+        )
+        Conversation.objects.rebuild_activity()
+        self.stdout.write(f"{len(users)} users, {len(conversations)} conversations")
+        return users, [(conversation, [users[index][0] for index in members[conversation.id]])
+                       for conversation in conversations]
+
+    def run(self, users, conversations, enabled, options):
+        rng = random.Random(0)
+        client = Client()
+        stats = get_conversation_cache().stats()
+        reads, writes = [], []
+        for _ in range(options["requests"]):
+            if rng.random() < options["write_ratio"]:
+                conversation, (sender, recipient) = rng.choice(conversations)
+                with Timer() as timer:
+                    Message.objects.store(conversation, sender, "news", recipient=recipient)
+                writes.append(timer.elapsed * 1000)
+                get_conversation_cache().flush()
+            else:
+                _, token = rng.choice(users)
+                with Timer() as timer:
+                    client.get("/api/chats", HTTP_AUTHORIZATION=f"Token {token}")
+                reads.append(timer.elapsed * 1000)
+        after = get_conversation_cache().stats()
+        hits, misses = after["hits"] - stats["hits"], after["misses"] - stats["misses"]
+        self.stdout.write(
+            f"cache {'on ' if enabled else 'off'}  list p50={statistics.median(reads):7.3f}ms "
+            f"mean={statistics.mean(reads):7.3f}ms  store p50={statistics.median(writes):6.3f}ms"
+            + (f"  hit rate={hits / (hits + misses):.1%}" if enabled else "")
+        )
+
+    def run_room(self, options):
+        members = [user for user, _ in create_users(options["room_size"], prefix="member")]
+        room = Conversation.objects.create(type="group", name="bench-room")
+        Through = Conversation.users.through
+        Through.objects.bulk_create([Through(conversation_id=room.id, user_id=user.id) for user in members],
+                                    batch_size=5000)
+        Membership.objects.bulk_create([Membership(conversation_id=room.id, user_id=user.id) for user in members],
+                                       batch_size=5000)
+        for label, delay in (("on commit", None), ("background", BACKGROUND)):
+            with override_settings(CONVO_CONVERSATION_CACHE={
+                "ENABLED": True, "CACHE": "conversations", "INVALIDATION_DELAY": delay,
+            }):
+                cache = get_conversation_cache()
+                stores, receipts, flushes = [], [], []
+                for index in range(options["room_messages"]):
+                    with Timer() as timer:
+                        Message.objects.store(room, members[index % len(members)], "news")
+                    stores.append(timer.elapsed * 1000)
+                    with Timer() as timer:
+                        Membership.objects.mark_read(members[(index + 1) % len(members)], room)
+                    receipts.append(timer.elapsed * 1000)
+                    with Timer() as timer:
+                        cache.flush()
+                    flushes.append(timer.elapsed * 1000)
+                self.stdout.write(
+                    f"room of {len(members)}, invalidation {label:10}  store p50={statistics.median(stores):7.3f}ms  "
+                    f"read receipt p50={statistics.median(receipts):6.3f}ms"
+                    + (f"  background p50={statistics.median(flushes):7.3f}ms" if delay else "")
+                )
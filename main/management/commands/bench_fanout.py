@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+from main import codec
+from main.consumers import ChatConsumer
+
+from ._bench import Timer
+
+SAMPLE_USER = {
+    "first_name": "Ada",
+    "last_name": "Lovelace",
+    "username": "ada",
+    "email": "ada@example.com",
+    "display_photo": "/media/user_ada/profile.jpeg",
+    "friends_count": 42,
+}
+
+SAMPLE_EVENT = {
+    "type": "chat_message",
+    "message": {
+        "id": 123456,
+        "sender": SAMPLE_USER,
+        "recipient": {**SAMPLE_USER, "username": "charles", "email": "charles@example.com"},
+        "content": "See you at the engine room at five, bring the punched cards. " * 2,
+        "created_at": "2026-10-18T19:28:57.123456Z",
+        "status": "sent",
+        "read": False,
+    },
+    "conversation_id": 42,
+}
+
+
+class StdlibChatConsumer(ChatConsumer):
+    """
+    The previous behaviour: every recipient re-encodes the event with the json module.
+    """
+
+    @classmethod
+    async def encode_json(cls, content):
+        return json.dumps(content)
+
+    async def chat_message(self, event):
+        await self.send_json(event)
+
+
+class Command(BaseCommand):
+    help = "Measure the per-recipient cost of fanning one chat message out to many sockets."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=5000)
+        parser.add_argument("--rounds", type=int, default=5)
+
+    def handle(self, *args, **options):
+        recipients, rounds = options["recipients"], options["rounds"]
+        self.stdout.write(f"codec={'orjson' if codec.orjson else 'json'} recipients={recipients} rounds={rounds}")
+        for name, consumer_class, encode_once in (
+            ("stdlib, encode per recipient", StdlibChatConsumer, False),
+            ("codec, encode per recipient", ChatConsumer, False),
+            ("codec, encode once", ChatConsumer, True),
+        ):
+            elapsed = asyncio.run(self.run(consumer_class, encode_once, recipients, rounds))
+            self.stdout.write(f"{name:30} {elapsed / (recipients * rounds) * 1e6:8.2f} us/recipient")
+
+    async def run(self, consumer_class, encode_once, recipients, rounds):
+        async def base_send(message):
+            pass
+
+        consumers = []
+        for _ in range(recipients):
+            consumer = consumer_class()
+            consumer.base_send = base_send
+            consumers.append(consumer)
+
+        with Timer() as timer:
+            for _ in range(rounds):
+                if encode_once:
+                    event = {"type": SAMPLE_EVENT["type"], "text": codec.dumps(SAMPLE_EVENT)}
+                else:
+                    event = SAMPLE_EVENT
+                for consumer in consumers:
+                    await consumer.chat_message(event)
+        return timer.elapsed
@@ -0,0 +1,103 @@
+import asyncio
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from main.layers import ShardedChannelLayer
+
+from ._bench import Timer
+
+SAMPLE_MESSAGE = {
+    "type": "chat.message",
+    "text": '{"type":"chat_message","message":{"id":123456,"content":"' + "See you at five. " * 8 + '"}}',
+    "user": "ada",
+    "message_id": 123456,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure group fan-out through the stock channel layers and ShardedChannelLayer: "
+        "one large group, and one message to many single-member groups."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=1000, help="Members of the large group.")
+        parser.add_argument("--messages", type=int, default=10, help="Messages sent to the large group.")
+        parser.add_argument("--groups", type=int, default=1000, help="Groups of the group_send_many run.")
+        parser.add_argument("--shards", type=int, default=4, help="In-memory shards of ShardedChannelLayer.")
+        parser.add_argument(
+            "--redis", action="append", default=[],
+            help="A Redis host (host:port or redis:// URL) to also compare the Redis-backed layers; repeatable.",
+        )
+
+    def handle(self, *args, **options):
+        layers = [
+            ("InMemoryChannelLayer", lambda: InMemoryChannelLayer(capacity=100000)),
+            ("Sharded, 1 memory shard", lambda: ShardedChannelLayer(shards=1, capacity=100000)),
+            (f"Sharded, {options['shards']} memory shards",
+             lambda: ShardedChannelLayer(shards=options["shards"], capacity=100000)),
+        ]
+        if options["redis"]:
+            hosts = [self.host(host) for host in options["redis"]]
+            try:
+                from channels_redis.core import RedisChannelLayer
+            except ImportError:
+                self.stderr.write("channels_redis is not installed, skipping RedisChannelLayer.")
+            else:
+                layers.append(("RedisChannelLayer", lambda: RedisChannelLayer(hosts=hosts, capacity=100000)))
+            layers.append(
+                (f"Sharded, {len(hosts)} Redis shards", lambda: ShardedChannelLayer(hosts=hosts, capacity=100000))
+            )
+
+        self.stdout.write(f"members={options['members']} messages={options['messages']} groups={options['groups']}")
+        for name, make_layer in layers:
+            group_send, group_send_many = asyncio.run(self.run(make_layer(), options))
+            self.stdout.write(
+                f"{name:28} group_send {group_send:9.0f} deliveries/s   "
+                f"group_send_many {group_send_many:9.0f} deliveries/s"
+            )
+
+    def host(self, host):
+        if "://" in host:
+            return host
+        address, _, port = host.partition(":")
+        return (address, int(port or 6379))
+
+    async def run(self, layer, options):
+        await layer.flush()
+        members = [await layer.new_channel() for _ in range(max(options["members"], options["groups"]))]
+
+        # One large group: every member receives every message.
+        for channel in members[:options["members"]]:
+            await layer.group_add("bench-room", channel)
+        with Timer() as timer:
+            await asyncio.gather(
+                self.receive(layer, members[:options["members"]], options["messages"]),
+                *(layer.group_send("bench-room", SAMPLE_MESSAGE) for _ in range(options["messages"])),
+            )
+        group_send = options["members"] * options["messages"] / timer.elapsed
+
+        # One message to many groups, as for new-message notifications.
+        groups = [f"bench-user-{index}__notifications" for index in range(options["groups"])]
+        for group, channel in zip(groups, members):
+            await layer.group_add(group, channel)
+        send_many = getattr(layer, "group_send_many", None)
+        if send_many is not None:
+            sending = send_many(groups, SAMPLE_MESSAGE)
+        else:
+            sending = asyncio.gather(*(layer.group_send(group, SAMPLE_MESSAGE) for group in groups))
+        with Timer() as timer:
+            await asyncio.gather(self.receive(layer, members[:options["groups"]], 1), sending)
+        group_send_many = options["groups"] / timer.elapsed
+
+        await layer.flush()
+        await layer.close()
+        return group_send, group_send_many
+
+    async def receive(self, layer, channels, count):
+        async def receive_from(channel):
+            for _ in range(count):
+                await layer.receive(channel)
+
+        await asyncio.gather(*(receive_from(channel) for channel in channels))
@@ -0,0 +1,248 @@
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import threading
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from main.models import Conversation
+
+from ._bench import Timer, bench_environment, create_users, websocket_application
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def resident_memory():
+    """
+    Return the resident set size of the process in bytes, or None where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class QueryCounter:
+    """
+    Count the queries of every database connection, including the ones opened
+    by the thread pool running the consumers' database calls.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.install)
+        for connection in connections.all():
+            self.install(connection)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self.install)
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive simulated users through connect, typing, message and read workloads over "
+        "personal chats and rooms, and report latency, throughput, queries and memory as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--room-size", type=int, default=20, help="Members per room; 0 disables rooms.")
+        parser.add_argument("--rooms", type=int, default=2)
+        parser.add_argument("--messages", type=int, default=5, help="Messages sent on every chat socket.")
+        parser.add_argument("--typing", type=int, default=5, help="Typing frames sent on every chat socket.")
+        parser.add_argument(
+            "--rate", type=float, default=40,
+            help="Messages per second sent across all sockets; keep it below capacity to measure latency.",
+        )
+        parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument("--baseline", help="A previous JSON report to compare the key metrics against.")
+
+    def handle(self, *args, **options):
+        users_count = options["users"] - options["users"] % 2
+        with bench_environment(), QueryCounter() as queries:
+            users = create_users(users_count)
+            sockets = []
+            for first, second in zip(users[::2], users[1::2]):
+                Conversation.objects.get_or_create_personal_conversation(first[0], second[0])
+                sockets.append({"user": first, "path": f"/ws/chat/{second[0].username}/", "members": 2})
+                sockets.append({"user": second, "path": f"/ws/chat/{first[0].username}/", "members": 2})
+            for room_index in range(options["rooms"] if options["room_size"] else 0):
+                members = users[room_index * options["room_size"]:(room_index + 1) * options["room_size"]]
+                room = Conversation.objects.create(type="group", name=f"bench-room-{room_index}")
+                room.users.add(*(user for user, _ in members))
+                for member in members:
+                    sockets.append({"user": member, "path": f"/ws/chat/room/{room.name}/", "members": len(members)})
+
+            report = asyncio.run(self.run(users, sockets, queries, options))
+
+        report = {
+            "commit": self.commit(),
+            "options": {key: options[key] for key in ("users", "room_size", "rooms", "messages", "typing", "rate")},
+            **report,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+        if options["baseline"]:
+            self.compare(report, options["baseline"])
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    async def run(self, users, sockets, queries, options):
+        application = websocket_application()
+        for socket in sockets:
+            socket["communicator"] = WebsocketCommunicator(
+                application, f"{socket['path']}?token={socket['user'][1]}"
+            )
+        notifications = [
+            WebsocketCommunicator(application, f"/ws/notifications/?token={token}") for _, token in users
+        ]
+        communicators = [socket["communicator"] for socket in sockets] + notifications
+        report = {"sockets": len(communicators)}
+
+        # Connect: every user opens its notification socket and its chat sockets.
+        gc.collect()
+        memory_before = resident_memory()
+        connect_latencies = []
+
+        async def connect(communicator):
+            started = time.perf_counter()
+            await communicator.connect(timeout=120)
+            connect_latencies.append(time.perf_counter() - started)
+
+        report["connect"] = await self.phase(
+            queries, len(communicators), connect_latencies,
+            asyncio.gather(*(connect(communicator) for communicator in communicators)),
+        )
+        await asyncio.sleep(0.1)
+        gc.collect()
+        memory_after = resident_memory()
+        report["memory_per_connection_bytes"] = (
+            None if memory_before is None else round((memory_after - memory_before) / len(communicators))
+        )
+        for socket in sockets:
+            await self.drain(socket["communicator"], "last_50_messages", 1)
+
+        # Typing: keystrokes are coalesced, done when every typist saw its own start broadcast.
+        async def type_keys(socket):
+            for i in range(options["typing"]):
+                await socket["communicator"].send_json_to({"type": "typing", "typing": i < options["typing"] - 1})
+            await self.drain(socket["communicator"], "typing", 1, user=socket["user"][0].username, typing=True)
+
+        report["typing"] = await self.phase(
+            queries, len(sockets) * options["typing"], None,
+            asyncio.gather(*(type_keys(socket) for socket in sockets)),
+        )
+
+        # Messages: the latency is the time from send to delivery on each member's socket.
+        delivery_latencies = []
+
+        # Sockets take turns so messages go out at a steady overall rate.
+        interval = len(sockets) / options["rate"]
+
+        async def send_messages(index, socket):
+            await asyncio.sleep(index / options["rate"])
+            for _ in range(options["messages"]):
+                await socket["communicator"].send_json_to(
+                    {"type": "chat_message", "message": repr(time.perf_counter())}
+                )
+                await asyncio.sleep(interval)
+
+        async def receive_messages(socket):
+            expected = socket["members"] * options["messages"]
+            while expected:
+                frame = await socket["communicator"].receive_json_from(timeout=120)
+                if frame["type"] == "chat_message":
+                    delivery_latencies.append(time.perf_counter() - float(frame["message"]["content"]))
+                    expected -= 1
+
+        report["messages"] = await self.phase(
+            queries, len(sockets) * options["messages"], delivery_latencies,
+            asyncio.gather(
+                *(send_messages(index, socket) for index, socket in enumerate(sockets)),
+                *(receive_messages(socket) for socket in sockets),
+            ),
+        )
+        report["messages"]["deliveries_per_sec"] = round(len(delivery_latencies) / report["messages"]["seconds"], 1)
+
+        # Read receipts: done when every reader got its own "seen_message" back.
+        async def read(socket):
+            await socket["communicator"].send_json_to({"type": "read_messages"})
+            await self.drain(socket["communicator"], "seen_message", 1, user=socket["user"][0].username)
+
+        report["read"] = await self.phase(
+            queries, len(sockets), None, asyncio.gather(*(read(socket) for socket in sockets)),
+        )
+
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        return report
+
+    async def phase(self, queries, events, latencies, work):
+        queries_before = queries.count
+        with Timer() as timer:
+            await work
+        result = {
+            "events": events,
+            "seconds": round(timer.elapsed, 4),
+            "events_per_sec": round(events / timer.elapsed, 1),
+            "queries_per_event": round((queries.count - queries_before) / events, 3),
+        }
+        if latencies is not None:
+            result["p50_ms"] = round(percentile(latencies, 0.50) * 1000, 3)
+            result["p99_ms"] = round(percentile(latencies, 0.99) * 1000, 3)
+        return result
+
+    async def drain(self, communicator, frame_type, count, **fields):
+        while count:
+            frame = await communicator.receive_json_from(timeout=120)
+            if frame["type"] == frame_type and all(frame.get(key) == value for key, value in fields.items()):
+                count -= 1
+
+    def compare(self, report, baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        self.stderr.write(f"compared with {baseline.get('commit')}:")
+        for phase in ("connect", "typing", "messages", "read"):
+            for metric in ("events_per_sec", "p50_ms", "p99_ms", "queries_per_event"):
+                old, new = baseline.get(phase, {}).get(metric), report[phase].get(metric)
+                if old is None or new is None:
+                    continue
+                change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+                self.stderr.write(f"  {phase}.{metric}: {old} -> {new} ({change})")
+        old, new = baseline.get("memory_per_connection_bytes"), report["memory_per_connection_bytes"]
+        if old and new:
+            self.stderr.write(f"  memory_per_connection_bytes: {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
@@ -0,0 +1,137 @@
+import os
+import random
+import statistics
+import tempfile
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from main.models import Conversation, Membership, Message
+
+from ._bench import Timer, bench_environment, create_users
+
+# Indexes tuned to the hot access paths; --without-indexes drops them to compare plans.
+HOT_INDEXES = (
+    (Message, 'message_history_idx'),
+    (Message, 'message_unread_idx'),
+    (Conversation, 'conversation_name_type_idx'),
+)
+
+
+class Command(BaseCommand):
+    help = "Seed a large message table and report query plans and latencies of the consumer and view queries."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--users", type=int, default=2000)
+        parser.add_argument("--conversations", type=int, default=5000, help="Personal conversations to seed.")
+        parser.add_argument("--groups", type=int, default=200, help="Group conversations of 20 members to seed.")
+        parser.add_argument("--repeat", type=int, default=50, help="Runs of every query.")
+        parser.add_argument("--without-indexes", action="store_true", help="Drop the hot-path indexes first.")
+        parser.add_argument("--no-explain", action="store_true", help="Only print latencies.")
+        parser.add_argument("--in-memory", action="store_true", help="Use the in-memory test database.")
+
+    def handle(self, *args, **options):
+        database_name = None
+        if not options["in_memory"]:
+            database_name = os.path.join(tempfile.mkdtemp(), "bench_queries.sqlite3")
+
+        with bench_environment(database_name=database_name):
+            with Timer() as seed:
+                user, conversation, group = self.seed(options)
+            self.stdout.write(f"seeded {Message.objects.count()} messages in {seed.elapsed:.1f}s")
+
+            if options["without_indexes"]:
+                with connection.schema_editor() as editor:
+                    for model, name in HOT_INDEXES:
+                        editor.remove_index(model, next(i for i in model._meta.indexes if i.name == name))
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+            for label, queryset in self.queries(user, conversation, group):
+                timings = []
+                for _ in range(options["repeat"]):
+                    with Timer() as timer:
+                        list(queryset.all())
+                    timings.append(timer.elapsed * 1000)
+                timings.sort()
+                p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+                self.stdout.write(f"{label:34} p50={statistics.median(timings):8.3f}ms p99={p99:8.3f}ms")
+                if not options["no_explain"]:
+                    for line in queryset.explain().splitlines():
+                        self.stdout.write(f"    {line}")
+
+    def seed(self, options):
+        rng = random.Random(0)
+        users = [user for user, _ in create_users(options["users"])]
+        Through = Conversation.users.through
+
+        conversations = Conversation.objects.bulk_create(
+            [Conversation(type="personal", name=f"bench-personal-{i}") for i in range(options["conversations"])]
+            + [Conversation(type="group", name=f"bench-group-{i}") for i in range(options["groups"])]
+        )
+        members = {}
+        for conversation in conversations:
+            size = 2 if conversation.type == "personal" else 20
+            members[conversation.id] = rng.sample(users, size)
+        Through.objects.bulk_create(
+            [Through(conversation_id=c_id, user_id=user.id) for c_id, users_ in members.items() for user in users_],
+            batch_size=10000,
+        )
+        Membership.objects.bulk_create(
+            [Membership(conversation_id=c_id, user_id=user.id) for c_id, users_ in members.items() for user in users_],
+            batch_size=10000, ignore_conflicts=True,
+        )
+
+        # Messages go to conversations with a skewed distribution, a few of them get very long histories.
+        weights = [1 / (rank + 1) for rank in range(len(conversations))]
+        start = timezone.now() - timedelta(days=365)
+        step = timedelta(days=365) / options["messages"]
+        remaining, offset = options["messages"], 0
+        while remaining:
+            chunk = min(remaining, 50000)
+            batch = []
+            for conversation in rng.choices(conversations, weights, k=chunk):
+                sender, recipient = rng.sample(members[conversation.id], 2)
+                batch.append(Message(
+                    conversation_id=conversation.id, sender=sender,
+                    recipient=recipient if conversation.type == "personal" else None,
+                    content="bench message", created_at=start + step * offset,
+                    # Only the newest messages are still unread, like in a live deployment.
+                    read=offset < options["messages"] * 0.999,
+                ))
+                offset += 1
+            Message.objects.bulk_create(batch, batch_size=5000)
+            remaining -= chunk
+        Conversation.objects.rebuild_activity()
+
+        # Query as a member of the busiest personal conversation and the busiest group.
+        conversation, group = conversations[0], conversations[options["conversations"]]
+        return members[conversation.id][0], conversation, group
+
+    def queries(self, user, conversation, group):
+        messages = conversation.messages.all()
+        newest = list(messages.order_by("-created_at", "-id")[:1000])
+        middle, recent = newest[-1], newest[20]
+        page = 51
+
+        return (
+            ("consumer: history page", messages.order_by("-created_at", "-id")[:page]),
+            ("consumer: load_more", messages.before(middle.created_at, middle.id)[:page]),
+            ("consumer: resume", messages.after(recent.created_at, recent.id)[:page]),
+            ("consumer: unread rows on read", messages.filter(recipient=user, read=False).order_by()),
+            ("consumer: unread counts",
+             Conversation.objects.filter(memberships__user=user).order_by("-created_at")
+             .values_list("id", "memberships__unread_count")),
+            ("consumer: group lookup",
+             Conversation.objects.filter(users__in=[group.users.first()], type__in=["group"], name__in=[group.name])),
+            ("view: conversation list",
+             Conversation.objects.with_list_fields(user).filter(memberships__user=user)
+             .order_by("-last_activity_at", "-id")),
+            ("view: conversation by name",
+             Conversation.objects.filter(name__contains=user.username, name=conversation.name).values_list("id")),
+            ("view: messages by conversation name",
+             Message.objects.filter(conversation_id__in=[conversation.id]).order_by("-created_at", "-id")[:page]),
+        )
@@ -0,0 +1,194 @@
+import itertools
+import os
+import random
+import statistics
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+
+from main.models import Conversation, Membership, Message, User
+from main.search import DatabaseMessageSearch, DatabaseUserSearch, FTS5MessageSearch, FTS5UserSearch
+
+from ._bench import Timer, bench_environment
+
+FIRST_NAMES = ["Ada", "Charles", "Grace", "Alan", "Barbara", "Edsger", "Frances", "Donald", "Radia", "Ken",
+               "Margaret", "John", "Katherine", "Dennis", "Adele", "Niklaus", "Sophie", "Tim", "Hedy", "Linus"]
+LAST_NAMES = ["Lovelace", "Babbage", "Hopper", "Turing", "Liskov", "Dijkstra", "Allen", "Knuth", "Perlman",
+              "Thompson", "Hamilton", "McCarthy", "Johnson", "Ritchie", "Goldberg", "Wirth", "Wilson", "Lamarr"]
+
+# Message words follow a Zipf distribution over VOCABULARY_SIZE words; these get the given ranks.
+VOCABULARY_SIZE = 10000
+RANKED_WORDS = {"engine": 10, "budget": 200, "review": 300, "turbine": 5000}
+
+MESSAGE_QUERIES = (
+    ("common word", "engine"),
+    ("rare word", "turbine"),
+    ("two words", "budget review"),
+    ("no match", "zzqx"),
+)
+
+QUERIES = (
+    ("common substring", "ada"),
+    ("rare substring", "lamarr7"),
+    ("two terms", "grace hop"),
+    ("no match", "zzqx"),
+    ("short prefix", "ad"),
+    ("directory", ""),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed large user and message tables and report the latency of user and message search "
+        "pages, the index rebuild and incremental indexing per backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000000)
+        parser.add_argument("--messages", type=int, default=1000000, help="0 skips the message search runs.")
+        parser.add_argument("--conversations", type=int, default=5000, help="Personal conversations to seed.")
+        parser.add_argument("--repeat", type=int, default=50, help="Runs of every query.")
+        parser.add_argument("--pages", type=int, default=5, help="Pages followed per run.")
+        parser.add_argument("--in-memory", action="store_true", help="Use the in-memory test database.")
+
+    def handle(self, *args, **options):
+        database_name = None
+        if not options["in_memory"]:
+            database_name = os.path.join(tempfile.mkdtemp(), "bench_search.sqlite3")
+
+        with bench_environment(database_name=database_name):
+            with Timer() as seed:
+                self.seed(max(options["users"], 2000))
+            self.stdout.write(f"seeded {User.objects.count()} users in {seed.elapsed:.1f}s")
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+            for backend in (FTS5UserSearch(), DatabaseUserSearch()):
+                self.stdout.write(type(backend).__name__)
+                for label, query in QUERIES:
+                    self.report(label, query, backend.search, {}, options)
+
+            if options["messages"]:
+                self.bench_messages(options)
+
+    def bench_messages(self, options):
+        with Timer() as seed:
+            users = self.seed_messages(options)
+        self.stdout.write(f"seeded {Message.objects.count()} messages in {seed.elapsed:.1f}s")
+
+        search = FTS5MessageSearch()
+        with Timer() as rebuild:
+            search.rebuild()
+        self.stdout.write(f"rebuilt the index in {rebuild.elapsed:.1f}s, "
+                          f"{options['messages'] / rebuild.elapsed:.0f} messages/s")
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+        for backend in (search, DatabaseMessageSearch()):
+            self.stdout.write(type(backend).__name__)
+            for user in users:
+                conversations = Membership.objects.filter(user=user).count()
+                for label, query in MESSAGE_QUERIES:
+                    self.report(f"{label}, {conversations} chats", query, backend.search, {"user": user}, options)
+
+        # Incremental indexing: the cost `store` pays for keeping the index current.
+        conversation = Conversation.objects.filter(memberships__user=users[0]).first()
+        for label, indexed in (("store, indexed", True), ("store, not indexed", False)):
+            index = search.index
+            if not indexed:
+                search.index = lambda messages: None
+            timings = []
+            for i in range(200):
+                with Timer() as timer:
+                    Message.objects.store(conversation, users[0], f"engine room incremental {i}")
+                timings.append(timer.elapsed * 1000)
+            search.index = index
+            self.stdout.write(f"{label:24} p50={statistics.median(timings):8.3f}ms")
+
+    def report(self, label, query, search, filters, options):
+        first_pages, next_pages = [], []
+        for _ in range(options["repeat"]):
+            cursor = None
+            for page in range(options["pages"]):
+                with Timer() as timer:
+                    _, cursor = search(query, cursor, limit=20, **filters)
+                (next_pages if page else first_pages).append(timer.elapsed * 1000)
+                if cursor is None:
+                    break
+        self.stdout.write(
+            f"  {label:28} {query!r:16} first page p50={statistics.median(first_pages):8.3f}ms "
+            f"max={max(first_pages):8.3f}ms"
+            + (f"  next pages p50={statistics.median(next_pages):8.3f}ms" if next_pages else "")
+        )
+
+    def seed(self, count):
+        rng = random.Random(0)
+        batch = []
+        for i in range(count):
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            batch.append(User(
+                username=f"{first_name.lower()}.{last_name.lower()}{i}",
+                first_name=first_name,
+                last_name=last_name,
+            ))
+            if len(batch) == 50000:
+                User.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        User.objects.bulk_create(batch, batch_size=5000)
+
+    def seed_messages(self, options):
+        """
+        Seed personal conversations between the first 2000 users and messages over
+        them, and return a user in a few conversations and one in many.
+        """
+        rng = random.Random(0)
+        users = list(User.objects.order_by("id")[:2000])
+        # The first user talks to a quarter of everyone, the others to a handful of people.
+        pairs = {(users[0], other) for other in users[1:500]}
+        while len(pairs) < options["conversations"]:
+            first, second = rng.sample(users[1:], 2)
+            pairs.add((first, second))
+        conversations = Conversation.objects.bulk_create(
+            [Conversation(type="personal", name=f"bench-{i}") for i in range(len(pairs))]
+        )
+        Through = Conversation.users.through
+        members = {conversation.id: pair for conversation, pair in zip(conversations, pairs)}
+        Through.objects.bulk_create(
+            [Through(conversation_id=c_id, user_id=user.id) for c_id, pair in members.items() for user in pair],
+            batch_size=10000,
+        )
+        Membership.objects.bulk_create(
+            [Membership(conversation_id=c_id, user_id=user.id) for c_id, pair in members.items() for user in pair],
+            batch_size=10000, ignore_conflicts=True,
+        )
+
+        vocabulary = [f"word{rank}" for rank in range(VOCABULARY_SIZE)]
+        for word, rank in RANKED_WORDS.items():
+            vocabulary[rank] = word
+        cumulative_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY_SIZE)))
+
+        conversation_ids = list(members)
+        remaining = options["messages"]
+        while remaining:
+            chunk = min(remaining, 50000)
+            batch = []
+            for _ in range(chunk):
+                conversation_id = rng.choice(conversation_ids)
+                sender, recipient = members[conversation_id]
+                words = rng.choices(vocabulary, cumulative_weights, k=8)
+                batch.append(Message(conversation_id=conversation_id, sender=sender, recipient=recipient,
+                                     content=" ".join(words)))
+            Message.objects.bulk_create(batch, batch_size=5000)
+            remaining -= chunk
+
+        quiet = (
+            User.objects.filter(id__gt=users[0].id, id__lte=users[-1].id)
+            .annotate(conversation_count=Count("memberships"))
+            .filter(conversation_count__gte=3)
+            .order_by("id")
+            .first()
+        )
+        # Small seeds may leave everyone but the first user in fewer conversations.
+        return [quiet or users[1], users[0]]
@@ -0,0 +1,81 @@
+import asyncio
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+from main.models import Conversation
+
+from ._bench import Timer, bench_environment, create_users, websocket_application
+
+
+class Command(BaseCommand):
+    help = "Measure how many chat sockets and messages per second one process handles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=200, help="Number of concurrent chat sockets.")
+        parser.add_argument("--messages", type=int, default=20, help="Messages sent by every socket.")
+        parser.add_argument(
+            "--frame", choices=("chat_message", "typing"), default="chat_message",
+            help="Frame type to send; typing frames skip the database and isolate consumer overhead. "
+                 "They are broadcast one by one, without coalescing.",
+        )
+
+    def handle(self, *args, **options):
+        sockets = options["sockets"] - options["sockets"] % 2
+        with bench_environment():
+            users = create_users(sockets)
+            for first, second in zip(users[::2], users[1::2]):
+                Conversation.objects.get_or_create_personal_conversation(first[0], second[0])
+            results = asyncio.run(self.run(users, options["messages"], options["frame"]))
+
+        self.stdout.write(
+            "sockets={sockets} connect={connect:.3f}s ({connects_per_sec:.0f}/s) "
+            "messages={messages} deliver={deliver:.3f}s ({messages_per_sec:.0f} msg/s)".format(**results)
+        )
+
+    async def run(self, users, messages, frame_type):
+        application = websocket_application(coalesce_typing=frame_type != "typing")
+        communicators = []
+        for index, (user, token) in enumerate(users):
+            peer = users[index ^ 1][0]
+            communicators.append(
+                WebsocketCommunicator(application, f"/ws/chat/{peer.username}/?token={token}")
+            )
+
+        with Timer() as connect:
+            await asyncio.gather(*(communicator.connect(timeout=60) for communicator in communicators))
+
+        # Every message is delivered to both sockets of its personal conversation.
+        expected = 2 * messages
+
+        async def send(communicator):
+            for i in range(messages):
+                if frame_type == "typing":
+                    await communicator.send_json_to({"type": "typing", "typing": bool(i % 2)})
+                else:
+                    await communicator.send_json_to({"type": "chat_message", "message": f"message {i}"})
+
+        async def drain(communicator):
+            received = 0
+            while received < expected:
+                frame = await communicator.receive_json_from(timeout=60)
+                if frame["type"] == frame_type:
+                    received += 1
+
+        with Timer() as deliver:
+            await asyncio.gather(
+                *(send(communicator) for communicator in communicators),
+                *(drain(communicator) for communicator in communicators),
+            )
+
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+        delivered = expected * len(communicators)
+        return {
+            "sockets": len(communicators),
+            "connect": connect.elapsed,
+            "connects_per_sec": len(communicators) / connect.elapsed,
+            "messages": delivered,
+            "deliver": deliver.elapsed,
+            "messages_per_sec": delivered / deliver.elapsed,
+        }
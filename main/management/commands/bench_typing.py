@@ -0,0 +1,83 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from main.models import Conversation
+
+from ._bench import Timer, bench_environment, create_users, websocket_application
+
+
+class Command(BaseCommand):
+    help = "Count the typing events a busy room puts on the channel layer, with and without coalescing."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=100, help="Sockets in the room.")
+        parser.add_argument("--typists", type=int, default=10, help="Members typing at the same time.")
+        parser.add_argument("--bursts", type=int, default=3, help="Bursts of keystrokes per typist.")
+        parser.add_argument("--keystrokes", type=int, default=30, help="Keystrokes per burst.")
+        parser.add_argument("--interval", type=float, default=0.02, help="Seconds between keystrokes.")
+        parser.add_argument("--pause", type=float, default=0.2, help="Seconds between bursts.")
+        parser.add_argument("--timeout", type=float, default=5.0)
+        parser.add_argument("--debounce", type=float, default=0.5)
+
+    def handle(self, *args, **options):
+        typing_settings = {"TIMEOUT": options["timeout"], "DEBOUNCE": options["debounce"]}
+        with bench_environment(), override_settings(CONVO_TYPING=typing_settings):
+            users = create_users(options["members"])
+            room = Conversation.objects.create(type="group", name="bench-room")
+            room.users.add(*(user for user, _ in users))
+
+            frames = options["typists"] * options["bursts"] * (options["keystrokes"] + 1)
+            self.stdout.write(f"members={options['members']} typists={options['typists']} typing frames sent={frames}")
+            for name, coalesce in (("every frame", False), ("coalesced", True)):
+                results = asyncio.run(self.run(users, room, coalesce, options))
+                self.stdout.write(
+                    "{name:12} layer sends={sends:6} frames delivered={delivered:8} "
+                    "all delivered after {elapsed:.2f}s".format(name=name, **results)
+                )
+
+    async def run(self, users, room, coalesce, options):
+        layer = get_channel_layer()
+        layer_group_send = layer.group_send
+        sends = 0
+
+        async def group_send(group, message):
+            nonlocal sends
+            if message["type"] == "typing":
+                sends += 1
+            await layer_group_send(group, message)
+
+        layer.group_send = group_send
+        application = websocket_application(coalesce_typing=coalesce)
+        communicators = [
+            WebsocketCommunicator(application, f"/ws/chat/room/{room.name}/?token={token}") for _, token in users
+        ]
+        await asyncio.gather(*(communicator.connect(timeout=60) for communicator in communicators))
+
+        async def drain(communicator):
+            # Every member, the typist included, gets every typing event put on the layer.
+            received = 0
+            while received < sends or not await communicator.receive_nothing(timeout=0.05):
+                if (await communicator.receive_json_from(timeout=120))["type"] == "typing":
+                    received += 1
+            return received
+
+        async def type_bursts(communicator):
+            for _ in range(options["bursts"]):
+                for _ in range(options["keystrokes"]):
+                    await communicator.send_json_to({"type": "typing", "typing": True})
+                    await asyncio.sleep(options["interval"])
+                await communicator.send_json_to({"type": "typing", "typing": False})
+                await asyncio.sleep(options["pause"])
+
+        with Timer() as timer:
+            await asyncio.gather(*(type_bursts(communicator) for communicator in communicators[:options["typists"]]))
+            # Let held-back stops go out before counting.
+            await asyncio.sleep(options["debounce"] + 0.1)
+            delivered = sum(await asyncio.gather(*(drain(communicator) for communicator in communicators)))
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        layer.group_send = layer_group_send
+        return {"sends": sends, "delivered": delivered, "elapsed": timer.elapsed}
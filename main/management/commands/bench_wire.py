@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import codec, wire
+from main.consumers import ChatConsumer
+from main.models import Conversation, Message, User
+from main.serializers import MessageSerializer
+
+from ._bench import Timer, bench_environment
+
+FIRST_NAMES = ["Ada", "Charles", "Grace", "Alan", "Barbara", "Edsger", "Frances", "Donald", "Radia", "Ken"]
+LAST_NAMES = ["Lovelace", "Babbage", "Hopper", "Turing", "Liskov", "Dijkstra", "Allen", "Knuth", "Perlman", "Thompson"]
+
+
+class Command(BaseCommand):
+    help = "Compare bytes and CPU of JSON and MessagePack frames for the traffic of a busy room."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Members of the room.")
+        parser.add_argument("--messages", type=int, default=1000, help="Chat messages received by the socket.")
+        parser.add_argument("--typing", type=int, default=2, help="Typing events per chat message.")
+
+    def handle(self, *args, **options):
+        if wire.msgpack is None:
+            self.stderr.write("msgpack is not installed.")
+            return
+
+        with bench_environment():
+            events = self.traffic(options)
+
+        self.stdout.write(
+            f"users={options['users']} messages={options['messages']} frames={len(events) + 1} "
+            f"codec={'orjson' if codec.orjson else 'json'}"
+        )
+        sender = ChatConsumer()
+        layer_messages = [sender.layer_message(event) for event in events[1:]]
+        with Timer() as json_encode:
+            for event in events[1:]:
+                codec.dumps(event)
+        with Timer() as both_encode:
+            for event in events[1:]:
+                sender.layer_message(event)
+        per_event = 1e6 / (len(events) - 1)
+        self.stdout.write(
+            f"sender encode per broadcast: json {json_encode.elapsed * per_event:.2f} us, "
+            f"json + packed {both_encode.elapsed * per_event:.2f} us"
+        )
+
+        for name, packed in (("json", False), ("msgpack", True)):
+            frames, elapsed = asyncio.run(self.receive(events[0], layer_messages, packed))
+            size = sum(len(frame) for frame in frames)
+            decode = wire.unpack if packed else codec.loads
+            started = time.perf_counter()
+            for frame in frames:
+                decode(frame)
+            decoded = time.perf_counter() - started
+            self.stdout.write(
+                f"{name:8} {size / 1024:9.1f} KiB {size / len(frames):7.1f} B/frame "
+                f"server {elapsed / len(frames) * 1e6:6.2f} us/frame "
+                f"client decode {decoded / len(frames) * 1e6:6.2f} us/frame"
+            )
+
+    def traffic(self, options):
+        """
+        Return the events one member of a busy room receives: the history page
+        on connect, then chat messages interleaved with typing and read receipts.
+        """
+        users = User.objects.bulk_create([
+            User(
+                username=f"{FIRST_NAMES[i % 10].lower()}{i}",
+                first_name=FIRST_NAMES[i % 10],
+                last_name=LAST_NAMES[i // 10 % 10],
+                email=f"{FIRST_NAMES[i % 10].lower()}{i}@example.com",
+            )
+            for i in range(options["users"])
+        ])
+        room = Conversation.objects.create(type="group", name="bench-room")
+        room.users.add(*users)
+        for i in range(50 + options["messages"]):
+            sender = users[i % len(users)]
+            Message.objects.store(room, sender, f"Message {i} from {sender.first_name}, about the engine room schedule.")
+
+        messages = list(room.messages.order_by("created_at", "id"))
+        history = MessageSerializer(messages[:50][::-1], many=True).data
+        events = [{"type": "last_50_messages", "messages": history, "has_more": True, "cursor": "cursor"}]
+        for i, data in enumerate(MessageSerializer(messages[50:], many=True).data):
+            sender = data["sender"]["username"]
+            for typing in range(options["typing"]):
+                events.append({"type": "typing", "user": sender, "typing": typing == 0})
+            events.append({"type": "chat_message", "message": data, "conversation_id": room.id})
+            if i % 10 == 9:
+                events.append({"type": "seen_message", "user": users[(i + 1) % len(users)].username})
+        return events
+
+    async def receive(self, history, layer_messages, packed):
+        frames = []
+
+        async def base_send(message):
+            frames.append(message.get("bytes") or message["text"].encode())
+
+        consumer = ChatConsumer()
+        consumer.base_send = base_send
+        consumer.packed = packed
+        with Timer() as timer:
+            await consumer.send_json(history)
+            for message in layer_messages:
+                await consumer.send_event(message)
+                # Let the writer task send it.
+                await asyncio.sleep(0)
+        return frames, timer.elapsed
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import tempfile
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+
+from main.models import Conversation, Message
+from main.writebehind import MessageWriter
+
+from ._bench import Timer, bench_environment, create_users
+
+
+class Command(BaseCommand):
+    help = "Compare message write throughput of per-message inserts and write-behind batching."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--senders", type=int, default=50, help="Concurrent senders.")
+        parser.add_argument("--messages", type=int, default=40, help="Messages per sender.")
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--flush-interval", type=float, default=0.05)
+        parser.add_argument("--in-memory", action="store_true", help="Use the in-memory test database.")
+
+    def handle(self, *args, **options):
+        database_name = None
+        if not options["in_memory"]:
+            database_name = os.path.join(tempfile.mkdtemp(), "bench_writes.sqlite3")
+
+        with bench_environment(database_name=database_name):
+            users = [user for user, _ in create_users(options["senders"] + 1)]
+            conversation = Conversation.objects.create(type="group", name="bench")
+            conversation.users.add(*users)
+
+            modes = (
+                ("per-message create", None),
+                ("write-behind", {"flush_before_ack": False}),
+                ("write-behind, flush before ack", {"flush_before_ack": True}),
+            )
+            for name, writer_options in modes:
+                Message.objects.all().delete()
+                elapsed = asyncio.run(self.run(conversation, users[1:], options, writer_options))
+                count = Message.objects.count()
+                self.stdout.write(f"{name:32} {count} messages in {elapsed:.3f}s ({count / elapsed:,.0f} msg/s)")
+
+    async def run(self, conversation, senders, options, writer_options):
+        store = database_sync_to_async(Message.objects.store)
+        writer = None
+        if writer_options is not None:
+            writer = MessageWriter(
+                batch_size=options["batch_size"], flush_interval=options["flush_interval"], worker_id=0,
+                **writer_options
+            )
+
+        async def send(sender):
+            for i in range(options["messages"]):
+                if writer is None:
+                    await store(conversation, sender, f"message {i}")
+                else:
+                    await writer.submit(writer.prepare(
+                        Message(conversation=conversation, sender=sender, content=f"message {i}")
+                    ))
+
+        with Timer() as timer:
+            await asyncio.gather(*(send(sender) for sender in senders))
+            if writer is not None:
+                await writer.flush()
+        return timer.elapsed
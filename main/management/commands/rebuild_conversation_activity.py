@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main.conversation_cache import get_conversation_cache
+from main.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Recompute every conversation's last message pointer and last activity time."
+
+    def handle(self, *args, **options):
+        updated = Conversation.objects.rebuild_activity()
+        # Cached conversation lists show the old last messages.
+        get_conversation_cache().clear()
+        self.stdout.write(f"Updated {updated} conversations.")
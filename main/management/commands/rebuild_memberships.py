@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Conversation, Membership
+
+
+class Command(BaseCommand):
+    help = "Recreate membership rows, unread counters and read watermarks from existing messages."
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.order_by("id")
+        Membership.objects.rebuild(conversations)
+        self.stdout.write(f"Rebuilt memberships for {conversations.count()} conversations.")
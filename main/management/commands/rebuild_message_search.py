@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+
+from main.models import Message
+from main.search import get_message_search
+
+
+class Command(BaseCommand):
+    help = "Create the message search index if needed and index every message again, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Messages indexed per transaction.")
+
+    def handle(self, *args, **options):
+        search = get_message_search()
+        if options["batch_size"]:
+            search.batch_size = options["batch_size"]
+        if hasattr(search, "install"):
+            # A new index is filled by install itself.
+            connection = connections[router.db_for_write(Message)]
+            if not search.is_installed(connection):
+                search.install(connection)
+                self.stdout.write("Created and filled the message search index.")
+                return
+        search.rebuild(progress=lambda indexed: self.stdout.write(f"Indexed {indexed} messages."))
+        self.stdout.write("Rebuilt the message search index.")
@@ -0,0 +1,154 @@
+"""
+Process-local metrics.
+
+Counters, gauges and histograms are kept in memory per worker process and
+keyed by their label values. They are cheap enough to update from hot paths:
+one lock acquisition and a dict update. `REGISTRY.render()` returns them in
+the Prometheus text format.
+"""
+import bisect
+import threading
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        """
+        Return (suffix, labels, value) tuples.
+        """
+        with self.lock:
+            return [('', dict(key), value) for key, value in self.values.items()]
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, buckets=None, registry=None):
+        super().__init__(name, documentation, registry=registry)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, **labels):
+        """
+        Return (count, sum) of the observations.
+        """
+        entry = self.values.get(self.key(labels))
+        return (entry[2], entry[1]) if entry else (0, 0.0)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            entries = [(dict(key), list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for labels, counts, total, count in entries:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append(('_bucket', {**labels, 'le': le}, cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self.metrics[metric.name] = metric
+
+    def snapshot(self):
+        """
+        Return {sample name: {label tuple: value}} for every metric.
+        """
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            for suffix, labels, value in metric.samples():
+                snapshot.setdefault(name + suffix, {})[tuple(sorted(labels.items()))] = value
+        return snapshot
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{name}{suffix}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
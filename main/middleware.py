@@ -1,57 +1,15 @@
-from django.contrib.auth import get_user_model
-from django.utils.translation import gettext_lazy as _
 from rest_framework.exceptions import AuthenticationFailed
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
 
-User = get_user_model()
+from .authentication import CachedTokenAuthentication, get_token_cache
 
 
-class TokenAuthentication:
-    """
-    Simple token based authentication.
-
-    Clients should authenticate by passing the token key in the query parameters.
-    For example:
-
-        ?token=401f7ac837da42b97f613d789819ff93537bee6a
-    """
-
-    model = None
-
-    def get_model(self):
-        if self.model is not None:
-            return self.model
-        from rest_framework.authtoken.models import Token
-        return Token
-
-    """
-    A custom token model may be used, but must have the following properties.
-
-    * key -- The string identifying the token
-    * user -- The user to which the token belongs
-    """
-
-    def authenticate_credentials(self, key):
-        model = self.get_model()
-        try:
-            token = model.objects.select_related("user").get(key=key)
-        except model.DoesNotExist:
-            raise AuthenticationFailed(_("Invalid token."))
-
-        if not token.user.is_active:
-            raise AuthenticationFailed(_("User inactive or deleted."))
-
-        return token.user
-
-
-
-
-@database_sync_to_async
-def get_user(scope):
+async def get_user(scope):
     """
     Return the user model instance associated with the given scope.
     If no user is retrieved, return an instance of `AnonymousUser`.
+    Cached tokens are resolved without leaving the event loop.
     """
     # postpone model import to avoid ImproperlyConfigured error before Django
     # setup is complete.
@@ -64,9 +22,13 @@ def get_user(scope):
         )
     token = scope["token"]
     user = None
+    auth = CachedTokenAuthentication()
     try:
-        auth = TokenAuthentication()
-        user = auth.authenticate_credentials(token)
+        cached = get_token_cache().get(token)
+        if cached is not None:
+            user = cached[0]
+        else:
+            user, _ = await database_sync_to_async(auth.load_credentials)(token)
     except AuthenticationFailed:
         pass
     return user or AnonymousUser()
@@ -1,9 +1,13 @@
-from django.db import models
+from collections import Counter
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
-from django.db.models import Count
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Lower
 from django.conf import settings
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db.models.signals import post_save, m2m_changed
+from django.dispatch import Signal, receiver
 from rest_framework.authtoken.models import Token
 
 
@@ -16,6 +20,12 @@ class User(AbstractUser):
     last_conversation = models.CharField(max_length=4, blank=True, null=True)
     friends = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Short username prefix searches, see main/search.py.
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+        ]
+
     @receiver(post_save, sender=settings.AUTH_USER_MODEL)
     def create_auth_token(sender, instance=None, created=False, **kwargs):
         if created:
@@ -32,7 +42,8 @@ class Request(models.Model):
 
 
 class TrackingModel(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so rows written in bulk can keep a timestamp assigned before the insert.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
@@ -40,19 +51,59 @@ class TrackingModel(models.Model):
 
 
 class ConversationManager(models.Manager):
-    def get_or_create_personal_conversation(self, first_user, second_user):
-        conversations = self.get_queryset().filter(type='personal').filter(users__in=[first_user, second_user]).distinct()
-        conversations = conversations.annotate(u_count=Count('users')).filter(u_count=2)
+    def pair_key(self, first_user, second_user):
+        """
+        Return the key shared by both orderings of a pair of users.
+        """
+        return ':'.join(str(pk) for pk in sorted((first_user.pk, second_user.pk)))
 
-        if conversations.exists():
-            return conversations.first()
-        else:
-            conversation = self.create(type='personal', name=f'{first_user}__{second_user}')
-            conversation.users.add(first_user)
-            conversation.users.add(second_user)
-            conversation.name = f'{first_user}__{second_user}'
+    def get_or_create_personal_conversation(self, first_user, second_user):
+        """
+        Look the conversation up by its pair key. When two calls race to create it,
+        the unique index rejects the second insert and it returns the winner's row.
+        """
+        pair_key = self.pair_key(first_user, second_user)
+        conversation = self.get_queryset().filter(pair_key=pair_key).first()
+        if conversation is not None:
             return conversation
 
+        try:
+            with transaction.atomic():
+                conversation = self.create(type='personal', name=f'{first_user}__{second_user}', pair_key=pair_key)
+                conversation.users.add(first_user, second_user)
+        except IntegrityError:
+            return self.get_queryset().get(pair_key=pair_key)
+        return conversation
+
+    def backfill_pair_keys(self):
+        """
+        Set the pair key of personal conversations created before it existed.
+
+        When a pair already has several conversations the oldest one keeps the key
+        and the others are left without it. Returns (updated, duplicates).
+        """
+        updated, duplicates = 0, 0
+        taken = set(self.get_queryset().exclude(pair_key=None).values_list('pair_key', flat=True))
+        members = Conversation.users.through.objects.filter(
+            conversation__type='personal', conversation__pair_key=None
+        ).order_by('conversation_id').values_list('conversation_id', 'user_id')
+        users = {}
+        for conversation_id, user_id in members:
+            users.setdefault(conversation_id, []).append(user_id)
+        for conversation_id, user_ids in users.items():
+            if len(user_ids) == 1:
+                # A conversation with oneself.
+                user_ids = user_ids * 2
+            if len(user_ids) != 2:
+                continue
+            pair_key = ':'.join(str(pk) for pk in sorted(user_ids))
+            if pair_key in taken:
+                duplicates += 1
+                continue
+            taken.add(pair_key)
+            updated += self.get_queryset().filter(pk=conversation_id).update(pair_key=pair_key)
+        return updated, duplicates
+
     def get_or_create_group_conversation(self, user, room_name, group_type, desc, image, participants):
 
         print(user, room_name)
@@ -71,6 +122,43 @@ class ConversationManager(models.Manager):
 
             return conversation
 
+    def unread_counts(self, user):
+        """
+        Return the user's total unread count and a list of per-conversation counts,
+        computed with a single grouped query.
+        """
+        conversations_unread_counts = [
+            {"id": conversation_id, "count": count}
+            for conversation_id, count in self.get_queryset().filter(memberships__user=user)
+            .order_by("-created_at")
+            .values_list('id', 'memberships__unread_count')
+        ]
+        unread_count = sum(conversation['count'] for conversation in conversations_unread_counts)
+        return unread_count, conversations_unread_counts
+
+    def with_list_fields(self, user):
+        """
+        Annotate what ConservationSerializer needs for `user` as subqueries,
+        users_count and other_user_id, and join the last message.
+        """
+        members = Conversation.users.through.objects.filter(conversation_id=OuterRef('pk'))
+        users_count = members.order_by().values('conversation_id').annotate(count=Count('*')).values('count')
+        other_user = members.exclude(user_id=user.id).order_by('user_id').values('user_id')[:1]
+        return self.get_queryset().select_related('last_message').annotate(
+            users_count=Coalesce(Subquery(users_count), 0),
+            other_user_id=Subquery(other_user),
+        )
+
+    def rebuild_activity(self):
+        """
+        Recompute last_message and last_activity_at from Message rows.
+        """
+        latest = Message.objects.filter(conversation_id=OuterRef('pk')).order_by('-created_at', '-id')
+        return self.get_queryset().update(
+            last_message=Subquery(latest.values('id')[:1]),
+            last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+        )
+
     def by_user(self, user):
         return self.get_queryset().filter(users_in=[user])
 
@@ -84,20 +172,107 @@ class Conversation(TrackingModel):
     name = models.CharField(max_length=40, null=True, blank=True)
     type = models.CharField(max_length=15, choices=CONVERSATION_TYPE, default='group')
     users = models.ManyToManyField(User)
-    online = models.ManyToManyField(User, related_name="online_users", blank=True)
     group_type = models.CharField(max_length=10, null=True, blank=True)
     group_image = models.ImageField(blank=True, null=True)
     group_description = models.CharField(max_length=500, null=True, blank=True)
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, related_name='+', blank=True, null=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Sorted "<user id>:<user id>" of a personal conversation, null for groups.
+    pair_key = models.CharField(max_length=41, unique=True, blank=True, null=True, editable=False)
 
     objects = ConversationManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity_at'], name='conversation_activity_idx'),
+            # Serves lookups by name alone (MessageViewSet) as well as by (type, name).
+            models.Index(fields=['name', 'type'], name='conversation_name_type_idx'),
+        ]
+
     def __str__(self) -> str:
         if self.type == 'personal' and self.users.count() == 2:
             return f'{self.users.first()} and {self.users.last()}'
         return f'{self.name}'
 
     def get_unread_messages_count(self, user):
-        return self.messages.filter(recipient=user, read=False).count()
+        return self.memberships.filter(user=user).values_list('unread_count', flat=True).first() or 0
+
+
+# Sent with `messages` inside the transaction of `store` and `bulk_store`, e.g. to index them, see main/search.py.
+messages_stored = Signal()
+# Sent with `conversation` and `user` inside the transaction of `Membership.objects.mark_read` when it
+# marked messages read, see main/conversation_cache.py.
+messages_read = Signal()
+
+
+class MessageQuerySet(models.QuerySet):
+    def before(self, created_at, pk):
+        """
+        Messages strictly older than the (created_at, id) position, newest first.
+        """
+        # The redundant bound lets the (conversation, created_at, id) index seek to the cursor.
+        return self.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        ).order_by('-created_at', '-id')
+
+    def after(self, created_at, pk):
+        """
+        Messages strictly newer than the (created_at, id) position, oldest first.
+        """
+        return self.filter(created_at__gte=created_at).filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+        ).order_by('created_at', 'id')
+
+
+class MessageManager(models.Manager.from_queryset(MessageQuerySet)):
+    def store(self, conversation, sender, content, recipient=None):
+        """
+        Create a message, bump the unread counter of every other member and move
+        the conversation's last-message pointer.
+        """
+        with transaction.atomic():
+            message = self.create(conversation=conversation, sender=sender, recipient=recipient, content=content)
+            Membership.objects.filter(conversation=conversation).exclude(user=sender).update(
+                unread_count=F('unread_count') + 1
+            )
+            Conversation.objects.filter(pk=conversation.pk).update(
+                last_message=message, last_activity_at=message.created_at
+            )
+            messages_stored.send(sender=self.model, messages=[message])
+        conversation.last_message = message
+        conversation.last_activity_at = message.created_at
+        return message
+
+    def bulk_store(self, messages):
+        """
+        Insert messages whose id and created_at were assigned ahead of time and
+        apply the counter and pointer updates of `store` once per batch.
+        """
+        sent = Counter((message.conversation_id, message.sender_id) for message in messages)
+        latest = {}
+        for message in messages:
+            current = latest.get(message.conversation_id)
+            if current is None or (message.created_at, message.id) > (current.created_at, current.id):
+                latest[message.conversation_id] = message
+
+        with transaction.atomic():
+            self.bulk_create(messages)
+
+            # Every member's counter grows by the batch's messages in that conversation they didn't send.
+            for conversation_id in latest:
+                senders = {sender_id: count for (c_id, sender_id), count in sent.items() if c_id == conversation_id}
+                Membership.objects.filter(conversation_id=conversation_id).update(
+                    unread_count=F('unread_count') + sum(senders.values()) - Case(
+                        *[When(user_id=sender_id, then=Value(count)) for sender_id, count in senders.items()],
+                        default=Value(0),
+                    )
+                )
+            for conversation_id, message in latest.items():
+                Conversation.objects.filter(pk=conversation_id, last_activity_at__lte=message.created_at).update(
+                    last_message=message, last_activity_at=message.created_at
+                )
+            messages_stored.send(sender=self.model, messages=messages)
+        return messages
 
 
 class Message(TrackingModel):
@@ -108,12 +283,156 @@ class Message(TrackingModel):
     content = models.CharField(max_length=1000)
     status = models.CharField(max_length=10, default="sent")
     read = models.BooleanField(default=False)
-    seen = models.ManyToManyField(User, blank=True)
+
+    objects = MessageManager()
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # History pages, load_more and resume are range scans over (created_at, id) in one conversation.
+            models.Index(fields=['conversation', 'created_at', 'id'], name='message_history_idx'),
+            # Read receipts only touch the recipient's unread rows, a small slice of the table.
+            models.Index(fields=['recipient', 'conversation'], condition=Q(read=False), name='message_unread_idx'),
+        ]
 
     def __str__(self) -> str:
         if self.recipient:
             return f'{self.sender} -> {self.recipient} : {self.content} @ {self.created_at}'
         return f'{self.sender} -> {self.conversation.name} : {self.content} @ {self.created_at}'
+
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the Message table by `archive_messages`, see main/archive.py.
+
+    Rows keep the id and timestamps of the original message, so cursors and
+    search index entries stay valid after the move.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='archived_messages')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', blank=True, null=True)
+    content = models.CharField(max_length=1000)
+    status = models.CharField(max_length=10, default="sent")
+    read = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['conversation', 'created_at', 'id'], name='archived_message_history_idx'),
+        ]
+
+
+class MembershipManager(models.Manager):
+    def mark_read(self, user, conversation):
+        """
+        Move the user's read watermark to the newest message of the conversation.
+
+        Message rows are only rewritten while the member still has unread messages,
+        so repeated read receipts cost a single UPDATE. In a conversation with
+        oneself every message is the member's own, which `store` never counts,
+        so its messages are marked read without looking at the counter.
+        """
+        last_message_id = conversation.messages.order_by('-id').values_list('id', flat=True).first()
+        membership = self.filter(user=user, conversation=conversation)
+        unread = conversation.messages.filter(recipient=user, read=False)
+        with transaction.atomic():
+            if membership.filter(unread_count__gt=0).update(unread_count=0, last_read_message_id=last_message_id):
+                unread.update(read=True, status="seen")
+                messages_read.send(sender=Membership, conversation=conversation, user=user)
+            else:
+                membership.update(last_read_message_id=last_message_id)
+                if conversation.pair_key == Conversation.objects.pair_key(user, user) and unread.update(
+                        read=True, status="seen"):
+                    messages_read.send(sender=Membership, conversation=conversation, user=user)
+
+    def rebuild(self, conversations=None):
+        """
+        Recreate membership rows and unread counters from Conversation.users and Message rows.
+
+        Group messages have no recipient to mark them read, so a group member's
+        counter is recounted from the messages of others after their watermark,
+        which is kept as it is.
+        """
+        conversations = conversations if conversations is not None else Conversation.objects.all()
+        for conversation in conversations.iterator():
+            user_ids = list(conversation.users.values_list('id', flat=True))
+            last_message_id = conversation.messages.order_by('-id').values_list('id', flat=True).first()
+            with transaction.atomic():
+                self.filter(conversation=conversation).exclude(user_id__in=user_ids).delete()
+                self.bulk_create(
+                    [Membership(user_id=user_id, conversation=conversation) for user_id in user_ids],
+                    ignore_conflicts=True
+                )
+                if conversation.type == 'group':
+                    self.rebuild_group(conversation)
+                    continue
+                for user_id in user_ids:
+                    unread = conversation.messages.filter(recipient_id=user_id, read=False)
+                    first_unread_id = unread.order_by('id').values_list('id', flat=True).first()
+                    if first_unread_id is None:
+                        last_read_message_id = last_message_id
+                    else:
+                        last_read_message_id = conversation.messages.filter(id__lt=first_unread_id).order_by(
+                            '-id').values_list('id', flat=True).first()
+                        if last_read_message_id is None:
+                            # Everything read before it may have been archived, see main/archive.py.
+                            last_read_message_id = conversation.archived_messages.filter(
+                                id__lt=first_unread_id).order_by('-id').values_list('id', flat=True).first()
+                    self.filter(user_id=user_id, conversation=conversation).update(
+                        unread_count=unread.count(), last_read_message_id=last_read_message_id
+                    )
+
+    def rebuild_group(self, conversation):
+        for membership in self.filter(conversation=conversation):
+            unread = conversation.messages.exclude(sender_id=membership.user_id)
+            if membership.last_read_message_id is not None:
+                unread = unread.filter(id__gt=membership.last_read_message_id)
+            self.filter(pk=membership.pk).update(unread_count=unread.count())
+
+
+class Membership(models.Model):
+    """
+    One row per (user, conversation) holding the member's denormalized read state.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+
+    objects = MembershipManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='unique_membership'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.user} in {self.conversation} ({self.unread_count} unread)'
+
+
+@receiver(m2m_changed, sender=Conversation.users.through)
+def sync_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep a Membership row for every entry of Conversation.users.
+    """
+    if action == 'post_add':
+        if reverse:
+            memberships = [Membership(user=instance, conversation_id=pk) for pk in pk_set]
+        else:
+            memberships = [Membership(user_id=pk, conversation=instance) for pk in pk_set]
+        Membership.objects.bulk_create(memberships, ignore_conflicts=True)
+    elif action == 'post_remove':
+        if reverse:
+            Membership.objects.filter(user=instance, conversation_id__in=pk_set).delete()
+        else:
+            Membership.objects.filter(conversation=instance, user_id__in=pk_set).delete()
+    elif action == 'post_clear':
+        if reverse:
+            Membership.objects.filter(user=instance).delete()
+        else:
+            Membership.objects.filter(conversation=instance).delete()
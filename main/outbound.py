@@ -0,0 +1,174 @@
+"""
+Bounded outbound frame queues for websocket consumers.
+
+Consumers don't write frames from their handlers. They queue them, and one
+writer task per socket sends them in order. When a client reads slower than
+its frames arrive, the queue holds at most ``MAX_SIZE`` frames:
+
+* Frames of a merge group (typing state, presence, unread counts) only matter
+  in their latest version, so a new one replaces the queued one of the same user.
+* When the queue is full, typing and presence frames are dropped first.
+* Chat messages are never dropped. When one doesn't fit, the client is too far
+  behind to catch up: the queue is cleared and the client receives a
+  "resume_required" frame with the id of the last message it was sent, and the
+  socket is closed. The client reconnects with ``?resume=<id>``.
+
+If sending a frame fails, the queued frames are discarded and the socket is
+closed with ``abort``, so a client never stays connected without receiving.
+
+The queue only fills when the ASGI server applies backpressure to websocket
+sends; daphne buffers them itself.
+
+Configured with the ``CONVO_OUTBOUND_QUEUE`` setting::
+
+    CONVO_OUTBOUND_QUEUE = {
+        'MAX_SIZE': 256,
+    }
+"""
+import asyncio
+import logging
+from collections import deque
+
+from .metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 256,
+}
+
+# Close code of a socket that fell too far behind, in the range reserved for applications.
+RESUME_REQUIRED_CLOSE_CODE = 4008
+
+queued_frames = Gauge('convo_outbound_queued_frames', 'Frames waiting in outbound queues.')
+merged_frames = Counter('convo_outbound_merged_frames_total', 'Queued frames replaced by a newer version.')
+dropped_frames = Counter('convo_outbound_dropped_frames_total', 'Frames dropped from full outbound queues.')
+slow_disconnects = Counter('convo_outbound_slow_disconnects_total', 'Sockets closed for falling too far behind.')
+
+
+class Frame:
+    __slots__ = ('event_type', 'payload', 'merge_key', 'message_id')
+
+    def __init__(self, event_type, payload, merge_key=None, message_id=None):
+        self.event_type = event_type
+        self.payload = payload
+        self.merge_key = merge_key
+        self.message_id = message_id
+
+
+class OutboundQueue:
+    merge_groups = {
+        'typing': 'typing',
+        'user_join': 'presence',
+        'user_leave': 'presence',
+        'unread_count': 'unread_count',
+    }
+    droppable_events = frozenset({'typing', 'user_join', 'user_leave'})
+
+    def __init__(self, send, close, abort, max_size=256, **kwargs):
+        self.send = send
+        self.close = close
+        self.abort = abort
+        self.max_size = max_size
+        self.frames = deque()
+        self.merge_keys = {}
+        self.last_message_id = None
+        self.closing = False
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, event_type, payload, user=None, message_id=None):
+        """
+        Queue a frame, applying the merge and drop policies.
+        """
+        if self.closing:
+            return
+        merge_group = self.merge_groups.get(event_type)
+        merge_key = (merge_group, user) if merge_group is not None else None
+        if merge_key is not None and merge_key in self.merge_keys:
+            frame = self.merge_keys[merge_key]
+            frame.event_type, frame.payload = event_type, payload
+            merged_frames.inc(type=event_type)
+            return
+
+        if len(self.frames) >= self.max_size:
+            if event_type in self.droppable_events:
+                dropped_frames.inc(type=event_type)
+                return
+            if not self.drop_oldest_droppable():
+                self.overflow()
+                return
+
+        frame = Frame(event_type, payload, merge_key, message_id)
+        self.frames.append(frame)
+        if merge_key is not None:
+            self.merge_keys[merge_key] = frame
+        queued_frames.inc()
+        self.wakeup.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def drop_oldest_droppable(self):
+        for frame in self.frames:
+            if frame.event_type in self.droppable_events:
+                self.frames.remove(frame)
+                self.forget(frame)
+                dropped_frames.inc(type=frame.event_type)
+                return True
+        return False
+
+    def forget(self, frame):
+        queued_frames.dec()
+        if frame.merge_key is not None and self.merge_keys.get(frame.merge_key) is frame:
+            del self.merge_keys[frame.merge_key]
+
+    def overflow(self):
+        for frame in self.frames:
+            self.forget(frame)
+        dropped_frames.inc(len(self.frames), type='overflow')
+        self.frames.clear()
+        self.closing = True
+        slow_disconnects.inc()
+        logger.warning("Closing a socket that fell %d frames behind", self.max_size)
+        self.wakeup.set()
+
+    async def run(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.frames:
+                    frame = self.frames.popleft()
+                    self.forget(frame)
+                    await self.send(frame.payload)
+                    if frame.message_id is not None and (
+                            self.last_message_id is None or frame.message_id > self.last_message_id):
+                        self.last_message_id = frame.message_id
+                if self.closing:
+                    await self.close(self.last_message_id)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Outbound queue writer failed, closing the socket")
+            self.discard()
+            await self.abort()
+        finally:
+            self.task = None
+
+    def discard(self):
+        for frame in self.frames:
+            self.forget(frame)
+        self.frames.clear()
+        self.closing = True
+
+    def stop(self):
+        """
+        Stop writing, e.g. after the socket was closed. Queued frames are discarded.
+        """
+        if self.task is not None:
+            self.task.cancel()
+        self.discard()
@@ -1,7 +1,201 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
 
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
-class MessagePagination(PageNumberPagination):
+
+def encode_position(position):
+    return urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def decode_position(cursor):
+    """
+    Return the position string stored in a cursor, or raise ValueError.
+    """
+    try:
+        return urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (BinasciiError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor.")
+
+
+def encode_cursor(message):
+    """
+    Return an opaque cursor pointing at the (created_at, id) position of a message.
+    """
+    return encode_position(f"{message.created_at.isoformat()}|{message.id}")
+
+
+def decode_cursor(cursor):
+    """
+    Return the (created_at, id) position stored in a cursor, or raise ValueError.
+    """
+    try:
+        position = decode_position(cursor)
+        created_at, pk = position.rsplit("|", 1)
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except ValueError:
+        raise ValueError("Invalid cursor.")
+    if created_at is None:
+        raise ValueError("Invalid cursor.")
+    return created_at, pk
+
+
+class MessagePagination(BasePagination):
+    """
+    Keyset pagination over (created_at, id), newest messages first.
+
+    Pages a MessageHistory, see main/archive.py. `before` returns the page of
+    messages older than the cursor and `after` the page newer than it. Neither
+    needs an OFFSET or a COUNT, so every page costs one indexed range scan of
+    `page_size + 1` rows per tier it reaches.
+    """
     page_size = 50
     page_size_query_param = "page_size"
     max_page_size = 100
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor."
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_position(self, request, param):
+        cursor = request.query_params.get(param)
+        if not cursor:
+            return None
+        try:
+            return decode_cursor(cursor)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        before = self.get_position(request, self.before_query_param)
+        after = self.get_position(request, self.after_query_param)
+
+        if after is not None:
+            messages = queryset.after(*after, page_size + 1)
+            self.has_newer = len(messages) > page_size
+            self.has_older = True
+            messages = messages[:page_size][::-1]
+        else:
+            if before is not None:
+                messages = queryset.before(*before, page_size + 1)
+            else:
+                messages = queryset.newest(page_size + 1)
+            self.has_older = len(messages) > page_size
+            self.has_newer = before is not None
+            messages = messages[:page_size]
+
+        self.page = messages
+        return messages
+
+    def get_link(self, param, message):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, encode_cursor(message))
+
+    def get_next_link(self):
+        if not self.has_older or not self.page:
+            return None
+        return self.get_link(self.before_query_param, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        return self.get_link(self.after_query_param, self.page[0])
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class SearchPagination(BasePagination):
+    """
+    Pages of a user or message search, see main/search.py.
+
+    `q` is the search query and `cursor` the opaque position returned as the
+    `next` link of the previous page. Pages only go forward.
+    """
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    search_query_param = "q"
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor."
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def paginate_search(self, search, request, **filters):
+        """
+        Return the ids of the results on the requested page, passing `filters` to the search.
+        """
+        self.request = request
+        cursor = request.query_params.get(self.cursor_query_param)
+        query = request.query_params.get(self.search_query_param, "")
+        try:
+            ids, self.next_position = search.search(
+                query,
+                decode_position(cursor) if cursor else None,
+                limit=self.get_page_size(request),
+                **filters,
+            )
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        return ids
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encode_position(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
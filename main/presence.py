@@ -0,0 +1,151 @@
+"""
+Ephemeral presence tracking for chat conversations.
+
+Presence is kept out of the SQL database. Every open socket registers its
+channel name under the conversation with an expiry, and keeps refreshing it
+with a heartbeat while it stays connected. When a worker dies its entries
+stop being refreshed and expire after ``TTL`` seconds.
+
+The backend is configured with the ``CONVO_PRESENCE`` setting::
+
+    CONVO_PRESENCE = {
+        'BACKEND': 'main.presence.ChannelLayerPresence',
+        'TTL': 60,
+    }
+"""
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+DEFAULT_PRESENCE = {
+    'BACKEND': 'main.presence.InMemoryPresence',
+    'TTL': 60,
+}
+
+
+class BasePresence:
+    """
+    Presence entries are keyed by conversation and channel name, so a user with
+    several open sockets stays online until the last one goes away.
+    """
+
+    def __init__(self, ttl=60, **kwargs):
+        self.ttl = ttl
+
+    @property
+    def heartbeat_interval(self):
+        return self.ttl / 3
+
+    async def join(self, conversation_id, username, channel_name):
+        raise NotImplementedError
+
+    async def heartbeat(self, conversation_id, username, channel_name):
+        await self.join(conversation_id, username, channel_name)
+
+    async def leave(self, conversation_id, username, channel_name):
+        raise NotImplementedError
+
+    async def online(self, conversation_id):
+        """
+        Return the sorted usernames with at least one live entry.
+        """
+        raise NotImplementedError
+
+
+class InMemoryPresence(BasePresence):
+    """
+    Process-local presence. Only suitable when a single worker serves every socket.
+    """
+
+    def __init__(self, ttl=60, **kwargs):
+        super().__init__(ttl=ttl, **kwargs)
+        self.entries = {}
+
+    async def join(self, conversation_id, username, channel_name):
+        self.entries.setdefault(conversation_id, {})[channel_name] = (username, time.monotonic() + self.ttl)
+
+    async def leave(self, conversation_id, username, channel_name):
+        entries = self.entries.get(conversation_id)
+        if entries is None:
+            return
+        entries.pop(channel_name, None)
+        if not entries:
+            del self.entries[conversation_id]
+
+    async def online(self, conversation_id):
+        entries = self.entries.get(conversation_id, {})
+        now = time.monotonic()
+        for channel_name in [name for name, (_, expires) in entries.items() if expires <= now]:
+            del entries[channel_name]
+        return sorted({username for username, _ in entries.values()})
+
+
+class ChannelLayerPresence(BasePresence):
+    """
+    Presence stored next to the channel layer's own data, so every worker sees it.
+
+    Requires a Redis-backed layer (``channels_redis``). Each conversation is a
+    sorted set of ``<channel name>|<username>`` members scored by expiry time.
+    """
+
+    def __init__(self, ttl=60, alias='default', **kwargs):
+        super().__init__(ttl=ttl, **kwargs)
+        self.alias = alias
+
+    def get_connection(self, key):
+        layer = get_channel_layer(self.alias)
+        if not hasattr(layer, 'connection') or not hasattr(layer, 'consistent_hash'):
+            raise ImproperlyConfigured(
+                "ChannelLayerPresence needs a Redis-backed channel layer; "
+                "use InMemoryPresence with %s." % type(layer).__name__
+            )
+        return layer.connection(layer.consistent_hash(key))
+
+    def key(self, conversation_id):
+        return f'presence:{conversation_id}'
+
+    async def join(self, conversation_id, username, channel_name):
+        key = self.key(conversation_id)
+        connection = self.get_connection(key)
+        pipeline = connection.pipeline(transaction=False)
+        pipeline.zadd(key, {f'{channel_name}|{username}': time.time() + self.ttl})
+        pipeline.expire(key, int(self.ttl * 2))
+        await pipeline.execute()
+
+    async def leave(self, conversation_id, username, channel_name):
+        key = self.key(conversation_id)
+        await self.get_connection(key).zrem(key, f'{channel_name}|{username}')
+
+    async def online(self, conversation_id):
+        key = self.key(conversation_id)
+        connection = self.get_connection(key)
+        pipeline = connection.pipeline(transaction=False)
+        pipeline.zremrangebyscore(key, '-inf', time.time())
+        pipeline.zrange(key, 0, -1)
+        _, members = await pipeline.execute()
+        return sorted({member.decode().rsplit('|', 1)[1] for member in members})
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        config = {**DEFAULT_PRESENCE, **getattr(settings, 'CONVO_PRESENCE', {})}
+        backend = import_string(config.pop('BACKEND'))
+        _presence = backend(**{key.lower(): value for key, value in config.items()})
+    return _presence
+
+
+def _reset_presence(setting, **kwargs):
+    global _presence
+    if setting == 'CONVO_PRESENCE':
+        _presence = None
+
+
+setting_changed.connect(_reset_presence)
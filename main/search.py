@@ -0,0 +1,478 @@
+"""
+User directory and message search.
+
+Searches return pages of bounded size with an opaque cursor to the next
+page, so a query never reads more than one page of results however many
+match.
+
+User searches match every whitespace-separated term of the query against the
+username, first name and last name, case-insensitively.
+``FTS5UserSearch`` answers from an SQLite FTS5 table with the trigram
+tokenizer. It is an external-content index over the user table, kept up to
+date by triggers, and is created and filled after ``migrate``. Terms shorter
+than three characters, which trigrams can't match, become a prefix search on
+the username through the ``user_username_lower_idx`` index. A query of only
+short terms is a prefix search on its first term, whose results the other
+terms filter like any term. On other
+databases, or an SQLite built without FTS5, it falls back to
+``DatabaseUserSearch``, a plain ``LIKE`` scan.
+
+Message searches match words, stemmed, in the conversations the caller is a
+member of, best match among the newest matches first. ``FTS5MessageSearch`` indexes the content and
+conversation of every message as `Message.objects.store` and `bulk_store`
+write it, through the ``messages_stored`` signal, so other backends can
+index the same way. ``rebuild_message_search`` refills the index in batches.
+``DatabaseMessageSearch`` is the ``LIKE`` fallback, newest first. Both
+search archived messages too, see main/archive.py.
+
+Configured with the ``CONVO_USER_SEARCH`` and ``CONVO_MESSAGE_SEARCH`` settings::
+
+    CONVO_USER_SEARCH = {
+        'BACKEND': 'main.search.FTS5UserSearch',
+    }
+
+    CONVO_MESSAGE_SEARCH = {
+        'BACKEND': 'main.search.FTS5MessageSearch',
+        'BATCH_SIZE': 10000,
+        'MAX_RANKED': 1000,
+    }
+"""
+import logging
+import re
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from .models import ArchivedMessage, Membership, Message, User, messages_stored
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_SEARCH = {
+    'BACKEND': 'main.search.FTS5UserSearch',
+}
+
+DEFAULT_MESSAGE_SEARCH = {
+    'BACKEND': 'main.search.FTS5MessageSearch',
+    'BATCH_SIZE': 10000,
+    'MAX_RANKED': 1000,
+}
+
+# Trigram indexes can't match shorter terms.
+MIN_TERM_LENGTH = 3
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def term_filter(term):
+    return Q(username__icontains=term) | Q(first_name__icontains=term) | Q(last_name__icontains=term)
+
+
+def page(rows, limit, cursor):
+    """
+    Return the first `limit` rows and the cursor `cursor(row)` after the last,
+    if there are more.
+    """
+    if len(rows) > limit:
+        return rows[:limit], cursor(rows[limit - 1])
+    return rows, None
+
+
+class BaseUserSearch:
+    """
+    `search` returns the ids of up to `limit` users and the cursor of the next
+    page, or None on the last page. Cursors are strings of the backend's own
+    format; a malformed one raises ValueError.
+    """
+
+    def search(self, query, cursor=None, limit=20, exclude=None):
+        terms = query.split()
+        users = User.objects.all()
+        if exclude is not None:
+            users = users.exclude(id=exclude)
+        if not terms:
+            return self.directory(users, cursor, limit)
+        if all(len(term) < MIN_TERM_LENGTH for term in terms):
+            first, *others = terms
+            for term in others:
+                users = users.filter(term_filter(term))
+            return self.username_prefix(users, first.lower(), cursor, limit)
+        return self.match(users, terms, cursor, limit, exclude)
+
+    def directory(self, users, cursor, limit):
+        if cursor is not None:
+            users = users.filter(id__gt=int(cursor))
+        ids = list(users.order_by('id').values_list('id', flat=True)[:limit + 1])
+        return page(ids, limit, str)
+
+    def username_prefix(self, users, prefix, cursor, limit):
+        # A range on LOWER(username) is answered by user_username_lower_idx, LIKE would scan.
+        users = users.annotate(username_lower=Lower('username')).filter(
+            username_lower__gte=prefix,
+            username_lower__lt=prefix[:-1] + chr(ord(prefix[-1]) + 1),
+        )
+        if cursor is not None:
+            last, last_id = cursor.rsplit('|', 1)
+            users = users.filter(Q(username_lower__gt=last) | Q(username_lower=last, id__gt=int(last_id)))
+        rows = list(users.order_by('username_lower', 'id').values_list('username_lower', 'id')[:limit + 1])
+        rows, cursor = page(rows, limit, lambda row: f'{row[0]}|{row[1]}')
+        return [user_id for _, user_id in rows], cursor
+
+    def match(self, users, terms, cursor, limit, exclude):
+        raise NotImplementedError
+
+
+class DatabaseUserSearch(BaseUserSearch):
+    """
+    Searches with LIKE, in id order. Every page scans users until it is full.
+    """
+
+    def match(self, users, terms, cursor, limit, exclude):
+        for term in terms:
+            users = users.filter(term_filter(term))
+        return self.directory(users, cursor, limit)
+
+
+class FTS5UserSearch(DatabaseUserSearch):
+    table = 'main_user_search'
+    columns = ('username', 'first_name', 'last_name')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.installed = {}
+
+    def get_connection(self):
+        return connections[router.db_for_read(User)]
+
+    def is_installed(self, connection):
+        if connection.vendor != 'sqlite':
+            return False
+        key = (connection.alias, connection.settings_dict['NAME'])
+        if key not in self.installed:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table])
+                self.installed[key] = cursor.fetchone() is not None
+        return self.installed[key]
+
+    def install(self, connection):
+        """
+        Create the index and its triggers unless they exist, and fill a new index
+        from the user table.
+        """
+        if connection.vendor != 'sqlite' or self.is_installed(connection):
+            return
+        user_table = connection.ops.quote_name(User._meta.db_table)
+        columns = ', '.join(self.columns)
+        new = ', '.join(f'new.{column}' for column in self.columns)
+        old = ', '.join(f'old.{column}' for column in self.columns)
+        changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in self.columns)
+        statements = [
+            f"CREATE VIRTUAL TABLE {self.table} USING fts5({columns}, "
+            f"content={user_table}, content_rowid='id', tokenize='trigram')",
+            f"CREATE TRIGGER {self.table}_insert AFTER INSERT ON {user_table} BEGIN "
+            f"INSERT INTO {self.table}(rowid, {columns}) VALUES (new.id, {new}); END",
+            f"CREATE TRIGGER {self.table}_delete AFTER DELETE ON {user_table} BEGIN "
+            f"INSERT INTO {self.table}({self.table}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+            # Only renames touch the index, not every save().
+            f"CREATE TRIGGER {self.table}_update AFTER UPDATE ON {user_table} WHEN {changed} BEGIN "
+            f"INSERT INTO {self.table}({self.table}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+            f"INSERT INTO {self.table}(rowid, {columns}) VALUES (new.id, {new}); END",
+            f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')",
+        ]
+        try:
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+        except DatabaseError:
+            logger.warning("Could not create the %s FTS5 index, searching users with LIKE.", self.table, exc_info=True)
+        else:
+            self.installed[(connection.alias, connection.settings_dict['NAME'])] = True
+
+    def match(self, users, terms, cursor, limit, exclude):
+        connection = self.get_connection()
+        if not self.is_installed(connection):
+            return super().match(users, terms, cursor, limit, exclude)
+
+        user_table = connection.ops.quote_name(User._meta.db_table)
+        # Every long term must occur as a substring; the short ones filter the candidates.
+        long_terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+        where = [f"{self.table} MATCH %s"]
+        params = [' AND '.join('"{}"'.format(term.replace('"', '""')) for term in long_terms)]
+        for term in terms:
+            if len(term) < MIN_TERM_LENGTH:
+                where.append('(' + ' OR '.join(f"u.{column} LIKE %s ESCAPE '\\'" for column in self.columns) + ')')
+                params.extend([f'%{escape_like(term)}%'] * len(self.columns))
+        if cursor is not None:
+            where.append("s.rowid > %s")
+            params.append(int(cursor))
+        if exclude is not None:
+            where.append("s.rowid != %s")
+            params.append(exclude)
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(
+                f"SELECT s.rowid FROM {self.table} s JOIN {user_table} u ON u.id = s.rowid "
+                f"WHERE {' AND '.join(where)} ORDER BY s.rowid LIMIT %s",
+                params + [limit + 1],
+            )
+            ids = [row[0] for row in db_cursor.fetchall()]
+        return page(ids, limit, str)
+
+
+class BaseMessageSearch:
+    """
+    `search` returns the ids of up to `limit` messages of the conversations
+    `user` is a member of, optionally only `conversation_id`, and the cursor
+    of the next page, or None on the last page.
+    """
+
+    def __init__(self, batch_size=10000, **kwargs):
+        self.batch_size = batch_size
+
+    def search(self, query, cursor=None, limit=20, user=None, conversation_id=None):
+        terms = [term for term in query.split() if re.search(r'\w', term)]
+        memberships = Membership.objects.filter(user=user)
+        if conversation_id is not None:
+            memberships = memberships.filter(conversation_id=conversation_id)
+        conversation_ids = list(memberships.values_list('conversation_id', flat=True))
+        if not terms or not conversation_ids:
+            return [], None
+        return self.match(terms, conversation_ids, cursor, limit)
+
+    def match(self, terms, conversation_ids, cursor, limit):
+        raise NotImplementedError
+
+    def index(self, messages):
+        """
+        Add newly stored messages to the index.
+        """
+
+    def rebuild(self, progress=None):
+        """
+        Index every message again, calling `progress(indexed)` after each batch.
+        """
+
+
+class DatabaseMessageSearch(BaseMessageSearch):
+    """
+    Searches with LIKE, newest first. Every page scans the caller's hot and
+    archived messages until it is full.
+    """
+
+    def match(self, terms, conversation_ids, cursor, limit):
+        if cursor is not None:
+            created_at, pk = cursor.rsplit('|', 1)
+            created_at = parse_datetime(created_at)
+            if created_at is None:
+                raise ValueError("Invalid cursor.")
+        rows = []
+        for model in (Message, ArchivedMessage):
+            messages = model.objects.filter(conversation_id__in=conversation_ids)
+            for term in terms:
+                messages = messages.filter(content__icontains=term)
+            if cursor is not None:
+                messages = messages.before(created_at, int(pk))
+            else:
+                messages = messages.order_by('-created_at', '-id')
+            rows.extend(messages.values_list('created_at', 'id')[:limit + 1])
+        rows = sorted(rows, reverse=True)[:limit + 1]
+        rows, cursor = page(rows, limit, lambda row: f'{row[0].isoformat()}|{row[1]}')
+        return [message_id for _, message_id in rows], cursor
+
+
+class FTS5MessageSearch(DatabaseMessageSearch):
+    """
+    Ranks hits by BM25 of the content among the newest ``MAX_RANKED`` matches,
+    so a query scores a bounded number of rows however common its words are.
+    The cursor holds the newest id of the first page's window and the position
+    in its ranking, so later pages rank the same matches even after new ones are
+    indexed. The scores themselves shift as the index grows; that can only swap
+    hits of almost equal score across a page boundary.
+
+    The conversation ids are indexed as words too. For callers in a few
+    conversations the membership filter is applied inside the index; for
+    the others by joining the messages, which stops at ``MAX_RANKED`` hits.
+    """
+    table = 'main_message_search'
+    max_indexed_conversations = 50
+
+    def __init__(self, batch_size=10000, max_ranked=1000, **kwargs):
+        super().__init__(batch_size=batch_size, **kwargs)
+        self.max_ranked = max_ranked
+        self.installed = {}
+
+    def get_connection(self):
+        return connections[router.db_for_write(Message)]
+
+    def is_installed(self, connection):
+        if connection.vendor != 'sqlite':
+            return False
+        key = (connection.alias, connection.settings_dict['NAME'])
+        if key not in self.installed:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table])
+                self.installed[key] = cursor.fetchone() is not None
+        return self.installed[key]
+
+    def install(self, connection):
+        """
+        Create the index unless it exists, and fill a new one from the message table.
+        """
+        if connection.vendor != 'sqlite' or self.is_installed(connection):
+            return
+        message_table = connection.ops.quote_name(Message._meta.db_table)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE {self.table} USING fts5(content, conversation_id, "
+                    f"content={message_table}, content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')"
+                )
+        except DatabaseError:
+            logger.warning("Could not create the %s FTS5 index, searching messages with LIKE.", self.table,
+                           exc_info=True)
+            return
+        self.installed[(connection.alias, connection.settings_dict['NAME'])] = True
+        self.rebuild()
+
+    def index(self, messages):
+        connection = self.get_connection()
+        if not messages or not self.is_installed(connection):
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table}(rowid, content, conversation_id) VALUES (%s, %s, %s)",
+                [(message.id, message.content, message.conversation_id) for message in messages],
+            )
+
+    def rebuild(self, progress=None):
+        connection = self.get_connection()
+        if not self.is_installed(connection):
+            return
+        message_table = connection.ops.quote_name(Message._meta.db_table)
+        archived_table = connection.ops.quote_name(ArchivedMessage._meta.db_table)
+        # Entries of deleted messages are only dropped here; searches skip them by joining the messages.
+        # Messages stored from now on are indexed by `index`, so the batches stop at the current newest.
+        # A write-behind batch with ids allocated before this point may still be indexed twice.
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('delete-all')")
+            cursor.execute(f"SELECT MAX(id) FROM {message_table}")
+            newest = cursor.fetchone()[0] or 0
+        # The archive goes second: a message archived meanwhile is indexed twice rather than missed.
+        indexed = 0
+        for table in (message_table, archived_table):
+            last_id = 0
+            while True:
+                with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                    cursor.execute(
+                        f"SELECT id, content, conversation_id FROM {table} "
+                        f"WHERE id > %s AND id <= %s ORDER BY id LIMIT %s",
+                        [last_id, newest, self.batch_size],
+                    )
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    cursor.executemany(
+                        f"INSERT INTO {self.table}(rowid, content, conversation_id) VALUES (%s, %s, %s)", rows
+                    )
+                last_id, indexed = rows[-1][0], indexed + len(rows)
+                if progress is not None:
+                    progress(indexed)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('optimize')")
+
+    def match(self, terms, conversation_ids, cursor, limit):
+        connection = self.get_connection()
+        if not self.is_installed(connection):
+            return super().match(terms, conversation_ids, cursor, limit)
+
+        message_table = connection.ops.quote_name(Message._meta.db_table)
+        archived_table = connection.ops.quote_name(ArchivedMessage._meta.db_table)
+        query = 'content : ({})'.format(' '.join('"{}"'.format(term.replace('"', '""')) for term in terms))
+        where, params = [f"{self.table} MATCH %s"], []
+        if len(conversation_ids) <= self.max_indexed_conversations:
+            query += ' AND conversation_id : ({})'.format(' OR '.join(f'"{pk}"' for pk in conversation_ids))
+            where.append("COALESCE(m.id, a.id) IS NOT NULL")
+        else:
+            where.append(
+                f"COALESCE(m.conversation_id, a.conversation_id) IN ({', '.join(['%s'] * len(conversation_ids))})"
+            )
+            params.extend(conversation_ids)
+        offset = 0
+        if cursor is not None:
+            newest, offset = (int(part) for part in cursor.split('|'))
+            if offset < 0:
+                raise ValueError("Invalid cursor.")
+            # The window of the first page, whatever was indexed since.
+            where.append("s.rowid <= %s")
+            params.append(newest)
+        params = [query, *params, self.max_ranked]
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(
+                f"SELECT id, MAX(id) OVER () FROM ("
+                f"SELECT bm25({self.table}, 1.0, 0.0) AS score, s.rowid AS id "
+                f"FROM {self.table} s LEFT JOIN {message_table} m ON m.id = s.rowid "
+                f"LEFT JOIN {archived_table} a ON m.id IS NULL AND a.id = s.rowid "
+                f"WHERE {' AND '.join(where)} ORDER BY s.rowid DESC LIMIT %s"
+                f") ORDER BY score, id LIMIT %s OFFSET %s",
+                params + [limit + 1, offset],
+            )
+            rows = db_cursor.fetchall()
+        if cursor is None and rows:
+            newest = rows[0][1]
+        return page([message_id for message_id, _ in rows], limit, lambda _: f'{newest}|{offset + limit}')
+
+
+def index_stored_messages(sender, messages, **kwargs):
+    get_message_search().index(messages)
+
+
+messages_stored.connect(index_stored_messages)
+
+
+def install_search_indexes(using='default', **kwargs):
+    """
+    post_migrate receiver creating the search indexes of the migrated database.
+    """
+    for search in (get_user_search(), get_message_search()):
+        if hasattr(search, 'install'):
+            search.install(connections[using])
+
+
+_user_search = None
+
+
+def get_user_search():
+    global _user_search
+    if _user_search is None:
+        config = {**DEFAULT_USER_SEARCH, **getattr(settings, 'CONVO_USER_SEARCH', {})}
+        backend = import_string(config.pop('BACKEND'))
+        _user_search = backend(**{key.lower(): value for key, value in config.items()})
+    return _user_search
+
+
+_message_search = None
+
+
+def get_message_search():
+    global _message_search
+    if _message_search is None:
+        config = {**DEFAULT_MESSAGE_SEARCH, **getattr(settings, 'CONVO_MESSAGE_SEARCH', {})}
+        backend = import_string(config.pop('BACKEND'))
+        _message_search = backend(**{key.lower(): value for key, value in config.items()})
+    return _message_search
+
+
+def _reset_search(setting, **kwargs):
+    global _user_search, _message_search
+    if setting == 'CONVO_USER_SEARCH':
+        _user_search = None
+    elif setting == 'CONVO_MESSAGE_SEARCH':
+        _message_search = None
+
+
+setting_changed.connect(_reset_search)
@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from django.contrib.humanize.templatetags.humanize import naturalday
+from django.db import models
+from django.db.models import Count
 
 from .models import User, Conversation, Message
 
@@ -34,19 +36,123 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('first_name', 'last_name', 'username', 'email', 'display_photo', 'friends_count')
 
     def get_friends_count(self, user):
-        return user.friends.count()
+        friends_count = getattr(user, 'friends_count', None)
+        if friends_count is None:
+            return user.friends.count()
+        return friends_count
+
+
+class CompactUserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ('username', 'display_photo')
+
+
+def load_users(user_ids, compact=False):
+    """
+    Return the users with the given ids keyed by id, loaded with one query.
+
+    Unless `compact` is set the users are annotated with `friends_count`, which
+    UserSerializer reads instead of running a COUNT per user.
+    """
+    users = User.objects.filter(id__in=user_ids)
+    if compact:
+        users = users.only('id', 'username', 'display_photo')
+    else:
+        users = users.annotate(friends_count=Count('friends'))
+    return {user.id: user for user in users}
+
+
+def get_message_user_ids(messages):
+    user_ids = {message.sender_id for message in messages}
+    user_ids.update(message.recipient_id for message in messages if message.recipient_id)
+    return user_ids
+
+
+def attach_message_users(messages, users):
+    for message in messages:
+        message.sender = users[message.sender_id]
+        if message.recipient_id:
+            message.recipient = users[message.recipient_id]
+
+
+def load_message_users(messages, compact=False):
+    """
+    Attach senders and recipients to `messages` with one query.
+    """
+    attach_message_users(messages, load_users(get_message_user_ids(messages), compact=compact))
+    return messages
+
+
+def load_conversation_relations(conversations):
+    """
+    Attach `other_user` to conversations annotated by
+    `Conversation.objects.with_list_fields`, together with the senders and
+    recipients of their last messages, using one query for the whole list.
+    """
+    messages = [conversation.last_message for conversation in conversations if conversation.last_message]
+    user_ids = get_message_user_ids(messages)
+    user_ids.update(conversation.other_user_id for conversation in conversations if conversation.other_user_id)
+    users = load_users(user_ids)
+    attach_message_users(messages, users)
+
+    for conversation in conversations:
+        conversation.other_user = users.get(conversation.other_user_id)
+    return conversations
+
+
+class MessageListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        messages = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        load_message_users(messages, compact=self.context.get('compact', False))
+        return super().to_representation(messages)
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    """
+    Pass `context={'compact': True}` to embed only the username and photo of
+    the sender and recipient.
+    """
     sender = UserSerializer()
     recipient = UserSerializer()
 
     class Meta:
         model = Message
         fields = ('id', 'sender', 'recipient', 'content', 'created_at', 'status', 'read')
+        list_serializer_class = MessageListSerializer
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.context.get('compact'):
+            fields['sender'] = CompactUserSerializer()
+            fields['recipient'] = CompactUserSerializer()
+        return fields
+
+
+class MessageSearchSerializer(MessageSerializer):
+    """
+    Search hits span conversations, so each one names its conversation.
+    """
+    conversation_id = serializers.IntegerField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ('conversation_id',)
+
+
+class ConversationListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        conversations = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        if conversations and hasattr(conversations[0], 'other_user_id'):
+            load_conversation_relations(conversations)
+        return super().to_representation(conversations)
 
 
 class ConservationSerializer(serializers.ModelSerializer):
+    """
+    Conversations annotated by `Conversation.objects.with_list_fields` are
+    serialized with a fixed number of queries; plain instances fall back to
+    querying their users and messages.
+    """
     other_user = serializers.SerializerMethodField('get_other_user')
     last_message = serializers.SerializerMethodField()
     users_count = serializers.SerializerMethodField()
@@ -56,17 +162,27 @@ class ConservationSerializer(serializers.ModelSerializer):
         fields = (
             'id', 'name', 'type', 'other_user', 'last_message', 'created_at', 'updated_at', 'group_type', 'group_image',
             'users_count')
+        list_serializer_class = ConversationListSerializer
+
+    def to_representation(self, instance):
+        if self.parent is None and hasattr(instance, 'other_user_id') and not hasattr(instance, 'other_user'):
+            load_conversation_relations([instance])
+        return super().to_representation(instance)
 
     def get_last_message(self, conversation):
-        message = conversation.messages.last()
+        message = conversation.last_message
         if not message:
             return None
         return MessageSerializer(message).data
 
     def get_users_count(self, conversation):
+        if hasattr(conversation, 'users_count'):
+            return conversation.users_count
         return conversation.users.count()
 
     def get_other_user(self, conversation):
+        if hasattr(conversation, 'other_user'):
+            return UserSerializer(conversation.other_user).data
         try:
             user = self.context['user']
             other_user = conversation.users.exclude(username=user.username)
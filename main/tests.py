@@ -1,3 +1,1650 @@
-from django.test import TestCase
+import asyncio
+import json
+import time
+import unittest
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.renderers import JSONRenderer
+
+from . import codec, serializers, wire
+from .archive import MessageHistory, get_archiver
+from .authentication import CachedTokenAuthentication, TokenCache, get_token_cache
+from .consumers import ChatConsumer, EventConsumer, TypingIndicator
+from .conversation_cache import ConversationListCache, get_conversation_cache
+from .fanout import group_send_many
+from .instrumentation import event_duration, event_queries
+from .layers import HashRing, ShardedChannelLayer
+from .middleware import TokenAuthMiddleware
+from .outbound import OutboundQueue
+from .presence import ChannelLayerPresence, InMemoryPresence
+from .routing import websocket_urlpatterns
+from .models import User, ArchivedMessage, Conversation, Membership, Message
+from .serializers import ConservationSerializer, MessageSerializer, UserSerializer
+from .writebehind import MessageIdAllocator, MessageWriter, get_writer
+
+
+class UnreadCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob, cls.eve = (User.objects.create(username=name) for name in ('ada', 'bob', 'eve'))
+        cls.chats = [Conversation.objects.get_or_create_personal_conversation(cls.ada, other)
+                     for other in (cls.bob, cls.eve)]
+        cls.room = Conversation.objects.create(type='group', name='room')
+        cls.room.users.add(cls.ada, cls.bob, cls.eve)
+        for i in range(3):
+            Message.objects.store(cls.chats[0], cls.bob, f'hi {i}', recipient=cls.ada)
+            Message.objects.store(cls.room, cls.eve, f'hey {i}')
+        Message.objects.store(cls.chats[1], cls.eve, 'hello', recipient=cls.ada)
+        Membership.objects.mark_read(cls.ada, cls.chats[1])
+        Message.objects.store(cls.chats[1], cls.ada, 'hello back', recipient=cls.eve)
+
+    def test_one_query_matches_the_per_conversation_counts(self):
+        with self.assertNumQueries(1):
+            unread_count, counts = Conversation.objects.unread_counts(self.ada)
+        conversations = Conversation.objects.filter(users=self.ada)
+        expected = {conversation.id: conversation.get_unread_messages_count(self.ada)
+                    for conversation in conversations}
+        self.assertEqual({count['id']: count['count'] for count in counts}, expected)
+        self.assertEqual(expected, {self.chats[0].id: 3, self.chats[1].id: 0, self.room.id: 3})
+        self.assertEqual(unread_count, 6)
+        # Personal conversations count the same messages as a COUNT over the unread rows.
+        for chat in self.chats:
+            self.assertEqual(expected[chat.id], chat.messages.filter(recipient=self.ada, read=False).count())
+
+
+class MembershipTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob, cls.eve = (User.objects.create(username=name) for name in ('ada', 'bob', 'eve'))
+        cls.chat = Conversation.objects.get_or_create_personal_conversation(cls.ada, cls.bob)
+        cls.room = Conversation.objects.create(type='group', name='room')
+        cls.room.users.add(cls.ada, cls.bob, cls.eve)
+
+    def unread(self, user, conversation):
+        return Membership.objects.get(user=user, conversation=conversation).unread_count
+
+    def test_counters_skip_the_sender(self):
+        Message.objects.store(self.chat, self.ada, 'hi', recipient=self.bob)
+        Message.objects.store(self.chat, self.ada, 'there', recipient=self.bob)
+        Message.objects.store(self.chat, self.bob, 'hello', recipient=self.ada)
+        self.assertEqual(self.unread(self.ada, self.chat), 1)
+        self.assertEqual(self.unread(self.bob, self.chat), 2)
+
+    def test_group_messages_count_for_every_other_member(self):
+        Message.objects.store(self.room, self.eve, 'hey all')
+        Message.objects.bulk_store([
+            Message(id=10 ** 12 + i, conversation=self.room, sender=sender, content='news')
+            for i, sender in enumerate((self.ada, self.ada, self.bob))
+        ])
+        self.assertEqual(self.unread(self.ada, self.room), 2)
+        self.assertEqual(self.unread(self.bob, self.room), 3)
+        self.assertEqual(self.unread(self.eve, self.room), 3)
+
+    def test_read_receipt_moves_the_watermark(self):
+        Message.objects.store(self.chat, self.ada, 'hi', recipient=self.bob)
+        last = Message.objects.store(self.chat, self.ada, 'there', recipient=self.bob)
+        Membership.objects.mark_read(self.bob, self.chat)
+        membership = Membership.objects.get(user=self.bob, conversation=self.chat)
+        self.assertEqual((membership.unread_count, membership.last_read_message_id), (0, last.id))
+        self.assertFalse(self.chat.messages.filter(recipient=self.bob, read=False).exists())
+        self.assertEqual(set(self.chat.messages.values_list('status', flat=True)), {'seen'})
+
+        newer = Message.objects.store(self.chat, self.bob, 'hello', recipient=self.ada)
+        Membership.objects.mark_read(self.bob, self.chat)
+        self.assertEqual(Membership.objects.get(user=self.bob, conversation=self.chat).last_read_message_id, newer.id)
+
+    def test_repeated_read_receipt_leaves_messages_alone(self):
+        Message.objects.store(self.chat, self.ada, 'hi', recipient=self.bob)
+        Membership.objects.mark_read(self.bob, self.chat)
+        with CaptureQueriesContext(connection) as queries:
+            Membership.objects.mark_read(self.bob, self.chat)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertTrue(updates)
+        self.assertTrue(all(sql.startswith('UPDATE "main_membership"') for sql in updates))
+
+    def test_messages_to_oneself_are_marked_read(self):
+        notes = Conversation.objects.get_or_create_personal_conversation(self.ada, self.ada)
+        Message.objects.store(notes, self.ada, 'remember the milk', recipient=self.ada)
+        self.assertEqual(self.unread(self.ada, notes), 0)
+        Membership.objects.mark_read(self.ada, notes)
+        self.assertEqual(list(notes.messages.values_list('read', 'status')), [(True, 'seen')])
+
+    def test_rebuild_matches_the_group_counters_of_store(self):
+        Message.objects.store(self.room, self.eve, 'hey all')
+        Message.objects.store(self.room, self.ada, 'hi')
+        Membership.objects.mark_read(self.bob, self.room)
+        Message.objects.store(self.room, self.eve, 'news')
+        Message.objects.store(self.room, self.bob, 'thanks')
+        counters = dict(Membership.objects.filter(conversation=self.room).values_list('user__username', 'unread_count'))
+        self.assertEqual(counters, {'ada': 3, 'bob': 1, 'eve': 2})
+        watermark = Membership.objects.get(user=self.bob, conversation=self.room).last_read_message_id
+
+        Membership.objects.filter(conversation=self.room).update(unread_count=0)
+        Membership.objects.rebuild(Conversation.objects.filter(pk=self.room.pk))
+        self.assertEqual(
+            dict(Membership.objects.filter(conversation=self.room).values_list('user__username', 'unread_count')),
+            counters,
+        )
+        self.assertEqual(Membership.objects.get(user=self.bob, conversation=self.room).last_read_message_id, watermark)
+
+    def test_rows_follow_the_conversation_users(self):
+        def members(conversation):
+            return set(Membership.objects.filter(conversation=conversation).values_list('user__username', flat=True))
+
+        self.assertEqual(members(self.room), {'ada', 'bob', 'eve'})
+        self.room.users.remove(self.bob)
+        self.assertEqual(members(self.room), {'ada', 'eve'})
+        self.bob.conversation_set.add(self.room)
+        self.assertEqual(members(self.room), {'ada', 'bob', 'eve'})
+        self.eve.conversation_set.remove(self.room)
+        self.assertEqual(members(self.room), {'ada', 'bob'})
+        self.ada.conversation_set.clear()
+        self.assertEqual(members(self.room), {'bob'})
+        self.assertEqual(members(self.chat), {'bob'})
+        self.room.users.clear()
+        self.assertEqual(members(self.room), set())
+
+
+class PresenceTests(SimpleTestCase):
+    async def test_user_stays_online_until_their_last_socket_leaves(self):
+        presence = InMemoryPresence()
+        await presence.join(1, 'ada', 'channel-a')
+        await presence.join(1, 'ada', 'channel-b')
+        await presence.join(1, 'bob', 'channel-c')
+        await presence.join(2, 'eve', 'channel-d')
+        self.assertEqual(await presence.online(1), ['ada', 'bob'])
+        await presence.leave(1, 'ada', 'channel-a')
+        self.assertEqual(await presence.online(1), ['ada', 'bob'])
+        await presence.leave(1, 'ada', 'channel-b')
+        await presence.leave(1, 'bob', 'channel-c')
+        await presence.leave(1, 'bob', 'channel-c')
+        self.assertEqual(await presence.online(1), [])
+        self.assertEqual(await presence.online(2), ['eve'])
+
+    async def test_entries_expire_without_heartbeats(self):
+        presence = InMemoryPresence(ttl=0.2)
+        await presence.join(1, 'ada', 'channel-a')
+        await presence.join(1, 'bob', 'channel-b')
+        await asyncio.sleep(0.1)
+        await presence.heartbeat(1, 'bob', 'channel-b')
+        await asyncio.sleep(0.15)
+        self.assertEqual(await presence.online(1), ['bob'])
+        await asyncio.sleep(0.1)
+        self.assertEqual(await presence.online(1), [])
+
+    async def test_heartbeat_survives_backend_errors(self):
+        presence = InMemoryPresence(ttl=0.03)
+        calls = []
+
+        async def heartbeat(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ConnectionError('backend unavailable')
+            await presence.join(*args)
+
+        consumer = ChatConsumer()
+        consumer.presence = presence
+        consumer.conversation, consumer.user = SimpleNamespace(id=1), SimpleNamespace(username='ada')
+        consumer.channel_name = 'channel-a'
+        with mock.patch.object(presence, 'heartbeat', heartbeat), self.assertLogs('main.consumers', 'ERROR'):
+            task = asyncio.create_task(consumer.heartbeat())
+            await asyncio.sleep(0.05)
+        task.cancel()
+        self.assertGreaterEqual(len(calls), 2)
+        self.assertEqual(await presence.online(1), ['ada'])
+
+    async def test_channel_layer_presence_needs_redis(self):
+        for layers in (
+            {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+            {'default': {'BACKEND': 'main.layers.ShardedChannelLayer', 'CONFIG': {'shards': 2}}},
+        ):
+            with override_settings(CHANNEL_LAYERS=layers):
+                with self.assertRaises(ImproperlyConfigured):
+                    await ChannelLayerPresence().join(1, 'ada', 'channel-a')
+
+
+class MessagePaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        cls.chat = Conversation.objects.get_or_create_personal_conversation(cls.ada, cls.bob)
+        cls.messages = [Message.objects.store(cls.chat, cls.ada, f'message {i}', recipient=cls.bob)
+                        for i in range(120)]
+
+    def get(self, url):
+        return self.client.get(url, HTTP_AUTHORIZATION=f'Token {self.ada.auth_token.key}')
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']]
+
+    def test_response_shape(self):
+        response = self.get('/api/chat/bob/messages?page_size=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'next', 'previous', 'results'})
+        self.assertIsNone(response.data['previous'])
+        self.assertEqual(response.data['results'][0], dict(MessageSerializer(self.messages[-1]).data))
+
+    def test_before_and_after_links_walk_the_history(self):
+        newest_first = [message.id for message in reversed(self.messages)]
+        response = self.get('/api/chat/bob/messages?page_size=50')
+        self.assertEqual(self.ids(response), newest_first[:50])
+        second = self.get(response.data['next'])
+        self.assertEqual(self.ids(second), newest_first[50:100])
+        third = self.get(second.data['next'])
+        self.assertEqual(self.ids(third), newest_first[100:])
+        self.assertIsNone(third.data['next'])
+
+        # Walking back up returns the same pages, and the newest one has no previous link.
+        self.assertEqual(self.ids(self.get(third.data['previous'])), newest_first[50:100])
+        first = self.get(second.data['previous'])
+        self.assertEqual(self.ids(first), newest_first[:50])
+        self.assertIsNone(first.data['previous'])
+        self.assertIsNotNone(first.data['next'])
+
+    def test_page_size_is_bounded(self):
+        for page_size, expected in (('10', 10), ('0', 50), ('-5', 50), ('abc', 50), ('1000', 100)):
+            self.assertEqual(len(self.ids(self.get(f'/api/chat/bob/messages?page_size={page_size}'))), expected)
+
+    def test_invalid_cursor_is_not_found(self):
+        for query in ('before=abc', 'after=abc', 'before=bm90IGEgY3Vyc29y'):
+            response = self.get(f'/api/chat/bob/messages?{query}')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.data['detail'], 'Invalid cursor.')
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CONVO_PRESENCE={'BACKEND': 'main.presence.InMemoryPresence'},
+    CONVO_CONVERSATION_CACHE={'INVALIDATION_DELAY': None},
+)
+class SocketTestCase(TransactionTestCase):
+    """
+    Drives the websocket routes through WebsocketCommunicator. Consumers close
+    the database connection between calls, so tests run outside a transaction.
+    Conversation lists are invalidated on commit, since the in-memory test
+    database locks tables against the background invalidation.
+    """
+    application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    async def connect(self, path, user, query='', subprotocols=None):
+        communicator = WebsocketCommunicator(
+            self.application, f'{path}?token={user.auth_token.key}{query}', subprotocols=subprotocols
+        )
+        connected, communicator.subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_until(self, communicator, frame_type, frames=None):
+        """
+        Return the next frame of `frame_type`, JSON or MessagePack, adding the frames read to `frames`.
+        """
+        while True:
+            payload = await communicator.receive_from()
+            frame = wire.unpack(payload) if isinstance(payload, bytes) else json.loads(payload)
+            if frames is not None:
+                frames.append(frame)
+            if frame['type'] == frame_type:
+                return frame
+
+
+class ChatHistorySocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        self.chat = Conversation.objects.get_or_create_personal_conversation(self.ada, self.bob)
+        self.ids = [Message.objects.store(self.chat, self.ada, f'message {i}', recipient=self.bob).id
+                    for i in range(120)]
+
+    def message_ids(self, frame):
+        return [message['id'] for message in frame['messages']]
+
+    async def test_load_more_pages_back_to_the_first_message(self):
+        communicator = await self.connect('/ws/chat/bob/', self.ada)
+        frame = await self.receive_until(communicator, 'last_50_messages')
+        ids, newest_first = self.message_ids(frame), self.ids[::-1]
+        self.assertEqual(ids, newest_first[:50])
+        while frame['has_more']:
+            self.assertIsNotNone(frame['cursor'])
+            await communicator.send_json_to({'type': 'load_more', 'cursor': frame['cursor']})
+            frame = await self.receive_until(communicator, 'more_messages')
+            ids += self.message_ids(frame)
+        self.assertEqual(ids, newest_first)
+
+        await communicator.send_json_to({'type': 'load_more', 'cursor': frame['cursor']})
+        frame = await self.receive_until(communicator, 'more_messages')
+        self.assertEqual((frame['messages'], frame['has_more'], frame['cursor']), ([], False, None))
+        await communicator.disconnect()
+
+    async def test_invalid_or_missing_cursor_gets_an_error_frame(self):
+        communicator = await self.connect('/ws/chat/bob/', self.ada)
+        await self.receive_until(communicator, 'last_50_messages')
+        for frame in ({'type': 'load_more', 'cursor': 'abc'}, {'type': 'load_more'},
+                      {'type': 'load_more', 'cursor': None}):
+            await communicator.send_json_to(frame)
+            self.assertEqual(await self.receive_until(communicator, 'error'),
+                             {'type': 'error', 'message': 'Invalid cursor.'})
+        await communicator.disconnect()
+
+    async def test_resume_delivers_the_missed_messages(self):
+        communicator = await self.connect('/ws/chat/ada/', self.bob, query=f'&resume={self.ids[30]}')
+        frame = await self.receive_until(communicator, 'resume_messages')
+        self.assertEqual(self.message_ids(frame), self.ids[31:81])
+        self.assertTrue(frame['has_more'])
+        await communicator.send_json_to({'type': 'resume', 'last_message_id': frame['messages'][-1]['id']})
+        frame = await self.receive_until(communicator, 'resume_messages')
+        self.assertEqual(self.message_ids(frame), self.ids[81:])
+        self.assertFalse(frame['has_more'])
+        await communicator.disconnect()
+
+    async def test_unknown_resume_id_falls_back_to_the_newest_page(self):
+        communicator = await self.connect('/ws/chat/ada/', self.bob, query='&resume=999999')
+        frame = await self.receive_until(communicator, 'last_50_messages')
+        self.assertEqual(self.message_ids(frame), self.ids[::-1][:50])
+        await communicator.send_json_to({'type': 'resume', 'last_message_id': 'abc'})
+        frame = await self.receive_until(communicator, 'last_50_messages')
+        self.assertEqual(self.message_ids(frame), self.ids[::-1][:50])
+        await communicator.disconnect()
+
+
+class ConsumerFrameSocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        self.chat = Conversation.objects.get_or_create_personal_conversation(self.ada, self.bob)
+        Message.objects.store(self.chat, self.ada, 'hello', recipient=self.bob)
+
+    async def test_notification_socket_gets_the_unread_counts_on_connect(self):
+        notifications = await self.connect('/ws/notifications/', self.bob)
+        self.assertEqual(await notifications.receive_json_from(), {
+            'type': 'unread_count',
+            'unread_count': 1,
+            'conversations_unread_counts': [{'id': self.chat.id, 'count': 1}],
+        })
+        await notifications.disconnect()
+
+    async def test_chat_socket_frames_on_connect(self):
+        bob = await self.connect('/ws/chat/ada/', self.bob)
+        await self.receive_until(bob, 'last_50_messages')
+        communicator = await self.connect('/ws/chat/bob/', self.ada)
+        frames = []
+        history = await self.receive_until(communicator, 'last_50_messages', frames)
+        # Group events such as the socket's own user_join may arrive in between.
+        self.assertEqual([frame for frame in frames[:-1] if frame['type'] != 'user_join'], [
+            {'type': 'online_user_list', 'users': ['bob']},
+            {'type': 'welcome_message', 'message': "Hey there! You've successfully connected!"},
+        ])
+        self.assertEqual(set(history), {'type', 'messages', 'has_more', 'cursor'})
+        self.assertEqual([message['content'] for message in history['messages']], ['hello'])
+        joins = [await self.receive_until(bob, 'user_join')]
+        if joins[0]['user'] == 'bob':
+            joins.append(await self.receive_until(bob, 'user_join'))
+        self.assertEqual(joins[-1], {'type': 'user_join', 'user': 'ada'})
+
+        await communicator.disconnect()
+        self.assertEqual(await self.receive_until(bob, 'user_leave'), {'type': 'user_leave', 'user': 'ada'})
+        await bob.disconnect()
+
+    async def test_chat_message_notification_and_read_receipt_frames(self):
+        notifications = await self.connect('/ws/notifications/', self.bob)
+        await notifications.receive_json_from()
+        ada = await self.connect('/ws/chat/bob/', self.ada)
+        await self.receive_until(ada, 'last_50_messages')
+
+        await ada.send_json_to({'type': 'chat_message', 'message': 'news'})
+        frame = await self.receive_until(ada, 'chat_message')
+        stored = await database_sync_to_async(Message.objects.get)(content='news')
+        expected = await database_sync_to_async(lambda: json.loads(json.dumps(MessageSerializer(stored).data)))()
+        self.assertEqual(frame, {'type': 'chat_message', 'message': expected, 'conversation_id': self.chat.id})
+        self.assertEqual(await notifications.receive_json_from(), {
+            'type': 'new_message_notification', 'name': 'ada', 'id': self.chat.id,
+        })
+
+        bob = await self.connect('/ws/chat/ada/', self.bob)
+        await self.receive_until(bob, 'last_50_messages')
+        await bob.send_json_to({'type': 'read_messages'})
+        self.assertEqual(await notifications.receive_json_from(), {
+            'type': 'unread_count',
+            'unread_count': 0,
+            'conversations_unread_counts': [{'id': self.chat.id, 'count': 0}],
+        })
+        self.assertEqual(await self.receive_until(ada, 'seen_message'), {'type': 'seen_message', 'user': 'bob'})
+        for communicator in (notifications, ada, bob):
+            await communicator.disconnect()
+
+
+class BroadcastEncodingSocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        Conversation.objects.get_or_create_personal_conversation(self.ada, self.bob)
+
+    async def test_a_broadcast_is_encoded_once_for_every_receiver(self):
+        ada = await self.connect('/ws/chat/bob/', self.ada)
+        sockets = [ada] + [await self.connect('/ws/chat/ada/', self.bob) for _ in range(2)]
+        for socket in sockets:
+            await self.receive_until(socket, 'last_50_messages')
+
+        with mock.patch('main.codec.dumps', wraps=codec.dumps) as dumps:
+            await ada.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            payloads = []
+            for socket in sockets:
+                while True:
+                    payload = await socket.receive_from()
+                    if json.loads(payload)['type'] == 'chat_message':
+                        payloads.append(payload)
+                        break
+        encoded = [call.args[0] for call in dumps.call_args_list if call.args[0]['type'] == 'chat_message']
+        self.assertEqual(len(encoded), 1)
+        # Every socket gets the sender's encoding, byte for byte.
+        self.assertEqual(payloads, [codec.dumps(encoded[0])] * 3)
+        for socket in sockets:
+            await socket.disconnect()
+
+
+class EventConsumerTests(SimpleTestCase):
+    async def test_receivers_forward_the_encoded_frame(self):
+        sender = EventConsumer()
+        event = {'type': 'chat_message', 'message': {'id': 7, 'content': 'hello'}, 'conversation_id': 1}
+        message = sender.layer_message(event)
+        self.assertEqual(json.loads(message['text']), event)
+        self.assertEqual(message['message_id'], 7)
+        sent = []
+        for _ in range(2):
+            receiver = EventConsumer()
+            receiver.outbox = mock.Mock()
+            with mock.patch('main.codec.dumps') as dumps:
+                await receiver.send_event(message)
+            dumps.assert_not_called()
+            receiver.outbox.put.assert_called_once_with('chat_message', message['text'], user=None, message_id=7)
+            sent.append(receiver.outbox.put.call_args.args[1])
+        self.assertIs(sent[0], sent[1])
+
+
+class RoomNotificationSocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob, self.eve = (User.objects.create(username=name) for name in ('ada', 'bob', 'eve'))
+        self.room = Conversation.objects.create(type='group', name='room')
+        self.room.users.add(self.ada, self.bob, self.eve)
+
+    async def connect_all(self):
+        notifications = {}
+        for user in (self.bob, self.eve):
+            notifications[user.username] = await self.connect('/ws/notifications/', user)
+            await notifications[user.username].receive_json_from()
+        with mock.patch('builtins.print'):
+            ada = await self.connect('/ws/chat/room/room/', self.ada)
+        await self.receive_until(ada, 'last_50_messages')
+        return ada, notifications
+
+    async def test_every_member_is_notified_once(self):
+        ada, notifications = await self.connect_all()
+        await ada.send_json_to({'type': 'chat_message', 'message': 'hello'})
+        await self.receive_until(ada, 'chat_message')
+        for communicator in notifications.values():
+            self.assertEqual(await communicator.receive_json_from(), {
+                'type': 'new_message_notification', 'name': 'ada', 'id': self.room.id,
+            })
+            self.assertTrue(await communicator.receive_nothing(0.05))
+        for communicator in (ada, *notifications.values()):
+            await communicator.disconnect()
+
+    async def test_a_failing_recipient_does_not_hold_up_the_sender(self):
+        ada, notifications = await self.connect_all()
+        layer = get_channel_layer()
+        group_send = layer.group_send
+
+        async def failing_group_send(group, message):
+            if group == 'eve__notifications':
+                raise ConnectionError('shard unavailable')
+            await group_send(group, message)
+
+        with mock.patch.object(layer, 'group_send', failing_group_send), self.assertLogs('main.fanout', 'ERROR'):
+            await ada.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            self.assertEqual((await self.receive_until(ada, 'chat_message'))['message']['content'], 'hello')
+            self.assertEqual((await notifications['bob'].receive_json_from())['type'], 'new_message_notification')
+        self.assertTrue(await notifications['eve'].receive_nothing(0.05))
+        for communicator in (ada, *notifications.values()):
+            await communicator.disconnect()
+
+
+class GroupSendManyTests(SimpleTestCase):
+    async def test_groups_get_one_send_each_and_failures_are_logged(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                if group == 'broken':
+                    raise ConnectionError('shard unavailable')
+                sent.append((group, message))
+
+        with self.assertLogs('main.fanout', 'ERROR'):
+            await group_send_many(Layer(), ['a', 'broken', 'b'], {'type': 'notify'})
+        self.assertEqual(sent, [('a', {'type': 'notify'}), ('b', {'type': 'notify'})])
+
+    async def test_layers_with_group_send_many_get_one_call(self):
+        layer = mock.Mock(spec=['group_send', 'group_send_many'])
+        layer.group_send_many = mock.AsyncMock()
+        await group_send_many(layer, (group for group in ['a', 'b']), {'type': 'notify'})
+        layer.group_send_many.assert_awaited_once_with(['a', 'b'], {'type': 'notify'})
+        layer.group_send.assert_not_called()
+
+
+class MessageIdAllocatorTests(SimpleTestCase):
+    def test_ids_increase_and_never_repeat(self):
+        allocator = MessageIdAllocator(worker_id=3)
+        # More ids than the sequence holds per millisecond.
+        ids = [allocator.next_id() for _ in range(2000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all((pk >> 8) & 31 == 3 for pk in ids))
+        self.assertLess(max(ids), 2 ** 53)
+
+    def test_workers_mint_disjoint_ids(self):
+        first, second = MessageIdAllocator(worker_id=0), MessageIdAllocator(worker_id=1)
+        ids = [allocator.next_id() for _ in range(500) for allocator in (first, second)]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_worker_id_is_required(self):
+        for worker_id in (None, -1, 32):
+            with self.assertRaises(ImproperlyConfigured):
+                MessageIdAllocator(worker_id=worker_id)
+        with override_settings(CONVO_WRITE_BEHIND={'ENABLED': True}):
+            with self.assertRaises(ImproperlyConfigured):
+                asyncio.run(self.get_writer())
+
+    async def get_writer(self):
+        return get_writer()
+
+    def test_config_is_read_once_per_setting_change(self):
+        async def get_twice():
+            writer = get_writer()
+            with mock.patch('main.writebehind.settings', object()):
+                return writer, get_writer()
+
+        with override_settings(CONVO_WRITE_BEHIND={'ENABLED': True, 'WORKER_ID': 1}):
+            writer, again = asyncio.run(get_twice())
+            self.assertIsNotNone(writer)
+            self.assertIs(again, writer)
+        self.assertIsNone(asyncio.run(self.get_writer()))
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        self.room = Conversation.objects.create(type='group', name='room')
+        self.room.users.add(self.ada, self.bob)
+        self.calls = []
+        bulk_store = Message.objects.bulk_store
+
+        def record(messages):
+            self.calls.append([message.content for message in messages])
+            return bulk_store(messages)
+
+        patcher = mock.patch.object(Message.objects, 'bulk_store', side_effect=record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def message(self, writer, content):
+        return writer.prepare(Message(conversation=self.room, sender=self.ada, content=content))
+
+    @database_sync_to_async
+    def stored(self):
+        return list(Message.objects.order_by('id').values_list('content', flat=True))
+
+    async def test_full_batch_is_written_right_away(self):
+        writer = MessageWriter(batch_size=3, flush_interval=60, worker_id=0)
+        for i in range(3):
+            await writer.submit(self.message(writer, f'm{i}'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(await self.stored(), ['m0', 'm1', 'm2'])
+        # The next message waits for the interval.
+        await writer.submit(self.message(writer, 'm3'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.calls, [['m0', 'm1', 'm2']])
+        await writer.drain()
+        self.assertEqual(self.calls, [['m0', 'm1', 'm2'], ['m3']])
+
+    async def test_partial_batch_is_written_after_the_interval(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.1, worker_id=0)
+        await writer.submit(self.message(writer, 'm0'))
+        await writer.submit(self.message(writer, 'm1'))
+        await asyncio.sleep(0.02)
+        self.assertEqual(await self.stored(), [])
+        await asyncio.sleep(0.2)
+        self.assertEqual(await self.stored(), ['m0', 'm1'])
+        self.assertEqual(self.calls, [['m0', 'm1']])
+
+    async def test_flush_before_ack_waits_for_the_commit(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, flush_before_ack=True, worker_id=0)
+        await writer.submit(self.message(writer, 'm0'))
+        self.assertEqual(await self.stored(), ['m0'])
+        # Messages arriving together are committed in one batch.
+        await asyncio.gather(*(writer.submit(self.message(writer, f'm{i}')) for i in range(1, 4)))
+        self.assertEqual(await self.stored(), ['m0', 'm1', 'm2', 'm3'])
+        self.assertEqual(self.calls, [['m0'], ['m1', 'm2', 'm3']])
+
+    async def test_failed_batch_is_retried_one_by_one(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, flush_before_ack=True, worker_id=0)
+        messages = [self.message(writer, f'm{i}') for i in range(3)]
+        await database_sync_to_async(Message.objects.bulk_store)([self.message(writer, 'taken')])
+        messages[1].id = (await self.stored_ids())[0]
+        with self.assertLogs('main.writebehind', 'ERROR'):
+            results = await asyncio.gather(*(writer.submit(message) for message in messages), return_exceptions=True)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertIsNone(results[2])
+        self.assertEqual(await self.stored(), ['m0', 'm2', 'taken'])
+        self.assertEqual(self.calls[1:], [['m0', 'm1', 'm2'], ['m0'], ['m1'], ['m2']])
+
+    @database_sync_to_async
+    def stored_ids(self):
+        return list(Message.objects.order_by('id').values_list('id', flat=True))
+
+    async def test_drain_writes_pending_messages(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, worker_id=0)
+        await writer.submit(self.message(writer, 'm0'))
+        await writer.drain()
+        self.assertEqual(await self.stored(), ['m0'])
+
+    def test_pending_messages_are_written_at_exit(self):
+        writer = MessageWriter(batch_size=2, flush_interval=60, worker_id=0)
+        writer.pending = [(self.message(writer, f'm{i}'), None) for i in range(3)]
+        writer.write_pending()
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['m0', 'm1', 'm2'])
+        self.assertEqual(self.calls, [['m0', 'm1'], ['m2']])
+
+
+class WireProtocolSocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        self.chat = Conversation.objects.get_or_create_personal_conversation(self.ada, self.bob)
+        Message.objects.store(self.chat, self.ada, 'first', recipient=self.bob)
+        Message.objects.store(self.chat, self.bob, 'second', recipient=self.ada)
+        self.ada_data = json.loads(json.dumps(UserSerializer(self.ada).data))
+
+    async def test_subprotocol_selection(self):
+        for offered, selected in (
+            ([wire.MSGPACK_SUBPROTOCOL], wire.MSGPACK_SUBPROTOCOL),
+            (['chat.v9', wire.JSON_SUBPROTOCOL, wire.MSGPACK_SUBPROTOCOL], wire.JSON_SUBPROTOCOL),
+            (['chat.v9'], None),
+            ([], None),
+        ):
+            communicator = await self.connect('/ws/chat/bob/', self.ada, subprotocols=offered)
+            self.assertEqual(communicator.subprotocol, selected)
+            payload = await communicator.receive_from()
+            self.assertIsInstance(payload, bytes if selected == wire.MSGPACK_SUBPROTOCOL else str)
+            await communicator.disconnect()
+
+    async def test_users_are_defined_once_and_interned(self):
+        ada = await self.connect('/ws/chat/bob/', self.ada, subprotocols=[wire.MSGPACK_SUBPROTOCOL])
+        frames = []
+        history = await self.receive_until(ada, 'last_50_messages', frames)
+        definitions = [frame for frame in frames if frame['type'] == 'users']
+        self.assertEqual(len(definitions), 1)
+        self.assertEqual([user['username'] for user in definitions[0]['users']], ['bob', 'ada'])
+        self.assertEqual(definitions[0]['users'][1], self.ada_data)
+        self.assertEqual([(message['sender'], message['recipient']) for message in history['messages']],
+                         [('bob', 'ada'), ('ada', 'bob')])
+
+        # Client frames may be binary too.
+        await ada.send_to(bytes_data=wire.pack({'type': 'chat_message', 'message': 'third'}))
+        frames = []
+        frame = await self.receive_until(ada, 'chat_message', frames)
+        self.assertEqual((frame['message']['sender'], frame['message']['recipient']), ('ada', 'bob'))
+        self.assertNotIn('users', [frame['type'] for frame in frames])
+        await ada.disconnect()
+
+    async def test_json_socket_in_the_same_conversation_gets_full_users(self):
+        ada = await self.connect('/ws/chat/bob/', self.ada, subprotocols=[wire.MSGPACK_SUBPROTOCOL])
+        bob = await self.connect('/ws/chat/ada/', self.bob)
+        await self.receive_until(ada, 'last_50_messages')
+        history = await self.receive_until(bob, 'last_50_messages')
+        self.assertEqual(history['messages'][0]['sender']['username'], 'bob')
+
+        await ada.send_to(bytes_data=wire.pack({'type': 'chat_message', 'message': 'third'}))
+        frame = await self.receive_until(bob, 'chat_message')
+        self.assertEqual(frame['message']['sender'], self.ada_data)
+        self.assertEqual(frame['message']['recipient']['username'], 'bob')
+        self.assertEqual((await self.receive_until(ada, 'chat_message'))['message']['sender'], 'ada')
+        await ada.disconnect()
+        await bob.disconnect()
+
+
+class TypingSocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        Conversation.objects.get_or_create_personal_conversation(self.ada, self.bob)
+
+    async def test_two_sockets_of_a_user_broadcast_one_state(self):
+        bob = await self.connect('/ws/chat/ada/', self.bob)
+        sockets = [await self.connect('/ws/chat/bob/', self.ada) for _ in range(2)]
+        for socket in sockets:
+            await self.receive_until(socket, 'last_50_messages')
+            await self.receive_until(bob, 'user_join')
+        for socket in sockets:
+            await socket.send_json_to({'type': 'typing', 'typing': True})
+        self.assertTrue((await self.receive_until(bob, 'typing'))['typing'])
+        self.assertTrue(await bob.receive_nothing(0.1))
+
+        await sockets[0].send_json_to({'type': 'chat_message', 'message': 'hello'})
+        self.assertFalse((await self.receive_until(bob, 'typing'))['typing'])
+        for socket in sockets + [bob]:
+            await socket.disconnect()
+
+
+@override_settings(CONVO_WRITE_BEHIND={'ENABLED': True, 'FLUSH_INTERVAL': 60, 'WORKER_ID': 0})
+class WriteBehindSocketTests(SocketTestCase):
+    def setUp(self):
+        self.ada, self.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        self.chat = Conversation.objects.get_or_create_personal_conversation(self.ada, self.bob)
+
+    async def send_message(self, communicator, content):
+        await communicator.send_json_to({'type': 'chat_message', 'message': content})
+        return (await self.receive_until(communicator, 'chat_message'))['message']
+
+    async def test_disconnect_writes_pending_messages(self):
+        communicator = await self.connect('/ws/chat/bob/', self.ada)
+        message = await self.send_message(communicator, 'hello')
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(id=message['id']).exists)())
+        await communicator.disconnect()
+        self.assertTrue(await database_sync_to_async(Message.objects.filter(id=message['id']).exists)())
+
+    async def test_read_receipt_writes_pending_messages_first(self):
+        ada = await self.connect('/ws/chat/bob/', self.ada)
+        bob = await self.connect('/ws/chat/ada/', self.bob)
+        await self.send_message(ada, 'hello')
+        await self.receive_until(bob, 'chat_message')
+        await bob.send_json_to({'type': 'read_messages'})
+        await self.receive_until(bob, 'seen_message')
+        membership = await database_sync_to_async(Membership.objects.get)(user=self.bob, conversation=self.chat)
+        self.assertEqual(membership.unread_count, 0)
+        self.assertTrue((await database_sync_to_async(Message.objects.get)(content='hello')).read)
+        await ada.disconnect()
+        await bob.disconnect()
+
+
+class MessageSerializerQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'user{i}') for i in range(4)]
+        cls.users[0].friends.add(cls.users[1], cls.users[2])
+        cls.users[1].friends.add(cls.users[3])
+        cls.conversation = Conversation.objects.get_or_create_personal_conversation(cls.users[0], cls.users[1])
+        group = Conversation.objects.create(type='group', name='room')
+        group.users.add(*cls.users)
+        for i in range(50):
+            sender, recipient = (cls.users[0], cls.users[1]) if i % 2 else (cls.users[1], cls.users[0])
+            Message.objects.store(cls.conversation, sender, f'message {i}', recipient=recipient)
+            Message.objects.store(group, cls.users[i % 4], f'room message {i}')
+
+    def test_page_of_50_messages_costs_two_queries(self):
+        with self.assertNumQueries(2):
+            data = MessageSerializer(self.conversation.messages.order_by('-created_at')[:50], many=True).data
+        self.assertEqual(len(data), 50)
+
+    def test_batched_output_matches_per_message_serialization(self):
+        messages = Message.objects.order_by('id')
+        batched = MessageSerializer(messages, many=True).data
+        single = [MessageSerializer(message).data for message in messages]
+        self.assertEqual(batched, single)
+        self.assertEqual(batched[0]['sender'], UserSerializer(self.users[1]).data)
+        self.assertEqual(batched[0]['recipient']['friends_count'], 2)
+        self.assertIsNone(batched[1]['recipient'])
+
+    def test_compact_mode_embeds_username_and_photo(self):
+        with self.assertNumQueries(2):
+            data = MessageSerializer(self.conversation.messages.all(), many=True, context={'compact': True}).data
+        self.assertEqual(set(data[0]['sender']), {'username', 'display_photo'})
+        self.assertEqual(data[0]['recipient']['username'], 'user0')
+
+
+@override_settings(CONVO_CONVERSATION_CACHE={'ENABLED': False})
+class ConversationListQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='owner')
+        cls.others = [User.objects.create(username=f'other{i}') for i in range(12)]
+        cls.user.friends.add(*cls.others[:3])
+
+    def add_conversations(self, others):
+        for i, other in enumerate(others):
+            conversation = Conversation.objects.get_or_create_personal_conversation(self.user, other)
+            if i % 3:
+                Message.objects.store(conversation, other, 'hello', recipient=self.user)
+                Message.objects.store(conversation, self.user, 'hi', recipient=other)
+        group = Conversation.objects.create(type='group', name=f'room{len(others)}')
+        group.users.add(self.user, *others)
+        Message.objects.store(group, others[0], 'hey all')
+
+    def get_chats(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chats', HTTP_AUTHORIZATION=f'Token {self.user.auth_token.key}')
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_query_count_does_not_grow_with_conversations(self):
+        self.add_conversations(self.others[:2])
+        small, small_queries = self.get_chats()
+        self.add_conversations(self.others[2:])
+        large, large_queries = self.get_chats()
+        self.assertEqual(len(small), 3)
+        self.assertEqual(len(large), 14)
+        self.assertEqual(small_queries, large_queries)
+
+    def test_output_matches_per_conversation_serialization(self):
+        self.add_conversations(self.others[:5])
+        data, _ = self.get_chats()
+        conversations = Conversation.objects.filter(users__in=[self.user]).order_by('-last_activity_at', '-id')
+        expected = [ConservationSerializer(conversation, context={'user': self.user}).data
+                    for conversation in conversations]
+        self.assertEqual(data, json.loads(JSONRenderer().render(expected)))
+
+
+class ConversationActivityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob, cls.eve, cls.grace = (
+            User.objects.create(username=name) for name in ('ada', 'bob', 'eve', 'grace')
+        )
+        cls.base = timezone.now() - timedelta(days=1)
+        cls.chats = {}
+        for other, created in ((cls.bob, 0), (cls.eve, 60), (cls.grace, 10)):
+            chat = Conversation.objects.get_or_create_personal_conversation(cls.ada, other)
+            created_at = cls.base + timedelta(minutes=created)
+            Conversation.objects.filter(pk=chat.pk).update(created_at=created_at, last_activity_at=created_at)
+            cls.chats[other.username] = chat
+        # Written without store(), so the pointers are stale until the rebuild.
+        Message.objects.bulk_create([
+            Message(conversation=cls.chats['bob'], sender=cls.bob, recipient=cls.ada, content='late',
+                    created_at=cls.base + timedelta(hours=3)),
+            Message(conversation=cls.chats['bob'], sender=cls.ada, recipient=cls.bob, content='early',
+                    created_at=cls.base + timedelta(hours=2)),
+            Message(conversation=cls.chats['grace'], sender=cls.grace, recipient=cls.ada, content='hi',
+                    created_at=cls.base + timedelta(minutes=30)),
+        ])
+        call_command('rebuild_conversation_activity', stdout=StringIO())
+
+    def get_chats(self, **params):
+        return self.client.get('/api/chats', params, HTTP_AUTHORIZATION=f'Token {self.ada.auth_token.key}')
+
+    def summary(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [(chat['other_user']['username'], chat['last_message'] and chat['last_message']['content'])
+                for chat in response.json()]
+
+    def test_rebuild_sets_the_pointers_and_empty_conversations_keep_their_creation_time(self):
+        bob, eve = Conversation.objects.get(pk=self.chats['bob'].pk), Conversation.objects.get(pk=self.chats['eve'].pk)
+        self.assertEqual((bob.last_message.content, bob.last_activity_at), ('late', self.base + timedelta(hours=3)))
+        self.assertEqual((eve.last_message, eve.last_activity_at), (None, self.base + timedelta(minutes=60)))
+
+    def test_chats_are_ordered_by_activity(self):
+        self.assertEqual(self.summary(self.get_chats()), [('bob', 'late'), ('eve', None), ('grace', 'hi')])
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.store(self.chats['grace'], self.grace, 'news', recipient=self.ada)
+        get_conversation_cache().flush()
+        self.assertEqual(self.summary(self.get_chats()), [('grace', 'news'), ('bob', 'late'), ('eve', None)])
+
+    def test_since_filters_and_skips_the_cache(self):
+        get_conversation_cache().clear()
+        self.get_chats()
+        since = (self.base + timedelta(minutes=45)).isoformat()
+        self.assertEqual(self.summary(self.get_chats(since=since)), [('bob', 'late'), ('eve', None)])
+        # The commit never happens in this test, so the cached list isn't invalidated.
+        Message.objects.store(self.chats['grace'], self.grace, 'news', recipient=self.ada)
+        self.assertEqual(self.summary(self.get_chats())[-1], ('grace', 'hi'))
+        self.assertEqual(self.summary(self.get_chats(since=since))[0], ('grace', 'news'))
+
+    def test_invalid_since(self):
+        response = self.get_chats(since='yesterday')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'since': ['Invalid datetime.']})
+
+
+class PersonalConversationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'user{i}') for i in range(3)]
+
+    def test_both_orderings_find_the_same_conversation_in_one_query(self):
+        conversation = Conversation.objects.get_or_create_personal_conversation(self.users[0], self.users[1])
+        with self.assertNumQueries(1):
+            found = Conversation.objects.get_or_create_personal_conversation(self.users[1], self.users[0])
+        self.assertEqual(found, conversation)
+        self.assertEqual(set(conversation.users.all()), {self.users[0], self.users[1]})
+
+    def test_backfill_keys_the_oldest_conversation_of_a_pair(self):
+        conversations = []
+        for _ in range(2):
+            conversation = Conversation.objects.create(type='personal', name='legacy')
+            conversation.users.add(self.users[2], self.users[0])
+            conversations.append(conversation)
+
+        self.assertEqual(Conversation.objects.backfill_pair_keys(), (1, 1))
+        found = Conversation.objects.get_or_create_personal_conversation(self.users[0], self.users[2])
+        self.assertEqual(found, conversations[0])
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        get_token_cache().clear()
+        self.user = User.objects.create(username='user')
+        self.key = self.user.auth_token.key
+        self.auth = CachedTokenAuthentication()
+
+    def test_repeated_authentication_hits_the_cache(self):
+        self.auth.authenticate_credentials(self.key)
+        with self.assertNumQueries(0):
+            user, token = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(user, self.user)
+        self.assertEqual(token.key, self.key)
+        self.assertEqual(get_token_cache().stats()['hits'], 1)
+        self.assertEqual(get_token_cache().stats()['misses'], 1)
+
+    def test_deleted_token_is_evicted(self):
+        self.auth.authenticate_credentials(self.key)
+        self.user.auth_token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.authenticate_credentials(self.key)
+
+    def test_deactivated_user_is_evicted(self):
+        self.auth.authenticate_credentials(self.key)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.authenticate_credentials(self.key)
+
+    def test_least_recently_used_entry_is_dropped(self):
+        cache = TokenCache(max_size=2)
+        tokens = [User.objects.create(username=f'lru{i}').auth_token for i in range(3)]
+        cache.set(tokens[0].key, tokens[0].user, tokens[0])
+        cache.set(tokens[1].key, tokens[1].user, tokens[1])
+        cache.get(tokens[0].key)
+        cache.set(tokens[2].key, tokens[2].user, tokens[2])
+        self.assertIsNotNone(cache.get(tokens[0].key))
+        self.assertIsNone(cache.get(tokens[1].key))
+
+
+class TypingIndicatorTests(SimpleTestCase):
+    class Consumer:
+        def __init__(self):
+            self.broadcasts = []
+            self.background_tasks = set()
+
+        async def broadcast_typing(self, typing):
+            self.broadcasts.append(typing)
+
+        def run_in_background(self, coroutine):
+            task = asyncio.ensure_future(coroutine)
+            self.background_tasks.add(task)
+
+    async def test_only_transitions_are_broadcast(self):
+        consumer = self.Consumer()
+        indicator = TypingIndicator(consumer, timeout=10, debounce=0.01)
+        for _ in range(5):
+            await indicator.update(True)
+        await indicator.update(False)
+        await indicator.update(True)
+        await indicator.update(False)
+        await asyncio.sleep(0.05)
+        self.assertEqual(consumer.broadcasts, [True, False])
+
+    async def test_typing_stops_after_timeout(self):
+        consumer = self.Consumer()
+        indicator = TypingIndicator(consumer, timeout=0.01, debounce=1)
+        await indicator.update(True)
+        await asyncio.sleep(0.05)
+        self.assertEqual(consumer.broadcasts, [True, False])
+
+    async def test_stop_is_immediate(self):
+        consumer = self.Consumer()
+        indicator = TypingIndicator(consumer)
+        await indicator.update(True)
+        await indicator.stop()
+        await indicator.stop()
+        self.assertEqual(consumer.broadcasts, [True, False])
+        self.assertIsNone(indicator.timer)
+
+    async def test_sockets_of_a_user_share_one_state(self):
+        first, second, other = self.Consumer(), self.Consumer(), self.Consumer()
+        indicator = TypingIndicator.attach((1, 'ada'), first, timeout=10, debounce=0.01)
+        self.assertIs(TypingIndicator.attach((1, 'ada'), second), indicator)
+        self.assertIsNot(TypingIndicator.attach((1, 'bob'), other), indicator)
+        await indicator.update(True)
+        await indicator.update(True)
+        await indicator.detach(first)
+        # The remaining socket broadcasts the stop.
+        await indicator.update(False)
+        await asyncio.sleep(0.05)
+        self.assertEqual((first.broadcasts, second.broadcasts), ([True], [False]))
+
+        await indicator.update(True)
+        await indicator.detach(second)
+        self.assertEqual(second.broadcasts, [False, True, False])
+        self.assertNotIn((1, 'ada'), TypingIndicator.attached)
+        await TypingIndicator.attached[(1, 'bob')].detach(other)
+        self.assertEqual(TypingIndicator.attached, {})
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def make_queue(self, max_size):
+        self.sent, self.closed = [], []
+        self.unblock = asyncio.Event()
+
+        async def send(text):
+            # The client reads nothing until the test unblocks it.
+            await self.unblock.wait()
+            self.sent.append(text)
+
+        async def close(last_message_id):
+            self.closed.append(last_message_id)
+
+        async def abort():
+            self.closed.append('aborted')
+
+        return OutboundQueue(send, close, abort, max_size=max_size)
+
+    async def test_typing_and_presence_frames_merge_per_user(self):
+        queue = self.make_queue(10)
+        queue.put('chat_message', 'm1', message_id=1)
+        queue.put('typing', 'ada typing', user='ada')
+        queue.put('user_join', 'bob joined', user='bob')
+        queue.put('typing', 'ada stopped', user='ada')
+        queue.put('user_leave', 'bob left', user='bob')
+        self.unblock.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['m1', 'ada stopped', 'bob left'])
+
+    async def test_full_queue_drops_typing_before_chat_messages(self):
+        queue = self.make_queue(3)
+        queue.put('chat_message', 'm1', message_id=1)
+        await asyncio.sleep(0)
+        queue.put('typing', 'ada typing', user='ada')
+        queue.put('chat_message', 'm2', message_id=2)
+        queue.put('chat_message', 'm3', message_id=3)
+        queue.put('chat_message', 'm4', message_id=4)
+        queue.put('typing', 'bob typing', user='bob')
+        self.unblock.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['m1', 'm2', 'm3', 'm4'])
+        self.assertEqual(self.closed, [])
+
+    async def test_client_too_far_behind_is_closed_with_resume_hint(self):
+        queue = self.make_queue(2)
+        queue.put('chat_message', 'm1', message_id=1)
+        await asyncio.sleep(0)
+        queue.put('chat_message', 'm2', message_id=2)
+        queue.put('chat_message', 'm3', message_id=3)
+        queue.put('chat_message', 'm4', message_id=4)
+        queue.put('chat_message', 'm5', message_id=5)
+        self.unblock.set()
+        await queue.task
+        self.assertEqual(self.sent, ['m1'])
+        self.assertEqual(self.closed, [1])
+
+    async def test_failed_send_closes_the_socket(self):
+        queue = self.make_queue(10)
+        self.unblock.set()
+        send = queue.send
+
+        async def failing_send(text):
+            if text == 'm2':
+                raise RuntimeError('connection reset')
+            await send(text)
+
+        queue.send = failing_send
+        with self.assertLogs('main.outbound', 'ERROR'):
+            queue.put('chat_message', 'm1', message_id=1)
+            queue.put('chat_message', 'm2', message_id=2)
+            queue.put('chat_message', 'm3', message_id=3)
+            await queue.task
+        self.assertEqual((self.sent, self.closed), (['m1'], ['aborted']))
+        self.assertIsNone(queue.task)
+        self.assertEqual(len(queue), 0)
+        queue.put('chat_message', 'm4', message_id=4)
+        self.assertEqual((len(queue), queue.task), (0, None))
+
+
+class ShardedChannelLayerTests(SimpleTestCase):
+    async def test_group_send_reaches_members_on_every_shard(self):
+        layer = ShardedChannelLayer(shards=3)
+        channels = [await layer.new_channel() for _ in range(6)]
+        for channel in channels:
+            await layer.group_add('room', channel)
+        await layer.group_discard('room', channels[0])
+        await layer.group_send('room', {'type': 'chat.message', 'packed': b'\x93'})
+        for channel in channels[1:]:
+            self.assertEqual(await layer.receive(channel), {'type': 'chat.message', 'packed': b'\x93'})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channels[0]), 0.01)
+        await layer.close()
+
+    async def test_group_send_many_sends_once_per_group(self):
+        layer = ShardedChannelLayer(shards=3)
+        channels = [await layer.new_channel() for _ in range(3)]
+        groups = [f'user{index}__notifications' for index in range(3)]
+        for group, channel in zip(groups, channels):
+            await layer.group_add(group, channel)
+        await layer.group_send_many(groups, {'type': 'notify'})
+        for channel in channels:
+            self.assertEqual(await layer.receive(channel), {'type': 'notify'})
+        await layer.close()
+
+    async def test_full_channel_rejects_send(self):
+        layer = ShardedChannelLayer(shards=2, capacity=1)
+        await layer.send('worker', {'type': 'first'})
+        with self.assertRaises(ChannelFull):
+            await layer.send('worker', {'type': 'second'})
+        self.assertEqual(await layer.receive('worker'), {'type': 'first'})
+
+    async def test_full_socket_buffer_in_this_process_rejects_send(self):
+        layer = ShardedChannelLayer(capacity=1)
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'first'})
+        await asyncio.sleep(0.01)
+        layer.start_reader(layer.non_local_name(channel))
+        await asyncio.sleep(0.01)
+        with self.assertRaises(ChannelFull):
+            await layer.send(channel, {'type': 'second'})
+        self.assertEqual(await layer.receive(channel), {'type': 'first'})
+        await layer.close()
+
+    async def test_cancelled_receive_forgets_the_socket(self):
+        layer = ShardedChannelLayer()
+        channel = await layer.new_channel()
+        queue = layer.non_local_name(channel)
+        await layer.send(channel, {'type': 'first'})
+        receive = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0.01)
+        self.assertEqual(receive.result(), {'type': 'first'})
+        receive = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0.01)
+        # A message reaching the buffer as the receive is cancelled stays behind in it.
+        layer.local_channels[queue][channel].put_nowait({'type': 'unread'})
+        receive.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await receive
+        self.assertNotIn(queue, layer.local_channels)
+        self.assertNotIn(queue, layer.readers)
+        await layer.close()
+
+    def test_adding_a_shard_moves_a_fraction_of_the_keys(self):
+        three, four = HashRing(['a', 'b', 'c']), HashRing(['a', 'b', 'c', 'd'])
+        keys = [f'group{index}' for index in range(1000)]
+        moved = [key for key in keys if three.lookup(key) != four.lookup(key)]
+        self.assertLess(len(moved), 400)
+        self.assertTrue(all(four.lookup(key) == 3 for key in moved))
+
+
+class RedisShardedChannelLayerTests(SimpleTestCase):
+    """
+    Runs the layer against the Redis server in CHANNEL_LAYERS, skipped when there is none.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        try:
+            import redis
+        except ImportError:
+            raise unittest.SkipTest('redis is not installed')
+        cls.hosts = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts']
+        try:
+            for address, port in cls.hosts:
+                redis.Redis(host=address, port=port, socket_connect_timeout=0.5).ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest('no Redis server')
+
+    async def asyncSetUp(self):
+        self.layer = ShardedChannelLayer(hosts=self.hosts, prefix=f'test{uuid.uuid4().hex}', capacity=2)
+
+    async def asyncTearDown(self):
+        await self.layer.flush()
+        await self.layer.close()
+
+    async def test_send_and_receive(self):
+        await self.layer.send('worker', {'type': 'first', 'packed': b'\x93'})
+        await self.layer.send('worker', {'type': 'second'})
+        with self.assertRaises(ChannelFull):
+            await self.layer.send('worker', {'type': 'third'})
+        self.assertEqual(await self.layer.receive('worker'), {'type': 'first', 'packed': b'\x93'})
+        self.assertEqual(await self.layer.receive('worker'), {'type': 'second'})
+
+    async def test_group_send_reaches_process_channels(self):
+        channels = [await self.layer.new_channel() for _ in range(3)]
+        for channel in channels:
+            await self.layer.group_add('room', channel)
+        await self.layer.group_discard('room', channels[0])
+        await self.layer.group_send('room', {'type': 'chat.message'})
+        for channel in channels[1:]:
+            self.assertEqual(await asyncio.wait_for(self.layer.receive(channel), 5), {'type': 'chat.message'})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.layer.receive(channels[0]), 0.1)
+
+    async def test_group_send_many_sends_once_per_group(self):
+        channels = [await self.layer.new_channel() for _ in range(3)]
+        groups = [f'user{index}__notifications' for index in range(3)]
+        for group, channel in zip(groups, channels):
+            await self.layer.group_add(group, channel)
+        await self.layer.group_send_many(groups, {'type': 'notify'})
+        for channel in channels:
+            self.assertEqual(await asyncio.wait_for(self.layer.receive(channel), 5), {'type': 'notify'})
+
+
+@override_settings(CONVO_CONVERSATION_CACHE={'INVALIDATION_DELAY': 0.2})
+class ConversationListInvalidationTests(TransactionTestCase):
+    def setUp(self):
+        self.ada, self.bob, self.eve = (User.objects.create(username=name) for name in ('ada', 'bob', 'eve'))
+        self.room = Conversation.objects.create(type='group', name='room')
+        self.room.users.add(self.ada, self.bob, self.eve)
+        get_conversation_cache().flush()
+        get_conversation_cache().clear()
+
+    def get_chats(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chats', HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+        return response.json(), len(queries)
+
+    def test_stored_messages_invalidate_in_the_background_once_per_delay(self):
+        cache = get_conversation_cache()
+        self.get_chats(self.ada)
+        invalidations = cache.stats()['invalidations']
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(10):
+                Message.objects.store(self.room, self.bob, f'news {i}')
+        self.assertNotIn('main_membership', ' '.join(q['sql'] for q in queries if q['sql'].startswith('SELECT')))
+        # Served from the cache until the background thread gets to it.
+        self.assertEqual(self.get_chats(self.ada)[1], 0)
+        deadline = time.monotonic() + 5
+        while cache.stats()['invalidations'] == invalidations and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(cache.invalidation_delay * 2)
+        # The ten messages invalidate the three members once.
+        self.assertEqual(cache.stats()['invalidations'] - invalidations, 3)
+        data, queries = self.get_chats(self.ada)
+        self.assertGreater(queries, 0)
+        self.assertEqual(data[0]['last_message']['content'], 'news 9')
+
+
+class ConversationListInvalidationThreadTests(SimpleTestCase):
+    def make_cache(self, failures):
+        cache = ConversationListCache(invalidation_delay=0.01)
+        self.calls = []
+
+        def invalidate_conversations(conversation_ids, user_ids=()):
+            self.calls.append(set(conversation_ids))
+            if len(self.calls) <= failures:
+                raise ConnectionError('cache unavailable')
+
+        cache.invalidate_conversations = invalidate_conversations
+        return cache
+
+    def test_failures_are_retried_with_backoff_and_logged_once(self):
+        cache = self.make_cache(failures=3)
+        with self.assertLogs('main.conversation_cache') as logs:
+            cache.invalidate_later([1])
+            deadline = time.monotonic() + 5
+            while len(self.calls) < 4 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            cache.stop()
+        self.assertEqual(self.calls, [{1}] * 4)
+        self.assertEqual([record.levelname for record in logs.records], ['ERROR', 'WARNING'])
+        self.assertFalse(cache.worker.is_alive())
+
+    def test_stop_invalidates_what_is_queued(self):
+        cache = self.make_cache(failures=0)
+        cache.invalidation_delay = 60
+        cache.invalidate_later([1, 2])
+        cache.stop()
+        self.assertEqual(self.calls, [{1, 2}])
+        self.assertFalse(cache.worker.is_alive())
+        cache.invalidate_later([3])
+        self.assertEqual(self.calls, [{1, 2}, {3}])
+
+
+class InstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user')
+        cls.admin = User.objects.create(username='admin', is_staff=True)
+
+    def get(self, path, user):
+        return self.client.get(path, HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+
+    def test_requests_are_recorded_per_route(self):
+        count, _ = event_duration.get(event='GET api/chats')
+        queries = event_queries.get(event='GET api/chats')
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.get('/api/chats', self.user).status_code, 200)
+        self.assertEqual(event_duration.get(event='GET api/chats')[0], count + 1)
+        self.assertEqual(event_queries.get(event='GET api/chats'), queries + len(captured))
+
+    def test_metrics_endpoint_serves_prometheus_text_to_admins(self):
+        self.get('/api/chats', self.user)
+        self.assertEqual(self.get('/api/metrics', self.user).status_code, 403)
+        response = self.get('/api/metrics', self.admin)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('convo_event_duration_seconds_count{event="GET api/chats"}', response.content.decode())
+
+
+class UserSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.caller = User.objects.create(username='adamant')
+        for username, first_name, last_name in [
+            ('ada', 'Ada', 'Lovelace'),
+            ('adam', 'Adam', 'Smith'),
+            ('grace', 'Grace', 'Hopper'),
+            ('bob', 'Bob', 'Adams'),
+            ('john', 'John', 'Doe'),
+            ('jodi', 'Jodi', 'Foster'),
+        ]:
+            User.objects.create(username=username, first_name=first_name, last_name=last_name)
+
+    def search(self, url):
+        response = self.client.get(url, HTTP_AUTHORIZATION=f'Token {self.caller.auth_token.key}')
+        self.assertEqual(response.status_code, 200)
+        return [user['username'] for user in response.data['results']], response.data['next']
+
+    def test_terms_match_substrings_of_usernames_and_names(self):
+        self.assertEqual(self.search('/api/users?q=LOVE')[0], ['ada'])
+        self.assertEqual(self.search('/api/users?q=ada')[0], ['ada', 'adam', 'bob'])
+        self.assertEqual(self.search('/api/users?q=ada smi')[0], ['adam'])
+
+    def test_short_terms_match_username_prefixes(self):
+        self.assertEqual(self.search('/api/users?q=Ad')[0], ['ada', 'adam'])
+
+    def test_users_deleted_after_the_search_are_skipped(self):
+        ada_id = User.objects.get(username='ada').id
+
+        def load_users(ids):
+            User.objects.filter(id=ada_id).delete()
+            return serializers.load_users(ids)
+
+        with mock.patch('main.views.load_users', load_users):
+            self.assertEqual(self.search('/api/users?q=ada')[0], ['adam', 'bob'])
+
+    def test_index_lookup_is_cached(self):
+        self.search('/api/users?q=lovelace')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search('/api/users?q=lovelace')[0], ['ada'])
+        self.assertFalse([query for query in queries if 'sqlite_master' in query['sql']])
+
+    def test_short_terms_after_the_first_filter_like_long_ones(self):
+        self.assertEqual(self.search('/api/users?q=jo do')[0], ['john'])
+        self.assertEqual(self.search('/api/users?q=ad SM')[0], ['adam'])
+        self.assertEqual(self.search('/api/users?q=do jo')[0], [])
+
+    def test_pages_follow_the_next_links(self):
+        for query in ('', 'ada', 'a'):
+            usernames, url = self.search(f'/api/users?q={query}&page_size=1')
+            while url:
+                page, url = self.search(url)
+                usernames += page
+            self.assertEqual(usernames, self.search(f'/api/users?q={query}')[0])
+            self.assertNotIn('adamant', usernames)
+
+    def test_index_follows_renames_and_deletes(self):
+        User.objects.filter(username='grace').update(last_name='Brewster')
+        self.assertEqual(self.search('/api/users?q=brewster')[0], ['grace'])
+        self.assertEqual(self.search('/api/users?q=hopper')[0], [])
+        User.objects.filter(username='ada').delete()
+        self.assertEqual(self.search('/api/users?q=love')[0], [])
+
+    @override_settings(CONVO_USER_SEARCH={'BACKEND': 'main.search.DatabaseUserSearch'})
+    def test_database_search_returns_the_same_results(self):
+        self.assertEqual(self.search('/api/users?q=ada')[0], ['ada', 'adam', 'bob'])
+        self.assertEqual(self.search('/api/users?q=ada smi')[0], ['adam'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(
+            '/api/users?cursor=abc', HTTP_AUTHORIZATION=f'Token {self.caller.auth_token.key}'
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob, cls.eve = (User.objects.create(username=name) for name in ('ada', 'bob', 'eve'))
+        cls.chat = Conversation.objects.get_or_create_personal_conversation(cls.ada, cls.bob)
+        cls.room = Conversation.objects.create(type='group', name='engineers')
+        cls.room.users.add(cls.ada, cls.eve)
+        cls.secret = Conversation.objects.get_or_create_personal_conversation(cls.bob, cls.eve)
+        cls.mentions = Message.objects.store(cls.chat, cls.ada, 'The engine, the engine room and the engines.')
+        cls.schedule = Message.objects.store(cls.chat, cls.bob, 'Schedule for the engine room is out')
+        Message.objects.store(cls.chat, cls.bob, 'Lunch at noon')
+        cls.running = Message.objects.store(cls.room, cls.eve, 'Engines running')
+        Message.objects.store(cls.secret, cls.eve, 'The engine secret')
+
+    def search(self, url, user=None):
+        user = user or self.ada
+        response = self.client.get(url, HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']], response.data['next']
+
+    def test_hits_are_ranked_within_the_callers_conversations(self):
+        self.assertEqual(
+            self.search('/api/messages/search?q=Engines')[0],
+            [self.mentions.id, self.running.id, self.schedule.id],
+        )
+        self.assertEqual(self.search(f'/api/messages/search?q=engine&conversation={self.room.id}')[0],
+                         [self.running.id])
+        self.assertEqual(self.search('/api/messages/search?q=engine room schedule')[0], [self.schedule.id])
+
+    def test_pages_follow_the_next_links(self):
+        ids, url = self.search('/api/messages/search?q=engine&page_size=1')
+        while url:
+            page, url = self.search(url)
+            ids += page
+        self.assertEqual(ids, self.search('/api/messages/search?q=engine')[0])
+
+    def test_pages_keep_the_first_pages_matches(self):
+        hits = self.search('/api/messages/search?q=engine')[0]
+        ids, url = self.search('/api/messages/search?q=engine&page_size=1')
+        newer = Message.objects.store(self.chat, self.bob, 'engine engine')
+        while url:
+            page, url = self.search(url)
+            ids += page
+        self.assertEqual(ids, hits)
+        self.assertIn(newer.id, self.search('/api/messages/search?q=engine')[0])
+
+    def test_malformed_cursor(self):
+        response = self.client.get('/api/messages/search?q=engine&cursor=0.5|3',
+                                   HTTP_AUTHORIZATION=f'Token {self.ada.auth_token.key}')
+        self.assertEqual(response.status_code, 404)
+
+    def test_bulk_stored_messages_are_indexed(self):
+        message = Message(id=10 ** 12, conversation=self.room, sender=self.eve, content='Turbine inspection')
+        Message.objects.bulk_store([message])
+        self.assertEqual(self.search('/api/messages/search?q=turbine')[0], [message.id])
+        self.assertEqual(self.search('/api/messages/search?q=turbine', user=self.bob)[0], [])
+
+    def test_rebuild_keeps_the_same_hits(self):
+        hits = self.search('/api/messages/search?q=engine')[0]
+        call_command('rebuild_message_search', batch_size=2, stdout=StringIO())
+        self.assertEqual(self.search('/api/messages/search?q=engine')[0], hits)
+
+    @override_settings(CONVO_MESSAGE_SEARCH={'BACKEND': 'main.search.DatabaseMessageSearch'})
+    def test_database_search_returns_newest_first(self):
+        self.assertEqual(
+            self.search('/api/messages/search?q=engine')[0],
+            [self.running.id, self.schedule.id, self.mentions.id],
+        )
+
+    def test_query_is_required(self):
+        response = self.client.get('/api/messages/search?q=', HTTP_AUTHORIZATION=f'Token {self.ada.auth_token.key}')
+        self.assertEqual(response.status_code, 400)
+
+
+class MessageArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob = User.objects.create(username='ada'), User.objects.create(username='bob')
+        cls.chat = Conversation.objects.get_or_create_personal_conversation(cls.ada, cls.bob)
+        Conversation.objects.filter(pk=cls.chat.pk).update(created_at=timezone.now() - timedelta(days=400))
+        cls.messages = []
+        for i in range(30):
+            message = Message.objects.store(cls.chat, cls.ada, f'budget line {i}', recipient=cls.bob)
+            # A message a day half a year ago, the last five are recent.
+            created_at = timezone.now() - timedelta(days=200 - i) if i < 25 else message.created_at
+            Message.objects.filter(pk=message.pk).update(created_at=created_at)
+            message.created_at = created_at
+            cls.messages.append(message)
+        Membership.objects.mark_read(cls.bob, cls.chat)
+
+    def archive(self, **options):
+        call_command('archive_messages', stdout=StringIO(), **options)
+
+    def get(self, url):
+        response = self.client.get(url, HTTP_AUTHORIZATION=f'Token {self.ada.auth_token.key}')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_old_messages_move_in_batches_and_history_reads_through(self):
+        self.archive(batch_size=7)
+        self.assertEqual(ArchivedMessage.objects.count(), 25)
+        self.assertEqual(Message.objects.count(), 5)
+
+        ids, url = [], f'/api/messages?conversation={self.chat.name}&page_size=4'
+        while url:
+            page = self.get(url)
+            ids += [message['id'] for message in page['results']]
+            url = page['next']
+        self.assertEqual(ids, [message.id for message in reversed(self.messages)])
+        # Newer pages walk back up from the archive into the hot table.
+        page = self.get(page['previous'])
+        self.assertEqual([message['id'] for message in page['results']], ids[-6:-2])
+
+        page = self.get('/api/chat/bob/messages?page_size=10')
+        self.assertEqual([message['content'] for message in page['results']][4:6], ['budget line 25', 'budget line 24'])
+
+    def test_last_message_and_unread_messages_stay_hot(self):
+        Message.objects.filter(pk=self.messages[10].pk).update(read=False)
+        Membership.objects.filter(user=self.bob, conversation=self.chat).update(unread_count=1)
+        get_archiver().archive()
+        self.assertEqual(ArchivedMessage.objects.count(), 10)
+
+        # Archiving never goes past the oldest unread message.
+        get_archiver().archive(now=timezone.now() + timedelta(days=365))
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [m.id for m in self.messages[10:]])
+        # Read receipts still reach the unread message.
+        Membership.objects.mark_read(self.bob, self.chat)
+        self.assertTrue(Message.objects.get(pk=self.messages[10].pk).read)
+        get_archiver().archive(now=timezone.now() + timedelta(days=365))
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.messages[-1].id])
+
+    def test_resume_and_search_find_archived_messages(self):
+        self.archive()
+        history = MessageHistory([self.chat.id])
+        position = history.position(self.messages[20].id)
+        self.assertEqual(position, (self.messages[20].created_at, self.messages[20].id))
+        self.assertEqual([message.id for message in history.after(*position, 6)],
+                         [message.id for message in self.messages[21:27]])
+
+        page = self.get('/api/messages/search?q=budget&page_size=100')
+        self.assertEqual(len(page['results']), 30)
+        with override_settings(CONVO_MESSAGE_SEARCH={'BACKEND': 'main.search.DatabaseMessageSearch'}):
+            page = self.get('/api/messages/search?q=budget&page_size=100')
+        self.assertEqual([message['id'] for message in page['results']],
+                         [message.id for message in reversed(self.messages)])
+
+
+class ConversationListCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada, cls.bob, cls.eve = (User.objects.create(username=name) for name in ('ada', 'bob', 'eve'))
+        cls.chat = Conversation.objects.get_or_create_personal_conversation(cls.ada, cls.bob)
+        cls.other = Conversation.objects.get_or_create_personal_conversation(cls.bob, cls.eve)
+        Message.objects.store(cls.chat, cls.ada, 'hello', recipient=cls.bob)
+
+    def setUp(self):
+        get_conversation_cache().clear()
+
+    @contextmanager
+    def committed(self):
+        """
+        Run the on-commit invalidations of the block, and the ones they queue, before returning.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            yield
+        get_conversation_cache().flush()
+
+    def get_chats(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chats', HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_repeated_lists_are_served_from_the_cache(self):
+        stats = get_conversation_cache().stats()
+        first, first_queries = self.get_chats(self.ada)
+        second, second_queries = self.get_chats(self.ada)
+        self.assertEqual(first, second)
+        # Authentication is cached too, so a hit costs no query at all.
+        self.assertEqual(second_queries, 0)
+        self.assertGreater(first_queries, 0)
+        self.assertEqual(get_conversation_cache().stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(get_conversation_cache().stats()['misses'], stats['misses'] + 1)
+
+    def test_only_the_members_are_invalidated(self):
+        self.get_chats(self.ada)
+        self.get_chats(self.bob)
+        self.get_chats(self.eve)
+        with self.committed():
+            Message.objects.store(self.other, self.eve, 'news', recipient=self.bob)
+        self.assertEqual(self.get_chats(self.ada)[1], 0)
+        data, queries = self.get_chats(self.bob)
+        self.assertGreater(queries, 0)
+        self.assertEqual(data[0]['last_message']['content'], 'news')
+        self.assertGreater(self.get_chats(self.eve)[1], 0)
+
+    def test_read_receipts_and_membership_changes_invalidate(self):
+        self.get_chats(self.ada)
+        with self.committed():
+            Membership.objects.mark_read(self.bob, self.chat)
+        data, queries = self.get_chats(self.ada)
+        self.assertGreater(queries, 0)
+        self.assertEqual(data[0]['last_message']['status'], 'seen')
+
+        room = Conversation.objects.create(type='group', name='room')
+        with self.committed():
+            room.users.add(self.ada, self.eve)
+        self.assertEqual([c['id'] for c in self.get_chats(self.ada)[0]], [room.id, self.chat.id])
+        with self.committed():
+            room.users.remove(self.eve)
+        self.assertEqual(self.get_chats(self.ada)[0][0]['users_count'], 1)
+
+    def test_group_read_receipts_invalidate_nobody(self):
+        room = Conversation.objects.create(type='group', name='room')
+        with self.committed():
+            room.users.add(self.ada, self.bob)
+            Message.objects.store(room, self.ada, 'hey')
+        self.get_chats(self.ada)
+        with self.committed():
+            Membership.objects.mark_read(self.bob, room)
+        self.assertEqual(self.get_chats(self.ada)[1], 0)
+
+    def test_login_takes_the_last_conversation_from_the_cache(self):
+        self.ada.set_password('secret')
+        self.ada.last_conversation = str(self.chat.id)
+        self.ada.save()
+        self.get_chats(self.ada)
+        with self.assertNumQueries(3):
+            response = self.client.post('/auth-token/', {'username': 'ada', 'password': 'secret'})
+        self.assertEqual(response.json()['last_conversation'], self.get_chats(self.ada)[0][0])
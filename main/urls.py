@@ -1,15 +1,19 @@
 from django.urls import path
 
-from .views import UserView, ConversationView, MessagesView, MessageViewSet, FriendsView, UserLogoutView
+from .views import UserView, UsersView, ConversationView, MessagesView, MessageViewSet, FriendsView, \
+    MessageSearchView, UserLogoutView, MetricsView
 
 urlpatterns = [
     path('user/add', UserView.as_view(), name='user_add'),
     path('user/<int:obj_id>', UserView.as_view(), name='user_view'),
+    path('users', UsersView.as_view(), name='users_view'),
     path('friends', FriendsView.as_view(), name='friends_view'),
     path('chats', ConversationView.as_view(), name='conversation_view'),
     path('chats/add', ConversationView.as_view(), name='conversation_add_view'),
     path('chat/<str:username>/messages', MessagesView.as_view(), name='messages_view'),
     path('messages', MessageViewSet.as_view({'get': 'list'})),
+    path('messages/search', MessageSearchView.as_view(), name='message_search_view'),
     path('user/logout', UserLogoutView.as_view(), name='user_logout'),
+    path('metrics', MetricsView.as_view(), name='metrics_view'),
 ]
 
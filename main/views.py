@@ -1,16 +1,23 @@
+from django.http import HttpResponse
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.decorators import permission_classes
 from rest_framework.mixins import ListModelMixin
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 
+from .archive import MessageHistory, load_messages
+from .conversation_cache import get_conversation_cache
+from .metrics import REGISTRY
 from .models import Conversation, User, Message
-from .pagination import MessagePagination
-from .serializers import ConservationSerializer, CreateUserSerializer, UserSerializer, MessageSerializer
+from .pagination import MessagePagination, SearchPagination
+from .search import get_message_search, get_user_search
+from .serializers import ConservationSerializer, CreateUserSerializer, UserSerializer, MessageSerializer, \
+    MessageSearchSerializer, load_users
 
 
 class CustomObtainAuthTokenView(ObtainAuthToken):
@@ -20,11 +27,14 @@ class CustomObtainAuthTokenView(ObtainAuthToken):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data["user"]
         token, created = Token.objects.get_or_create(user=user)
-        last = Conversation.objects.filter(id=user.last_conversation).first()
-        serializer = ConservationSerializer(last, context={'user': user, 'request': request})
+        conversations = get_conversation_cache().get(user, request.build_absolute_uri('/')) or []
+        last = next((c for c in conversations if str(c['id']) == user.last_conversation), None)
+        if last is None:
+            last = Conversation.objects.with_list_fields(user).filter(id=user.last_conversation).first()
+            last = ConservationSerializer(last, context={'user': user, 'request': request}).data or None
         response_data = {
             "token": token.key,
-            "last_conversation": serializer.data or None
+            "last_conversation": last
         }
         serializer1 = UserSerializer(user)
         response_data.update(serializer1.data)
@@ -60,14 +70,21 @@ class UserView(APIView):
 
 
 class UsersView(APIView):
+    permission_classes = [IsAuthenticated, ]
+    pagination_class = SearchPagination
+
     """
-    create new user.
+    search the user directory, a page at a time.
+    pass ?q=<terms> to match usernames and names, and ?cursor=<next> for the next page.
     """
 
-    @permission_classes([IsAuthenticated, ])
     def get(self, request):
-        serializer = UserSerializer(User.objects.exclude(username=request.user.username), many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        paginator = self.pagination_class()
+        ids = paginator.paginate_search(get_user_search(), request, exclude=request.user.id)
+        users = load_users(ids)
+        # Users deleted since the search are skipped.
+        serializer = UserSerializer([users[user_id] for user_id in ids if user_id in users], many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class FriendsView(APIView):
@@ -85,13 +102,30 @@ class ConversationView(APIView):
     permission_classes = [IsAuthenticated, ]
 
     """
-    get conversations
+    get conversations, most recently active first.
+    pass ?since=<ISO datetime> to only get conversations with activity after it.
     """
 
     def get(self, request):
-        conversation = Conversation.objects.filter(users__in=[request.user]).order_by("-created_at")
-        serializer = ConservationSerializer(conversation, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        conversation = (
+            Conversation.objects.with_list_fields(request.user)
+            .filter(memberships__user=request.user)
+            .order_by("-last_activity_at", "-id")
+        )
+        since = request.query_params.get("since")
+        if since:
+            since = parse_datetime(since)
+            if since is None:
+                return Response({"since": ["Invalid datetime."]}, status=status.HTTP_400_BAD_REQUEST)
+            conversation = conversation.filter(last_activity_at__gt=since)
+            serializer = ConservationSerializer(conversation, many=True, context={'request': request})
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        # The full list is cached per user, see main/conversation_cache.py.
+        data = get_conversation_cache().get_or_build(
+            request.user, request.build_absolute_uri('/'),
+            lambda: ConservationSerializer(conversation, many=True, context={'request': request}).data,
+        )
+        return Response(data, status=status.HTTP_200_OK)
 
     def post(self, request):
         conversation = None
@@ -130,8 +164,10 @@ class MessagesView(APIView):
     def get(self, request, username):
         user2 = User.objects.get(username=username)
         conversation = Conversation.objects.get_or_create_personal_conversation(request.user, user2)
-        serializer = MessageSerializer(conversation.messages, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        paginator = self.pagination_class()
+        messages = paginator.paginate_queryset(MessageHistory([conversation.id]), request, view=self)
+        serializer = MessageSerializer(messages, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class MessageViewSet(ListModelMixin, GenericViewSet):
@@ -142,14 +178,43 @@ class MessageViewSet(ListModelMixin, GenericViewSet):
 
     def get_queryset(self):
         conversation_name = self.request.GET.get("conversation")
-        queryset = (
-            Message.objects.filter(
-                conversation__name__contains=self.request.user.username,
-            )
-            .filter(conversation__name=conversation_name)
-            .order_by("-created_at")
+        # Resolve the conversations first, so the message page is read in index order instead of
+        # joining and sorting the whole history.
+        conversation_ids = list(
+            Conversation.objects.filter(
+                name__contains=self.request.user.username,
+                name=conversation_name,
+            ).values_list("id", flat=True)
+        )
+        # Pages read through to archived messages, see main/archive.py.
+        return MessageHistory(conversation_ids)
+
+
+class MessageSearchView(APIView):
+    permission_classes = [IsAuthenticated, ]
+    pagination_class = SearchPagination
+
+    """
+    search the messages of the caller's conversations, best match first.
+    pass ?q=<words>, optionally ?conversation=<id>, and ?cursor=<next> for the next page.
+    """
+
+    def get(self, request):
+        if not request.query_params.get("q", "").strip():
+            return Response({"q": ["This field is required."]}, status=status.HTTP_400_BAD_REQUEST)
+        conversation_id = request.query_params.get("conversation")
+        if conversation_id is not None:
+            try:
+                conversation_id = int(conversation_id)
+            except ValueError:
+                return Response({"conversation": ["A valid integer is required."]}, status=status.HTTP_400_BAD_REQUEST)
+        paginator = self.pagination_class()
+        ids = paginator.paginate_search(
+            get_message_search(), request, user=request.user, conversation_id=conversation_id
         )
-        return queryset
+        messages = load_messages(ids)
+        serializer = MessageSearchSerializer([messages[pk] for pk in ids if pk in messages], many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class UserLogoutView(APIView):
@@ -158,7 +223,18 @@ class UserLogoutView(APIView):
     def post(self, request):
         try:
             request.user.last_conversation = request.data['id']
-            request.user.save()
+            request.user.save(update_fields=['last_conversation'])
             return Response(status=status.HTTP_200_OK)
         except KeyError:
             pass
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser, ]
+
+    """
+    metrics of this worker process in the Prometheus text format.
+    """
+
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,71 @@
+"""
+Wire formats of the chat sockets.
+
+JSON is the default. A client can offer the ``convo.msgpack.v1`` websocket
+subprotocol to get binary MessagePack frames instead, when msgpack is
+installed. Frames have the same shape as their JSON versions, except that
+users are interned: the sender and recipient objects of messages are replaced
+by their username, and each user is described once per connection in a
+preceding frame::
+
+    {"type": "users", "users": [{"username": "ada", "first_name": "Ada", ...}]}
+
+Clients keep a username-to-user table filled from these frames. Definitions
+are not repeated when a user changes, a reconnect picks up the new version.
+Frames sent by the client may be MessagePack maps or JSON text.
+"""
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'convo.msgpack.v1'
+JSON_SUBPROTOCOL = 'convo.json.v1'
+
+USER_FIELDS = ('sender', 'recipient')
+
+
+def select_subprotocol(offered):
+    """
+    Return the first subprotocol offered by the client that we speak, or None for plain JSON.
+    """
+    for subprotocol in offered:
+        if subprotocol == JSON_SUBPROTOCOL or (subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None):
+            return subprotocol
+    return None
+
+
+def intern_message(message, users):
+    interned = dict(message)
+    for field in USER_FIELDS:
+        user = message.get(field)
+        if isinstance(user, dict) and 'username' in user:
+            users.setdefault(user['username'], user)
+            interned[field] = user['username']
+    return interned
+
+
+def intern_users(event):
+    """
+    Return a copy of `event` with the users of its messages replaced by their
+    username, and the {username: user} definitions taken out of it.
+    """
+    users = {}
+    message = event.get('message')
+    messages = event.get('messages')
+    if not isinstance(message, dict) and not isinstance(messages, list):
+        return event, users
+    event = dict(event)
+    if isinstance(message, dict):
+        event['message'] = intern_message(message, users)
+    if isinstance(messages, list):
+        event['messages'] = [intern_message(message, users) for message in messages]
+    return event, users
+
+
+def pack(content):
+    return msgpack.packb(content, use_bin_type=True)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, raw=False)
@@ -0,0 +1,239 @@
+"""
+Write-behind persistence for chat messages.
+
+When enabled, a message gets its id and timestamp in the worker and is
+acknowledged and broadcast right away. It is written later together with
+other messages in one `bulk_create` transaction. A batch is flushed when it
+reaches ``BATCH_SIZE`` messages or when the oldest message in it has waited
+``FLUSH_INTERVAL`` seconds.
+
+Durability: by default a crash of the worker loses at most the messages of the
+last ``FLUSH_INTERVAL``. With ``FLUSH_BEFORE_ACK`` the sender waits until the
+batch holding its message is committed, so nothing is acknowledged before it
+is durable. Flushes then start as soon as the writer is idle and everything
+that arrives during a flush is committed together in the next one. A socket
+that disconnects drains the writer, and whatever is still pending when the
+worker exits is written before the process ends.
+
+Read receipts drain the writer of their worker before marking messages read,
+so the messages a member has seen are never counted unread after the
+receipt. Messages still pending on other workers are counted unread when
+their batch is committed after the receipt.
+
+Configured with the ``CONVO_WRITE_BEHIND`` setting::
+
+    CONVO_WRITE_BEHIND = {
+        'ENABLED': True,
+        'BATCH_SIZE': 100,
+        'FLUSH_INTERVAL': 0.05,
+        'FLUSH_BEFORE_ACK': False,
+        'WORKER_ID': 3,
+    }
+
+Message ids are time ordered 53-bit integers, so JavaScript clients can hold
+them exactly: 40 bits of milliseconds since 2020-01-01, a 5-bit ``WORKER_ID``
+and an 8-bit sequence. Every worker writing messages needs a distinct
+``WORKER_ID`` between 0 and 31; enabling write-behind without one is an
+error. Keep every message write going through this
+path while it is enabled, since auto-increment ids handed out in between
+continue from the largest id in the table.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils import timezone
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.05,
+    'FLUSH_BEFORE_ACK': False,
+    'WORKER_ID': None,
+}
+
+EPOCH_MS = 1577836800000
+WORKER_BITS = 5
+SEQUENCE_BITS = 8
+
+
+class MessageIdAllocator:
+    def __init__(self, worker_id=None):
+        # Two workers sharing an id mint the same message ids; the second insert fails after the ack.
+        if worker_id is None:
+            raise ImproperlyConfigured("Write-behind needs a distinct CONVO_WRITE_BEHIND['WORKER_ID'] per worker.")
+        if not 0 <= worker_id < 1 << WORKER_BITS:
+            raise ImproperlyConfigured(
+                "CONVO_WRITE_BEHIND['WORKER_ID'] must be between 0 and %d." % ((1 << WORKER_BITS) - 1)
+            )
+        self.worker_id = worker_id
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            now = int(time.time() * 1000) - EPOCH_MS
+            if now < self.last_ms:
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) % (1 << SEQUENCE_BITS)
+                if self.sequence == 0:
+                    now += 1
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return (now << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+class MessageWriter:
+    def __init__(self, batch_size=100, flush_interval=0.05, flush_before_ack=False, worker_id=None, **kwargs):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_before_ack = flush_before_ack
+        self.ids = MessageIdAllocator(worker_id)
+        self.pending = []
+        self.flush_lock = asyncio.Lock()
+        self.timer = None
+        self.flushing = False
+        self.tasks = set()
+        self.loop = None
+
+    def prepare(self, message):
+        """
+        Give an unsaved message its final id and creation time.
+        """
+        message.id = self.ids.next_id()
+        message.created_at = timezone.now()
+        return message
+
+    async def submit(self, message):
+        """
+        Queue a prepared message. Returns once it is committed if the writer
+        flushes before acknowledging, otherwise right away.
+        """
+        loop = asyncio.get_running_loop()
+        committed = loop.create_future()
+        self.pending.append((message, committed))
+        if self.flush_before_ack or len(self.pending) >= self.batch_size:
+            self.start_flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.flush_interval, self.start_flush)
+        if self.flush_before_ack:
+            await committed
+
+    async def drain(self):
+        """
+        Write everything pending now instead of waiting for the timer.
+        """
+        if self.pending:
+            self.start_flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def write_pending(self):
+        """
+        Write what is pending synchronously, once the event loop is gone at exit.
+        """
+        batch, self.pending = self.pending, []
+        for start in range(0, len(batch), self.batch_size):
+            messages = [message for message, _ in batch[start:start + self.batch_size]]
+            try:
+                Message.objects.bulk_store(messages)
+            except Exception:
+                logger.exception("Dropped %d unpersisted messages at exit", len(messages))
+
+    def start_flush(self):
+        self.timer = None
+        if self.flushing:
+            # The running flush keeps writing batches until nothing is pending.
+            return
+        self.flushing = True
+        task = asyncio.ensure_future(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            try:
+                while self.pending:
+                    batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                    await self.write(batch)
+            finally:
+                self.flushing = False
+
+    async def write(self, batch):
+        try:
+            await database_sync_to_async(Message.objects.bulk_store)([message for message, _ in batch])
+        except Exception:
+            logger.exception("Batch of %d messages failed, retrying one by one", len(batch))
+            for message, committed in batch:
+                try:
+                    await database_sync_to_async(Message.objects.bulk_store)([message])
+                except Exception as exc:
+                    self.resolve(committed, exc)
+                else:
+                    self.resolve(committed)
+        else:
+            for _, committed in batch:
+                self.resolve(committed)
+
+    def resolve(self, committed, exc=None):
+        if committed.done():
+            return
+        if exc is None:
+            committed.set_result(None)
+        elif self.flush_before_ack:
+            committed.set_exception(exc)
+        else:
+            logger.error("Dropped an unpersisted message", exc_info=exc)
+            committed.set_result(None)
+
+
+_writer = None
+_writer_config = None
+
+
+def get_writer():
+    """
+    Return the writer of the running event loop, or None when write-behind is disabled.
+    """
+    global _writer, _writer_config
+    if _writer_config is None:
+        _writer_config = {**DEFAULT_WRITE_BEHIND, **getattr(settings, 'CONVO_WRITE_BEHIND', {})}
+    if not _writer_config['ENABLED']:
+        return None
+    loop = asyncio.get_running_loop()
+    if _writer is None or _writer.loop is not loop:
+        _writer = MessageWriter(**{key.lower(): value for key, value in _writer_config.items() if key != 'ENABLED'})
+        _writer.loop = loop
+    return _writer
+
+
+def _reset_writer(setting, **kwargs):
+    global _writer, _writer_config
+    if setting == 'CONVO_WRITE_BEHIND':
+        _writer = None
+        _writer_config = None
+
+
+def _write_pending_at_exit():
+    if _writer is not None:
+        _writer.write_pending()
+
+
+setting_changed.connect(_reset_writer)
+atexit.register(_write_pending_at_exit)